@@ -0,0 +1,242 @@
+#  Collaborative filtering with implicit feedback:  factorizes the implicit
+#  user x game matrix from rating_matrix.py by alternating least squares, as in
+#  Hu, Koren and Volinsky, "Collaborative Filtering for Implicit Feedback
+#  Datasets".  Each half-step solves a regularized least squares problem for
+#  every row.  Rather than forming and inverting a matrix per row, all of the
+#  rows in a batch are solved together by a few steps of conjugate gradient
+#  (warm started from the previous factors), so that the work is done by large
+#  NumPy (BLAS) operations.  A new user's vector is found directly from their
+#  collection ("fold-in"), without retraining.
+#
+#  Train the model served by server.py (from the collections saved so far)
+#  with:  uv run als.py
+
+import os
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from constants import (ALS_DATA, ALS_FACTORS, ALS_REGULARIZATION, ALS_ALPHA, ALS_EPOCHS,
+                       ALS_CG_STEPS, ALS_BATCH_NNZ, RATING_MATRIX_DATA)
+from collection_warehouse import CollectionWarehouse
+from rating_matrix import _implicit, build_from_warehouse
+
+
+def _batches(indptr, max_nnz=ALS_BATCH_NNZ):
+    '''Split the rows of a CSR matrix into ranges with about max_nnz entries.'''
+    bounds = [0]
+    while bounds[-1] < len(indptr) - 1:
+        start = bounds[-1]
+        end = np.searchsorted(indptr, indptr[start] + max_nnz, side='right') - 1
+        bounds.append(min(max(end, start + 1), len(indptr) - 1))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _solveRows(confidence, Y, X, YtY, regularization, alpha, steps=ALS_CG_STEPS):
+    '''Update the factors X (in place) for the rows of the confidence matrix,
+       given the factors Y of its columns.
+    '''
+    indptr = np.asarray(confidence.indptr)
+    for start, end in _batches(indptr):
+        block = confidence[start:end]
+        nnz = block.nnz
+        if nnz == 0:
+            X[start:end] = 0
+            continue
+        #  S sums the entries of each row, e.g. S @ M for an nnz x f matrix M
+        S = sp.csr_matrix((np.ones(nnz, dtype=np.float32), np.arange(nnz), block.indptr - block.indptr[0]),
+                          shape=(end - start, nnz))
+        rows = np.repeat(np.arange(end - start), np.diff(block.indptr))
+        Yi = Y[block.indices]
+        extra = (alpha * block.data).astype(np.float32)[:, None]
+
+        def product(x):
+            #  A x, where A = YtY + Y^T (C - I) Y + regularization * I
+            return x @ YtY + regularization * x + S @ (extra * np.einsum('ij,ij->i', Yi, x[rows])[:, None] * Yi)
+
+        x = X[start:end].astype(np.float32)
+        r = S @ ((1 + extra) * Yi) - product(x)
+        p = r.copy()
+        rs = np.einsum('ij,ij->i', r, r)
+        for _ in range(steps):
+            Ap = product(p)
+            pAp = np.einsum('ij,ij->i', p, Ap)
+            step = np.divide(rs, pAp, out=np.zeros_like(rs), where=pAp > 0)[:, None]
+            x += step * p
+            r -= step * Ap
+            rs_new = np.einsum('ij,ij->i', r, r)
+            p = r + np.divide(rs_new, rs, out=np.zeros_like(rs), where=rs > 0)[:, None] * p
+            rs = rs_new
+        X[start:end] = x
+
+
+class ALSModel():
+    '''A class for an implicit matrix factorization:  user_factors and
+       item_factors (float32 arrays with a row for each user and game of the
+       RatingMatrix that it was trained on), along with the usernames and
+       game ids for those rows.  A user's predicted preference for a game
+       is the dot product of their factors.
+    '''
+    def __init__(self, users, games, user_factors, item_factors,
+                 regularization=ALS_REGULARIZATION, alpha=ALS_ALPHA):
+        self.users = np.asarray(users)
+        self.games = np.asarray(games, dtype=np.int64)
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self._game_index = pd.Index(self.games)
+        self._user_index = None
+        self._YtY = None
+
+    def __repr__(self):
+        return f'ALSModel: {len(self.users)} users x {len(self.games)} games, ' + \
+               f'{self.item_factors.shape[1]} factors'
+
+    @classmethod
+    def fit(cls, matrix, factors=ALS_FACTORS, epochs=ALS_EPOCHS, regularization=ALS_REGULARIZATION,
+            alpha=ALS_ALPHA, checkpoint=None, seed=0):
+        '''Train a model on the implicit matrix of a RatingMatrix.
+
+           checkpoint:  A filename where the factors are saved after every
+                        epoch, which is removed once training has finished.
+                        If it exists (i.e. an earlier fit was interrupted),
+                        training resumes from it (with new users and games,
+                        if the matrix has grown since, starting from random
+                        factors).
+        '''
+        rng = np.random.default_rng(seed)
+        n_users, n_games = matrix.shape
+        user_factors = (rng.standard_normal((n_users, factors)) * 0.01).astype(np.float32)
+        item_factors = (rng.standard_normal((n_games, factors)) * 0.01).astype(np.float32)
+        first = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with np.load(checkpoint) as saved:
+                old_users, old_items = saved['user_factors'], saved['item_factors']
+                if old_users.shape[1] == factors and int(saved['epoch']) < epochs:
+                    user_factors[:len(old_users)] = old_users[:n_users]
+                    item_factors[:len(old_items)] = old_items[:n_games]
+                    first = int(saved['epoch'])
+
+        by_user = sp.csr_matrix(matrix.implicit, dtype=np.float32)
+        by_game = by_user.T.tocsr()
+        for epoch in range(first, epochs):
+            _solveRows(by_user, item_factors, user_factors, item_factors.T @ item_factors,
+                       regularization, alpha)
+            _solveRows(by_game, user_factors, item_factors, user_factors.T @ user_factors,
+                       regularization, alpha)
+            if checkpoint is not None:
+                with open(f'{checkpoint}.tmp', 'wb') as f:
+                    np.savez(f, user_factors=user_factors, item_factors=item_factors, epoch=epoch + 1)
+                os.replace(f'{checkpoint}.tmp', checkpoint)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return cls(matrix.users, matrix.games, user_factors, item_factors, regularization, alpha)
+
+    def YtY(self):
+        if self._YtY is None:
+            self._YtY = np.asarray(self.item_factors.T @ self.item_factors, dtype=np.float64)
+        return self._YtY
+
+    def user_vector(self, username):
+        '''Return the factors of a user in the training data (or None).'''
+        if self._user_index is None:
+            self._user_index = pd.Index(self.users)
+        row = self._user_index.get_indexer([username])[0]
+        return None if row < 0 else np.asarray(self.user_factors[row])
+
+    def fold_in(self, collection):
+        '''Return the factors for a collection (as from get_collection) that
+           the model wasn't trained on, by solving the user's half of the
+           least squares problem with the item factors held fixed.
+        '''
+        table = collection.reset_index()
+        confidence = _implicit(table)
+        columns = self._game_index.get_indexer(table['id'])
+        keep = (columns >= 0) & (confidence > 0)
+        Yu = np.asarray(self.item_factors[columns[keep]], dtype=np.float64)
+        extra = self.alpha * confidence[keep].astype(np.float64)
+        A = self.YtY() + Yu.T @ (Yu * extra[:, None]) + self.regularization * np.eye(Yu.shape[1])
+        return np.linalg.solve(A, Yu.T @ (1 + extra)).astype(np.float32)
+
+    def scores(self, vector):
+        '''Return the predicted preference of a user (given by their
+           factors) for every game, as a Series indexed by game id.
+        '''
+        return pd.Series(self.item_factors @ vector, index=pd.Index(self.games, name='id'),
+                         name='score')
+
+    def recommend(self, vector, n=10, exclude=None):
+        '''Return a Series of the n games (other than the exclude ids) with
+           the highest predicted preference, for a user's factors.
+        '''
+        scores = np.asarray(self.item_factors @ vector, dtype=np.float32)
+        if exclude is not None:
+            excluded = self._game_index.get_indexer(np.asarray(list(exclude), dtype=np.int64))
+            scores[excluded[excluded >= 0]] = -np.inf
+        n = min(n, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        top = top[np.isfinite(scores[top])]
+        return pd.Series(scores[top], index=pd.Index(self.games[top], name='id'), name='score')
+
+    def recommend_for_user(self, user, n=10):
+        '''Return recommendations for a User, folding them in if they weren't
+           in the training data, excluding the games in their collection.
+        '''
+        vector = self.user_vector(user.bggUserName)
+        if vector is None:
+            vector = self.fold_in(user.collection)
+        return self.recommend(vector, n, exclude=user.collection.index)
+
+    def save(self, path=ALS_DATA):
+        '''Save the model, replacing a saved one atomically:  the arrays are
+           all written to temporary files first, and then each renamed over
+           the old one, so that a server with the old arrays memory-mapped
+           keeps reading them (and one loading the model doesn't see any
+           partly written arrays).
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = {'users': self.users.astype(str), 'games': self.games,
+                  'user_factors': self.user_factors, 'item_factors': self.item_factors,
+                  'parameters': np.array([self.regularization, self.alpha])}
+        for name, array in arrays.items():
+            with open(f'{path}/{name}.npy.tmp', 'wb') as f:
+                np.save(f, array)
+        for name in arrays:
+            os.replace(f'{path}/{name}.npy.tmp', f'{path}/{name}.npy')
+
+    @classmethod
+    def load(cls, path=ALS_DATA, mmap_mode='r'):
+        '''Load a saved model, with the factors memory-mapped by default.'''
+        regularization, alpha = np.load(f'{path}/parameters.npy')
+        return cls(np.load(f'{path}/users.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/games.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/user_factors.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/item_factors.npy', mmap_mode=mmap_mode),
+                   float(regularization), float(alpha))
+
+
+def train(warehouse=None, matrix_path=RATING_MATRIX_DATA, path=ALS_DATA, **kwargs):
+    '''Build the rating matrix from the collections in the warehouse (by
+       default, the saved collections of every user), save it, and train a
+       model on it, saved where server.py loads it from.  The training is
+       checkpointed in path, so an interrupted run resumes where it stopped.
+       Any other arguments are passed to ALSModel.fit.
+
+       Returns:  The model.
+    '''
+    if warehouse is None:
+        warehouse = CollectionWarehouse()
+        warehouse.ingest_files()
+    matrix = build_from_warehouse(warehouse)
+    matrix.save(matrix_path)
+    os.makedirs(path, exist_ok=True)
+    model = ALSModel.fit(matrix, checkpoint=f'{path}/checkpoint.npz', **kwargs)
+    model.save(path)
+    return model
+
+
+if __name__ == '__main__':
+    print(train())
@@ -3,14 +3,16 @@
 
 import pandas as pd
 import numpy as np
-import requests
 import re
-import time
 import dill
+import io
 
+from array import array
 from bs4 import BeautifulSoup
+from lxml import etree
 
-from constants import BASE_API, EXTRA_DATA, SLEEP_DELAY, AUTHORIZATION_DICT
+from constants import BASE_API, EXTRA_DATA, MAX_THING_IDS
+from http_client import get_client
 
 #  Filter out some annoying warnings from the latest version of BeautifulSoup
 import warnings
@@ -18,7 +20,7 @@ from bs4.builder import XMLParsedAsHTMLWarning
 warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
 
 
-def get_thing(id, **args):
+def get_thing(id, ttl=None, **args):
     '''A "thing" is BGG's designation for a physical item, 
        such as a board game, expansion, board game accessory, 
        etc.  The "id" supplied can have several numbers 
@@ -34,33 +36,55 @@ def get_thing(id, **args):
        to the query string (preceded, of course, by an ampersand 
        to make it a separate element of the URL query string).  
        
+       ttl is how old (as a timedelta) a copy of the response in the 
+       response cache may be, where None uses the default for "thing"s
+       and timedelta(0) always makes the request.
+
        Returns:  A string for the "thing".  The only processing 
        done is to remove the newline and tab characters from 
        the string.  
     '''
    
-    url = f'{BASE_API}/thing?'
-    for (k,v) in args.items():   #  Add the arbitrary (key,value) 
-                                 #  pairs passed to the query string.
-        url += str(k) + '=' + str(v) + '&'
-        
-    url = url + 'id=' + str(id).strip()
-
-    r = requests.get(url,
-                     headers=AUTHORIZATION_DICT)
-    if r.status_code == 404:
+    params = {str(k): str(v) for (k,v) in args.items()}   #  Add the arbitrary
+                                                          #  (key,value) pairs.
+    params['id'] = str(id).strip()
+
+    r = get_client().get(f'{BASE_API}/thing', params, ttl)
+    if r.status_code != 200:   #  i.e. 404, or still queued/throttled after retrying
         return None
-    while r.status_code == 202:
-        time.sleep(5)
-        r = requests.get(url)
     return re.sub('[\n\t]', '', r.text)
 
 
+def get_things(ids, ttl=None, **args):
+    '''Retrieve several "things" concurrently through the shared client.
+
+       ids:  An iterable of ids, where each can be a single id or a list 
+       of ids that are retrieved together in one request.  ttl and **args 
+       are as for get_thing.
+
+       Returns:  A generator of (ids, string) pairs in the order that the 
+       requests complete, where the string is None if the request failed.
+    '''
+    params = {str(k): str(v) for (k,v) in args.items()}
+    requests_ = []
+    for key in ids:
+        if isinstance(key, (list, tuple, range)):
+            key = tuple(key)
+            query = ','.join(str(x) for x in key)
+        else:
+            query = str(key).strip()
+        requests_.append((key, f'{BASE_API}/thing', dict(params, id=query)))
+    for key, r in get_client().fetch_many(requests_, ttl):
+        if r.status_code != 200:
+            yield key, None
+        else:
+            yield key, re.sub('[\n\t]', '', r.text)
+
+
 def getBGGCategories(save=False):
     '''Retrieve all of the boardgame categories used by BGG for classification.'''
     
-    page = requests.get('https://boardgamegeek.com/browse/boardgamecategory',
-                        headers=AUTHORIZATION_DICT)
+    page = get_client().get('https://boardgamegeek.com/browse/boardgamecategory')
     soup = BeautifulSoup(page.text, 'lxml')
     result = []
     for item in soup.findAll('td'):
@@ -82,8 +106,7 @@ def getBGGMechanisms(save=False):
     '''Retrieve all of the boardgame mechanisms used by BGG for classification.'''
     
     mechs = []
-    page = requests.get('https://boardgamegeek.com/browse/boardgamemechanic',
-                        headers=AUTHORIZATION_DICT)
+    page = get_client().get('https://boardgamegeek.com/browse/boardgamemechanic')
     soup = BeautifulSoup(re.sub('[\t\n]', '', page.text), 'lxml')
     for item in soup.findAll('td'):
         anchor = item.find('a')
@@ -100,91 +123,168 @@ def getBGGMechanisms(save=False):
     return result
 
 
-def _cleanGameItem(response):
-    '''A utility method to take an XML <item> from a BGG response and
-       parse to a DataFrame with information about the game.
+#  The columns (after the "id" index) of the DataFrame built by _cleanGameItem.
+GAME_COLUMNS = ['name', 'subtype', 'description', 'yearpublished', 'minplayers',
+                'maxplayers', 'playingtime', 'minplaytime', 'maxplaytime',
+                'averating', 'bayesaverage', 'bggrank', 'averageweight',
+                'categories', 'mechanics', 'family', 'designer', 'artist',
+                'publisher', 'expansions', 'basegames', 'numratings']
+_INT_TAGS = {'yearpublished': 'yearpublished', 'minplayers': 'minplayers',
+             'maxplayers': 'maxplayers', 'playingtime': 'playingtime',
+             'minplaytime': 'minplaytime', 'maxplaytime': 'maxplaytime',
+             'usersrated': 'numratings'}
+_FLOAT_TAGS = {'average': 'averating', 'bayesaverage': 'bayesaverage',
+               'averageweight': 'averageweight'}
+_LINK_TYPES = {'boardgamecategory': 'categories', 'boardgamemechanic': 'mechanics',
+               'boardgamefamily': 'family', 'boardgamedesigner': 'designer',
+               'boardgameartist': 'artist', 'boardgamepublisher': 'publisher',
+               'boardgameexpansion': 'expansions'}
+_INT_COLUMNS = list(_INT_TAGS.values()) + ['bggrank']
+#  Runs of whitespace (including the escaped newlines and dashes) become a
+#  single space, and escaped quotes become quotes.
+_DESCRIPTION_CLEANUP = re.compile(r'(?:\s|&#10;|&mdash;|&ndash;)+|&quot;')
+
+
+def _cleanGameItem(response, vocabularies=None):
+    '''A utility method to take the XML text of a BGG "thing" response and
+       parse all of its <item>s into a single DataFrame with information
+       about the games, indexed by the game id.
+
+       Each <item> is walked exactly once (using lxml's iterparse), and the
+       values are appended straight into per-column buffers, rather than
+       building a one-row DataFrame per game.  Missing values are NaN, and
+       the integer columns are only stored as floats if one of the games
+       is missing that value (just as with concatenating one-row DataFrames).
+
+       vocabularies:  An optional dictionary of taxonomy.Vocabulary objects,
+       keyed by link column (e.g. 'mechanics'), to which the names of the
+       links are added along with their BGG ids.
+    '''
+    if isinstance(response, str):
+        response = response.encode('utf-8')
+
+    ids = []
+    text_columns = {c: [] for c in ['name', 'subtype', 'description']}
+    number_columns = {c: array('d') for c in _INT_COLUMNS + list(_FLOAT_TAGS.values())}
+    link_columns = {c: [] for c in list(_LINK_TYPES.values()) + ['basegames']}
+
+    for _, item in etree.iterparse(io.BytesIO(response), events=('end',), tag='item'):
+        #  Ignore any <item>s nested inside of another item (e.g. versions).
+        if item.getparent() is not None and item.getparent().tag == 'items':
+            _parseGameItem(item, ids, text_columns, number_columns, link_columns, vocabularies)
+            item.clear()
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+
+    data = dict()
+    data.update(text_columns)
+    for column, values in number_columns.items():
+        values = np.array(values, dtype=np.float64)
+        if column in _INT_COLUMNS and not np.isnan(values).any():
+            values = values.astype(np.int64)
+        data[column] = values
+    data.update(link_columns)
+
+    return pd.DataFrame(data, index=pd.Index(ids, name='id'), columns=GAME_COLUMNS)
+
+
+def _parseGameItem(item, ids, text_columns, number_columns, link_columns, vocabularies=None):
+    '''A utility method for _cleanGameItem, that walks a single <item>
+       element once and appends its values to the column buffers.
     '''
-    results = dict()
-    results['id'] = int(response.attrs['id'])
-    try:
-        results['name'] = response.find('name').attrs['value']
-    except AttributeError:
-        results['name'] = np.nan
-    results['subtype'] = response.attrs['type']
-    #  Clean the description up a little bit here
-    try:
-        results['description'] = response.find('description').text
-        results['description'] = re.sub(r'&#10;|&mdash;|&ndash;', ' ', results['description'])
-        results['description'] = re.sub(r'\s+', ' ', results['description'])
-        results['description'] = re.sub(r'&quot;', '"', results['description'])
-    except AttributeError:
-        results['description'] = np.nan
-        
-    try:
-        results['yearpublished'] = int(response.find('yearpublished').attrs['value'])
-    except AttributeError:
-        results['yearpublished'] = np.nan
-    try:
-        results['minplayers'] = int(response.find('minplayers').attrs['value'])
-    except AttributeError:
-        results['minplayers'] = np.nan
-    try:
-        results['maxplayers'] = int(response.find('maxplayers').attrs['value'])
-    except AttributeError:
-        results['maxplayers'] = np.nan
-    try:
-        results['playingtime'] = int(response.find('playingtime').attrs['value'])
-    except AttributeError:
-        results['playingtime'] = np.nan
-    try:
-        results['minplaytime'] = int(response.find('minplaytime').attrs['value'])
-    except AttributeError:
-        results['minplaytime'] = np.nan
-    try:
-        results['maxplaytime'] = int(response.find('maxplaytime').attrs['value'])
-    except AttributeError:
-        results['maxplaytime'] = np.nan
-    try:
-        results['averating'] = float(response.find('average').attrs['value'])
-    except (AttributeError, ValueError):
-        results['averating'] = np.nan
-    try:
-        results['bayesaverage'] = float(response.find('bayesaverage').attrs['value'])
-    except (AttributeError, ValueError):
-        results['bayesaverage'] = np.nan
-    try:
-        results['bggrank'] = int([r['value'] for r in response.find_all('rank') 
-                                  if r.attrs['name'] == 'boardgame'][0])
-    except (AttributeError, IndexError, ValueError):
-        results['bggrank'] = np.nan
-    try:
-        results['averageweight'] = float(response.find('averageweight').attrs['value'])
-    except (AttributeError, ValueError):
-        results['averageweight'] = np.nan
-    results['categories'] = [c['value'] for c in response.find_all('link') 
-                             if c['type'] == 'boardgamecategory']
-    results['mechanics'] = [c['value'] for c in response.find_all('link') 
-                            if c['type'] == 'boardgamemechanic']
-    results['family'] = [c['value'] for c in response.find_all('link') 
-                         if c['type'] == 'boardgamefamily']
-    results['designer'] = [c['value'] for c in response.find_all('link') 
-                           if c['type'] == 'boardgamedesigner']
-    results['artist'] = [c['value'] for c in response.find_all('link') 
-                         if c['type'] == 'boardgameartist']
-    results['publisher'] = [c['value'] for c in response.find_all('link') 
-                            if c['type'] == 'boardgamepublisher']
-    results['expansions'] = [int(c['id']) for c in response.find_all('link')
-                             if c['type'] == 'boardgameexpansion']
-    try:
-        if response.find('usersrated'):
-            results['numratings'] = int(response.find('usersrated').attrs['value'])
-    except ValueError:
-        results['numratings'] = 0
-
-    return pd.DataFrame([results]).set_index('id')  
-
-
-def getGame(bggGameId):
+    values = dict()
+    links = {c: [] for c in link_columns}
+    for element in item.iter():
+        tag = element.tag
+        if tag == 'link':
+            column = _LINK_TYPES.get(element.get('type'))
+            if column == 'expansions':
+                #  An expansion links back to its base game(s) with an
+                #  "inbound" link of the same type.
+                if element.get('inbound') == 'true':
+                    links['basegames'].append(int(element.get('id')))
+                else:
+                    links[column].append(int(element.get('id')))
+            elif column is not None:
+                links[column].append(element.get('value'))
+                if vocabularies is not None and column in vocabularies:
+                    vocabularies[column].add(element.get('value'), int(element.get('id')))
+        elif tag == 'rank':
+            if element.get('name') == 'boardgame' and 'bggrank' not in values:
+                try:
+                    values['bggrank'] = int(element.get('value'))
+                except (TypeError, ValueError):
+                    values['bggrank'] = np.nan
+        elif tag == 'name':
+            if 'name' not in values:
+                values['name'] = element.get('value')
+        elif tag == 'description':
+            #  Clean the description up a little bit here (in one pass)
+            values['description'] = _DESCRIPTION_CLEANUP.sub(
+                lambda m: '"' if m.group() == '&quot;' else ' ', element.text or '')
+        elif tag in _INT_TAGS:
+            if _INT_TAGS[tag] not in values:
+                try:
+                    values[_INT_TAGS[tag]] = int(element.get('value'))
+                except (TypeError, ValueError):
+                    values[_INT_TAGS[tag]] = 0 if tag == 'usersrated' else np.nan
+        elif tag in _FLOAT_TAGS:
+            if _FLOAT_TAGS[tag] not in values:
+                try:
+                    values[_FLOAT_TAGS[tag]] = float(element.get('value'))
+                except (TypeError, ValueError):
+                    values[_FLOAT_TAGS[tag]] = np.nan
+
+    ids.append(int(item.get('id')))
+    text_columns['name'].append(values.get('name', np.nan))
+    text_columns['subtype'].append(item.get('type'))
+    text_columns['description'].append(values.get('description', np.nan))
+    for column, buffer in number_columns.items():
+        buffer.append(values.get(column, np.nan))
+    for column, buffer in link_columns.items():
+        buffer.append(links[column])
+
+
+def _itemIds(response):
+    '''Return the ids of the <item>s in the XML text of a BGG response.'''
+    if isinstance(response, str):
+        response = response.encode('utf-8')
+    return [int(item.get('id')) for _, item
+            in etree.iterparse(io.BytesIO(response), events=('end',), tag='item')
+            if item.getparent() is not None and item.getparent().tag == 'items']
+
+
+def _getGameBatches(ids):
+    '''Retrieve games in batches of (at most MAX_THING_IDS) ids per request,
+       with the requests made concurrently through the shared client, and 
+       then re-fetch, one at a time, only those items that were affected 
+       by the missing description bug (again concurrently).
+
+       Returns:  A DataFrame with the games found, or None.
+    '''
+    batches = [ids[index:index+MAX_THING_IDS] for index in range(0, len(ids), MAX_THING_IDS)]
+    result = []
+    broken = []
+    for _, text in get_things(batches, stats=1):
+        if text is None:
+            continue
+        games = _cleanGameItem(text)
+        broken.extend(games.index[games['description'].fillna('').astype(str).str.strip() == ''])
+        result.append(games)
+    if not result:
+        return None
+    games = pd.concat(result)
+
+    fixed = [_cleanGameItem(text) for _, text in get_things(broken, stats=1) 
+             if text is not None]
+    fixed = [f for f in fixed if len(f)]
+    if fixed:
+        fixed = pd.concat(fixed)
+        games = pd.concat([games.drop(index=fixed.index), fixed])
+    return games.sort_index()
+
+
+def getGame(bggGameId, batched=True):
     '''A method to get information about one or more games from BGG and
        return that information in the form of a DataFrame.
 
@@ -192,32 +292,37 @@ def getGame(bggGameId):
        comma-separated values for games seems to result in the description
        of game beyond the first to (not necessarily) be included in the output.
        Hence the more complicated approach to handling more than one game
-       in the request below (as well as allowing for int, str, list, range inputs).  
+       in the request below (as well as allowing for int, str, list, range inputs).
+
+       With batched=True (the default) the games are requested in groups of
+       up to MAX_THING_IDS with stats=1, and only the items that come back
+       without a description are requested again individually.  With
+       batched=False each game is requested on its own, as before.  In 
+       both cases the requests are throttled by the shared client's rate 
+       limiter, rather than by sleeping between them.
     '''
+    result = []
     if isinstance(bggGameId, int):
-        response = BeautifulSoup(get_thing(bggGameId, stats=1), 'lxml')
-        if response.find('item'):
-            result = [_cleanGameItem(response.find('item'))]
-        else:
+        response = get_thing(bggGameId, stats=1)
+        if response is None:
             return None
+        result = [_cleanGameItem(response)]
     elif isinstance(bggGameId, (str, list, range)):  #  Assumes a comma-separated string
         if isinstance(bggGameId, str):
-            games = ','.join([x.strip() for x in bggGameId.split(',')])
+            games = [x.strip() for x in bggGameId.split(',') if x.strip()]
         elif isinstance(bggGameId, (list,range)):
             games = list(bggGameId)
-            games = ','.join(str(x) for x in bggGameId)
-
-        item_numbers = [int(item.attrs['id']) for item in BeautifulSoup(get_thing(games), 'lxml').find_all('item')]
-        result = []
-        for g in item_numbers:
-            response = BeautifulSoup(get_thing(g, stats=1), 'lxml')
-            if response.find('item'):
-                result.append(_cleanGameItem(response.find('item')))
-            time.sleep(SLEEP_DELAY)
-            
+
+        if batched:
+            result = [_getGameBatches(games)]
+        else:
+            response = get_thing(','.join(str(x) for x in games))
+            item_numbers = _itemIds(response) if response is not None else []
+            result = [_cleanGameItem(text) for _, text in get_things(item_numbers, stats=1)
+                      if text is not None]
+
+    result = [r for r in result if r is not None and len(r)]
     if result:
         return pd.concat(result)
     else:
         return None
-
-
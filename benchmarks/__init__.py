@@ -0,0 +1,6 @@
+#  Benchmarks that run offline, against recorded or synthetic BGG responses
+#  served by a local stand-in for the API.  Run from the top of the
+#  repository with:
+#
+#      python -m benchmarks.run --catalog-size 5000 --output results.json
+#      python -m benchmarks.compare before.json after.json
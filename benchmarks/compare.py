@@ -0,0 +1,46 @@
+#  Compares two sets of benchmark results (from run.py), e.g. from before and
+#  after a change:
+#
+#      python -m benchmarks.compare before.json after.json --threshold 1.1
+#
+#  Prints the ratio of the median times of each benchmark, and exits with 1
+#  if any of them got slower by more than the threshold.
+
+import argparse
+import json
+import sys
+
+
+def compare(before, after, threshold=1.1):
+    '''Return a list of (benchmark, seconds before, seconds after, ratio,
+       regressed) for the benchmarks in both sets of results.
+    '''
+    rows = []
+    for name, result in after['results'].items():
+        if name not in before['results']:
+            continue
+        old, new = before['results'][name]['seconds'], result['seconds']
+        ratio = new / old if old else float('inf')
+        rows.append((name, old, new, ratio, ratio > threshold))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two sets of benchmark results.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='The ratio of the times above which a benchmark has regressed')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get('config') != after.get('config'):
+        print('Warning: the benchmarks were run with different settings.', file=sys.stderr)
+
+    rows = compare(before, after, args.threshold)
+    print(f'{before.get("commit", "")[:10]:>10} -> {after.get("commit", "")[:10]}')
+    for name, old, new, ratio, regressed in rows:
+        print(f'{name:24} {old:12.6f} {new:12.6f} {ratio:7.2f}x{"  REGRESSION" if regressed else ""}')
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
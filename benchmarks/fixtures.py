@@ -0,0 +1,217 @@
+#  The responses used by the benchmarks:  either recorded from BGG (see
+#  record.py, which keeps them in benchmarks/corpus, outside of the
+#  repository since BGG's terms of use don't allow the data to be shared),
+#  or synthetic ones in the same format, generated deterministically from
+#  the id or username so that every run sees the same data.
+#
+#  A synthetic catalog has the games with ids 1 to size, apart from every
+#  GAP-th id (which BGG returns nothing for), and about one game in five is
+#  an expansion of an earlier game.
+
+import glob
+import os
+import re
+import zlib
+
+from html import escape
+
+import numpy as np
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+#  Every GAP-th id of a synthetic catalog doesn't exist
+GAP = 11
+
+_WORDS = ('dice cards tiles worker placement engine building trading pirates farming '
+          'trains castles dungeon heroes monsters space exploration economic auction '
+          'cooperative campaign legacy deck area control negotiation bluffing puzzle '
+          'drafting set collection network roads cities empire war history fantasy '
+          'science fiction zombies animals ocean islands merchants kingdom').split()
+
+_TERMS = 'termsofuse="https://boardgamegeek.com/xmlapi/termsofuse"'
+
+
+def _rng(key):
+    return np.random.default_rng(zlib.crc32(str(key).encode()))
+
+
+def exists(bggGameId, size):
+    return 0 < bggGameId <= size and bggGameId % GAP != 0
+
+
+def _description(rng):
+    words = rng.choice(_WORDS, size=int(rng.integers(80, 400)))
+    text = ' '.join(words).capitalize()
+    #  With the entities that BGG puts into the descriptions
+    return text.replace(' cards ', ' &quot;cards&quot; ').replace(' dice ', ' dice&#10;&#10;')
+
+
+def _links(rng, kind, prefix, base, count):
+    ids = rng.choice(base, size=count, replace=False)
+    return ''.join(f'<link type="{kind}" id="{i}" value="{prefix} {i}"/>' for i in ids)
+
+
+def _isExpansion(bggGameId, rng=None):
+    rng = rng if rng is not None else _rng(('thing', bggGameId))
+    return bggGameId > 10 and rng.random() < 0.2
+
+
+def thing_item(bggGameId, size, description=True):
+    '''Return the XML of the <item> for a game of a synthetic catalog.'''
+    rng = _rng(('thing', bggGameId))
+    expansion = _isExpansion(bggGameId, rng)
+    kind = 'boardgameexpansion' if expansion else 'boardgame'
+    minplayers = int(rng.integers(1, 4))
+    maxplayers = minplayers + int(rng.integers(0, 5))
+    playingtime = int(rng.choice([15, 30, 45, 60, 90, 120, 180]))
+    ratings = int(rng.pareto(1.2) * 20)
+    average = float(np.clip(rng.normal(6.8, 0.9), 1, 10)) if ratings else 0
+    rank = (f'<rank type="subtype" id="1" name="boardgame" friendlyname="Board Game Rank" '
+            f'value="{bggGameId}" bayesaverage="{5.5 + average / 10:.5f}"/>'
+            if ratings > 30 and not expansion else
+            '<rank type="subtype" id="1" name="boardgame" friendlyname="Board Game Rank" '
+            'value="Not Ranked" bayesaverage="Not Ranked"/>')
+    desc = escape(_description(rng), quote=False) if description else ''
+    links = (_links(rng, 'boardgamecategory', 'Category', np.arange(1000, 1090), int(rng.integers(1, 5))) +
+             _links(rng, 'boardgamemechanic', 'Mechanic', np.arange(2000, 2190), int(rng.integers(1, 8))) +
+             _links(rng, 'boardgamefamily', 'Family', np.arange(3000, 3500), int(rng.integers(0, 4))) +
+             _links(rng, 'boardgamedesigner', 'Designer', np.arange(4000, 6000), int(rng.integers(1, 3))) +
+             _links(rng, 'boardgameartist', 'Artist', np.arange(6000, 8000), int(rng.integers(0, 3))) +
+             _links(rng, 'boardgamepublisher', 'Publisher', np.arange(8000, 9000), int(rng.integers(1, 6))))
+    if expansion:
+        base = int(rng.integers(1, bggGameId))
+        links += f'<link type="boardgameexpansion" id="{base}" value="Game {base}" inbound="true"/>'
+    else:
+        for other in rng.integers(bggGameId + 1, bggGameId + 500, size=int(rng.integers(0, 3))):
+            links += f'<link type="boardgameexpansion" id="{other}" value="Game {other}"/>'
+    polls = ''.join(f'<results numplayers="{p}"><result value="Best" numvotes="{int(rng.integers(0, 50))}"/>'
+                    f'<result value="Recommended" numvotes="{int(rng.integers(0, 50))}"/>'
+                    f'<result value="Not Recommended" numvotes="{int(rng.integers(0, 50))}"/></results>'
+                    for p in range(minplayers, maxplayers + 1))
+    return (f'<item type="{kind}" id="{bggGameId}">'
+            f'<thumbnail>https://cf.geekdo-images.com/{bggGameId}_t.jpg</thumbnail>'
+            f'<image>https://cf.geekdo-images.com/{bggGameId}.jpg</image>'
+            f'<name type="primary" sortindex="1" value="Game {bggGameId}"/>'
+            f'<name type="alternate" sortindex="1" value="Spiel {bggGameId}"/>'
+            f'<description>{desc}</description>'
+            f'<yearpublished value="{1990 + bggGameId % 35}"/>'
+            f'<minplayers value="{minplayers}"/><maxplayers value="{maxplayers}"/>'
+            f'<poll name="suggested_numplayers" title="User Suggested Number of Players" '
+            f'totalvotes="{int(rng.integers(0, 200))}">{polls}</poll>'
+            f'<playingtime value="{playingtime}"/><minplaytime value="{playingtime // 2}"/>'
+            f'<maxplaytime value="{playingtime}"/><minage value="{int(rng.integers(6, 15))}"/>'
+            f'{links}'
+            f'<statistics page="1"><ratings><usersrated value="{ratings}"/>'
+            f'<average value="{average:.5f}"/><bayesaverage value="{5.5 + average / 10:.5f}"/>'
+            f'<ranks>{rank}</ranks><stddev value="1.4"/><median value="0"/>'
+            f'<owned value="{ratings * 2}"/><trading value="3"/><wanting value="4"/>'
+            f'<wishing value="10"/><numcomments value="{ratings // 5}"/><numweights value="{ratings // 10}"/>'
+            f'<averageweight value="{float(rng.uniform(1, 4.5)) if ratings else 0:.4f}"/>'
+            f'</ratings></statistics></item>')
+
+
+def _recordedItem(bggGameId):
+    filename = f'{CORPUS}/thing/{bggGameId}.xml'
+    if not os.path.exists(filename):
+        return None
+    with open(filename, encoding='utf-8') as f:
+        match = re.search(r'<item .*</item>', f.read(), re.S)
+    return match.group(0) if match else ''
+
+
+def thing(ids, size, description_bug=True):
+    '''Return the "thing" response for some ids, from the recorded corpus
+       where possible.  With description_bug, the games after the first
+       come back without a description (as BGG does for multi-id requests).
+    '''
+    items = []
+    for bggGameId in ids:
+        item = _recordedItem(bggGameId)
+        if item is None and exists(bggGameId, size):
+            item = thing_item(bggGameId, size, description=True)
+        if not item:
+            continue
+        if description_bug and items:
+            item = re.sub(r'<description>.*?</description>', '<description></description>', item,
+                          flags=re.S)
+        items.append(item)
+    return f'<?xml version="1.0" encoding="utf-8"?><items {_TERMS}>{"".join(items)}</items>'
+
+
+def is_user(username):
+    '''Whether a username is one of the synthetic users or recorded.'''
+    return (re.fullmatch(r'user\d+', username) is not None or
+            bool(glob.glob(f'{CORPUS}/collection/{glob.escape(username)}-*.xml')))
+
+
+def collection_ids(username, size, items=300):
+    '''Return the (sorted) ids of the games in a synthetic user's collection.'''
+    rng = _rng(('collection', username))
+    ids = rng.choice(np.arange(1, size + 1), size=min(items, size), replace=False)
+    return np.sort(ids[ids % GAP != 0])
+
+
+def _collectionItem(bggGameId, rng):
+    kind = 'boardgameexpansion' if _isExpansion(bggGameId) else 'boardgame'
+    own = int(rng.random() < 0.7)
+    wishlist = int(not own and rng.random() < 0.5)
+    rating = f'{rng.integers(1, 11)}' if rng.random() < 0.6 else 'N/A'
+    comment = '<comment>Great with four</comment>' if rng.random() < 0.1 else ''
+    priority = f'wishlistpriority="{rng.integers(1, 6)}" ' if wishlist else ''
+    return (f'<item objecttype="thing" objectid="{bggGameId}" subtype="{kind}" collid="{bggGameId * 7}">'
+            f'<name sortindex="1">Game {bggGameId}</name>'
+            f'<yearpublished>{1990 + bggGameId % 35}</yearpublished>'
+            f'<image>https://cf.geekdo-images.com/{bggGameId}.jpg</image>'
+            f'<stats minplayers="2" maxplayers="4" minplaytime="30" maxplaytime="60" '
+            f'playingtime="60" numowned="100"><rating value="{rating}"><usersrated value="50"/>'
+            f'<average value="7.1"/><bayesaverage value="6.2"/><stddev value="1.2"/><median value="0"/>'
+            f'<ranks><rank type="subtype" id="1" name="boardgame" friendlyname="Board Game Rank" '
+            f'value="{bggGameId}" bayesaverage="6.2"/></ranks></rating></stats>'
+            f'<status own="{own}" prevowned="{int(not own and rng.random() < 0.2)}" fortrade="0" '
+            f'want="0" wanttoplay="{int(rng.random() < 0.1)}" wanttobuy="0" wishlist="{wishlist}" '
+            f'{priority}preordered="0" '
+            f'lastmodified="2024-{1 + bggGameId % 12:02d}-{1 + bggGameId % 28:02d} 10:00:00"/>'
+            f'<numplays>{int(rng.integers(0, 20))}</numplays>{comment}</item>', kind)
+
+
+def collection(username, size, subtype=None, excludesubtype=None, items=300):
+    '''Return the collection response for a user (recorded, or synthetic),
+       restricted to a subtype (or excluding one) as BGG does.
+    '''
+    kind = subtype or ('boardgame' if excludesubtype == 'boardgameexpansion' else None)
+    filename = f'{CORPUS}/collection/{username}-{kind}.xml'
+    if os.path.exists(filename):
+        with open(filename, encoding='utf-8') as f:
+            return f.read()
+    rng = _rng(('collection-items', username))
+    found = []
+    for bggGameId in collection_ids(username, size, items):
+        item, item_kind = _collectionItem(int(bggGameId), rng)
+        if (subtype is None or item_kind == subtype) and item_kind != excludesubtype:
+            found.append(item)
+    return ('<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n'
+            f'<items totalitems="{len(found)}" {_TERMS} pubdate="Thu, 01 Jan 2026 00:00:00 +0000">\n\t'
+            + '\n\t'.join(found) + '</items>')
+
+
+def buddies(username, users, page=1, page_size=1000):
+    '''Return a page of the "users" response with the Geekbuddies of a user,
+       among the synthetic users user0 ... user{users - 1}.
+    '''
+    filename = f'{CORPUS}/users/{username}-{page}.xml'
+    if os.path.exists(filename):
+        with open(filename, encoding='utf-8') as f:
+            return f.read()
+    rng = _rng(('buddies', username))
+    names = sorted(set(f'user{i}' for i in rng.integers(0, users, size=int(rng.integers(0, 40)))))
+    names = names[(page - 1) * page_size:page * page_size]
+    found = ''.join(f'<buddy id="{zlib.crc32(n.encode())}" name="{n}"/>' for n in names)
+    return (f'<?xml version="1.0" encoding="utf-8"?><user id="{zlib.crc32(username.encode())}" '
+            f'name="{username}" {_TERMS}><firstname value=""/><lastname value=""/>'
+            f'<buddies total="{len(names)}" page="{page}">{found}</buddies></user>')
+
+
+def recorded_ids():
+    '''Return the (sorted) ids of the games in the recorded corpus.'''
+    return sorted(int(re.search(r'(\d+)\.xml$', f).group(1))
+                  for f in glob.glob(f'{CORPUS}/thing/*.xml'))
@@ -0,0 +1,157 @@
+#  A local stand-in for the BGG XML API2, for the benchmarks, serving the
+#  responses from fixtures.py with BGG's behaviour:
+#
+#      - Each response takes "latency" seconds (plus some jitter)
+#      - A fraction p429 of the requests are refused with 429 (too many
+#        requests)
+#      - Each request for a user's collection gets 202 (the request has been
+#        queued) "queued" times before it is answered, as BGG does while it
+#        prepares the collection
+#      - Multi-id "thing" requests leave out the descriptions of the games
+#        after the first (the bug that getGame works around)
+#
+#  The retryable responses carry a Retry-After of retry_after seconds, so
+#  that the client's backoff doesn't dominate the benchmarks.  The counts of
+#  the responses by endpoint and status are kept in self.counts.
+#
+#  Run on its own (e.g. to point a cron job at it with BGG_BASE_API) with:
+#      python -m benchmarks.mock_bgg --port 8080 --catalog-size 20000
+
+import argparse
+import logging
+import random
+import threading
+import time
+
+from collections import Counter
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+from benchmarks import fixtures
+
+
+class MockBGG():
+    '''A class for the stand-in server, run on a background thread (use
+       it as a context manager, or call start and stop).
+    '''
+    def __init__(self, catalog_size=10000, users=1000, latency=0.05, p429=0.0, queued=1,
+                 description_bug=True, retry_after=0.01, port=0, seed=0):
+        self.catalog_size = catalog_size
+        self.users = users
+        self.latency = latency
+        self.p429 = p429
+        self.queued = queued
+        self.description_bug = description_bug
+        self.retry_after = retry_after
+        self.port = port
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self._collections = Counter()
+        self._server = None
+
+    def __repr__(self):
+        return f'MockBGG: {self.url} ({self.catalog_size} games)'
+
+    @property
+    def url(self):
+        '''The base URL of the API (for BGG_BASE_API).'''
+        return f'http://127.0.0.1:{self.port}/xmlapi2'
+
+    def _respond(self, endpoint, status, text=''):
+        with self.lock:
+            self.counts[f'{endpoint} {status}'] += 1
+        headers = {'Retry-After': str(self.retry_after)} if status in (202, 429) else {}
+        return Response(text, status=status, headers=headers,
+                        content_type='text/xml; charset=utf-8')
+
+    def _delay(self, endpoint):
+        #  Returns a 429 response if this request is refused
+        with self.lock:
+            jitter = self.random.uniform(0.8, 1.2)
+            refused = self.random.random() < self.p429
+        time.sleep(self.latency * jitter)
+        if refused:
+            return self._respond(endpoint, 429, '<error><message>Rate limit exceeded.</message></error>')
+        return None
+
+    def app(self):
+        app = Flask(__name__)
+
+        @app.get('/xmlapi2/thing')
+        def thing():
+            refused = self._delay('thing')
+            if refused is not None:
+                return refused
+            ids = [int(x) for x in request.args.get('id', '').split(',') if x.strip()]
+            return self._respond('thing', 200, fixtures.thing(ids, self.catalog_size,
+                                                              self.description_bug))
+
+        @app.get('/xmlapi2/collection')
+        def collection():
+            refused = self._delay('collection')
+            if refused is not None:
+                return refused
+            username = request.args.get('username', '')
+            if not fixtures.is_user(username):
+                return self._respond('collection', 200, '<errors><error><message>Invalid username '
+                                     'specified</message></error></errors>')
+            key = tuple(sorted(request.args.items()))
+            with self.lock:
+                self._collections[key] += 1
+                queued = self._collections[key] <= self.queued
+                if not queued:
+                    del self._collections[key]
+            if queued:
+                return self._respond('collection', 202, '<message>Your request for this collection '
+                                     'has been accepted and will be processed.</message>')
+            return self._respond('collection', 200, fixtures.collection(
+                username, self.catalog_size, request.args.get('subtype'),
+                request.args.get('excludesubtype')))
+
+        @app.get('/xmlapi2/users')
+        def users():
+            refused = self._delay('users')
+            if refused is not None:
+                return refused
+            return self._respond('users', 200, fixtures.buddies(
+                request.args.get('name', ''), self.users, int(request.args.get('page', 1))))
+
+        return app
+
+    def start(self):
+        #  Without a line logged for every request
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self._server = make_server('127.0.0.1', self.port, self.app(), threaded=True)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the BGG XML API2.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--catalog-size', type=int, default=10000)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--p429', type=float, default=0.0)
+    parser.add_argument('--queued', type=int, default=1)
+    args = parser.parse_args()
+    with MockBGG(args.catalog_size, latency=args.latency, p429=args.p429, queued=args.queued,
+                 port=args.port) as server:
+        print(f'Serving on {server.url}  (BGG_BASE_API={server.url})')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,78 @@
+#  Records responses from BGG into the corpus used by the benchmarks (see
+#  fixtures.py), through the shared client (so with the token and the rate
+#  limit of the real jobs).  The corpus is kept out of the repository.
+#
+#      python -m benchmarks.record --ids 1-500 --users someone,someone_else
+#
+#  Each game is requested on its own, so that its description is included,
+#  and each user's collection is recorded as the two requests made by
+#  get_collection (the board games, and the expansions), along with the
+#  pages of their Geekbuddies.
+
+import argparse
+import os
+
+from datetime import timedelta
+
+from benchmarks.fixtures import CORPUS
+from constants import BASE_API, BUDDIES_PAGE_SIZE
+from http_client import get_client
+
+
+def _save(kind, name, text):
+    os.makedirs(f'{CORPUS}/{kind}', exist_ok=True)
+    with open(f'{CORPUS}/{kind}/{name}.xml', 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _parseIds(text):
+    ids = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            ids.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            ids.append(int(part))
+    return ids
+
+
+def record_games(ids):
+    saved = 0
+    for bggGameId in ids:
+        r = get_client().get(f'{BASE_API}/thing', {'id': str(bggGameId), 'stats': '1'}, timedelta(0))
+        if r.status_code == 200:
+            _save('thing', bggGameId, r.text)
+            saved += 1
+    return saved
+
+
+def record_user(username):
+    for kind, params in [('boardgame', {'excludesubtype': 'boardgameexpansion'}),
+                         ('boardgameexpansion', {'subtype': 'boardgameexpansion'})]:
+        r = get_client().get(f'{BASE_API}/collection', dict(username=username, stats=1, **params),
+                             timedelta(0))
+        if r.status_code == 200:
+            _save('collection', f'{username}-{kind}', r.text)
+    page = 1
+    while True:
+        r = get_client().get(f'{BASE_API}/users', {'name': username, 'buddies': 1, 'page': page},
+                             timedelta(0))
+        if r.status_code != 200:
+            break
+        _save('users', f'{username}-{page}', r.text)
+        if r.text.count('<buddy ') < BUDDIES_PAGE_SIZE:
+            break
+        page += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record BGG responses for the benchmarks.')
+    parser.add_argument('--ids', default='', help='Game ids, e.g. 1-500,13,822')
+    parser.add_argument('--users', default='', help='Comma-separated usernames')
+    args = parser.parse_args()
+    ids = _parseIds(args.ids)
+    if ids:
+        print(f'Recorded {record_games(ids)} of {len(ids)} games.')
+    for username in [u.strip() for u in args.users.split(',') if u.strip()]:
+        record_user(username)
+        print(f'Recorded {username}.')
@@ -0,0 +1,231 @@
+#  Runs the benchmarks against a local stand-in for BGG (see mock_bgg.py), in
+#  a temporary working directory, and writes the results as JSON, e.g.
+#
+#      python -m benchmarks.run --catalog-size 5000 --output results.json
+#
+#  The benchmarks are:
+#
+#      parse_thing             _cleanGameItem on responses of MAX_THING_IDS games
+#      get_game                getGame for a batch of games
+#      get_collection          get_collection (a full download) for each of some users
+#      user_filter             User.filter on a loaded collection
+#      update_existing_games   A run of the job, on a store of the catalog
+#      find_new_games          A run of the job, which finds the rest of the catalog
+#
+#  Each result has "seconds" (the median time of the unit being measured),
+#  which is what compare.py compares between runs.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+from benchmarks import fixtures
+from benchmarks.mock_bgg import MockBGG
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ['parse_thing', 'get_game', 'get_collection', 'user_filter',
+              'update_existing_games', 'find_new_games']
+
+
+def _timed(function, repeat):
+    '''Run function repeat times, and return the times and the last value.'''
+    times, value = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        times.append(time.perf_counter() - start)
+    return times, value
+
+
+def _result(times, units=1, **extra):
+    '''Summarize the times of runs that each did some units of work.'''
+    per_unit = [t / units for t in times]
+    result = {'seconds': statistics.median(per_unit), 'min': min(per_unit),
+              'max': max(per_unit), 'runs': len(times), 'units': units,
+              'per_second': units / statistics.median(times) if statistics.median(times) else None}
+    result.update(extra)
+    return result
+
+
+def _requests(server, client, function):
+    '''Run function, and return its value along with the requests made to
+       the server (by endpoint and status) while it ran.
+    '''
+    counts, made = server.counts.copy(), client.requests
+    value = function()
+    return value, {'requests': client.requests - made,
+                   'responses': dict(server.counts - counts)}
+
+
+#  The modules of the repository are imported within the benchmarks, since
+#  they can only be imported once run has pointed them at the stand-in.
+
+def bench_parse_thing(args, server, client):
+    from api_functions import _cleanGameItem
+    from constants import MAX_THING_IDS
+    texts = [fixtures.thing(range(first, first + MAX_THING_IDS), args.catalog_size, False)
+             for first in range(1, 50 * MAX_THING_IDS, MAX_THING_IDS)]
+    items = sum(len(_cleanGameItem(text)) for text in texts)
+    times, _ = _timed(lambda: [_cleanGameItem(text) for text in texts], args.repeat)
+    return _result(times, items, bytes=sum(len(text) for text in texts))
+
+
+def bench_get_game(args, server, client):
+    from api_functions import getGame
+    ids = list(range(1, min(args.games, args.catalog_size) + 1))
+    times, extra = [], None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        games, extra = _requests(server, client, lambda: getGame(ids))
+        times.append(time.perf_counter() - start)
+    return _result(times, len(games), **extra)
+
+
+def bench_get_collection(args, server, client):
+    from classes import get_collection
+    users = [f'user{i}' for i in range(args.users)]
+    times, extra = [], None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        _, extra = _requests(server, client, lambda: [get_collection(u, cutoff=None, full_sync=None)
+                                                      for u in users])
+        times.append(time.perf_counter() - start)
+    return _result(times, len(users), **extra)
+
+
+def bench_user_filter(args, server, client):
+    from classes import User
+    user = User('user0', cutoff=timedelta(days=365))
+    filters = [dict(own=True), dict(subtype='boardgame', has_rating=True),
+               dict(wishlist=True, wishlistpriority=2), dict(published_after=2010, min_numplays=1)]
+    calls = 200
+    times, _ = _timed(lambda: [user.filter(**f) for _ in range(calls) for f in filters], args.repeat)
+    return _result(times, calls * len(filters), collection=len(user.collection))
+
+
+def _populate(size):
+    '''Fill a game store with (about) the first 90% of the catalog, and
+       return the store.
+    '''
+    from api_functions import _cleanGameItem
+    from game_store import load_store
+    store = load_store()
+    known = int(size * 0.9)
+    for first in range(1, known + 1, 500):
+        ids = range(first, min(first + 500, known + 1))
+        store.upsert(_cleanGameItem(fixtures.thing(ids, size, description_bug=False)))
+    return store
+
+
+def bench_update_existing_games(args, server, client, state):
+    from update_existing_games import update_existing_games
+    times, extra, updated = [], None, []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        updated, extra = _requests(server, client, lambda: update_existing_games(
+                                       state['store'], state['scheduler'], args.budget,
+                                       state['history']))
+        times.append(time.perf_counter() - start)
+    return _result(times, 1, games=len(updated), **extra)
+
+
+def bench_find_new_games(args, server, client, state):
+    from find_new_games import find_new_games
+    start = time.perf_counter()
+    found, extra = _requests(server, client, lambda: find_new_games(
+                                 state['store'], state['tombstones'], state['scheduler'],
+                                 state['history']))
+    #  Only run once, since the games found aren't new the next time
+    return _result([time.perf_counter() - start], 1, games=len(found), **extra)
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    '''Run the benchmarks, and return the results as a dictionary.'''
+    server = MockBGG(args.catalog_size, users=max(args.users, 100), latency=args.latency,
+                     p429=args.p429, queued=args.queued, seed=args.seed).start()
+    workdir = tempfile.mkdtemp(prefix='bgg-bench-')
+    #  The modules of the repository read these when they are imported, and
+    #  keep their data in directories relative to the working directory.
+    os.environ['BGG_BASE_API'] = server.url
+    os.environ.setdefault('BGG_TOKEN', 'benchmark')
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    for directory in ['USERS', 'GEEKBUDDIES', 'BGG_GAMES', 'EXTRA_DATA']:
+        os.makedirs(directory, exist_ok=True)
+
+    from http_client import BGGClient, set_client
+    from stats_history import StatsHistory
+    from tombstones import TombstoneIndex
+    from update_scheduler import UpdateScheduler
+    client = BGGClient(rate=args.rate, burst=max(1, int(args.rate)))
+    set_client(client)
+
+    results, state = dict(), None
+    try:
+        #  The jobs print their progress, which mustn't get mixed into the results
+        with contextlib.redirect_stdout(sys.stderr):
+            for name in [b for b in BENCHMARKS if b in args.only]:
+                if name in ('update_existing_games', 'find_new_games') and state is None:
+                    start = time.perf_counter()
+                    store = _populate(args.catalog_size)
+                    state = {'store': store, 'scheduler': UpdateScheduler(),
+                             'tombstones': TombstoneIndex(), 'history': StatsHistory()}
+                    results['populate_store'] = _result([time.perf_counter() - start], 1,
+                                                        games=len(store.ids()))
+                function = globals()[f'bench_{name}']
+                if name in ('update_existing_games', 'find_new_games'):
+                    results[name] = function(args, server, client, state)
+                else:
+                    results[name] = function(args, server, client)
+                print(f'{name}: {results[name]["seconds"]:.6f} s', file=sys.stderr)
+    finally:
+        server.stop()
+        os.chdir(ROOT)
+
+    return {'commit': _commit(), 'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'config': {k: v for k, v in vars(args).items() if k != 'output'},
+            'workdir': workdir, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmarks against a local stand-in for BGG.')
+    parser.add_argument('--catalog-size', type=int, default=5000)
+    parser.add_argument('--games', type=int, default=200, help='Games fetched by get_game')
+    parser.add_argument('--users', type=int, default=10, help='Users synced by get_collection')
+    parser.add_argument('--budget', type=int, default=10,
+                        help='The requests budget of update_existing_games')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--p429', type=float, default=0.02)
+    parser.add_argument('--queued', type=int, default=1, help='202s before each collection')
+    parser.add_argument('--rate', type=float, default=50, help='Requests per second')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='+', default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument('--output', help='The file for the results (standard output if not given)')
+    args = parser.parse_args()
+
+    output = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
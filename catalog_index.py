@@ -0,0 +1,191 @@
+#  An index over the numeric attributes of the catalog (player counts, playing
+#  times, weight and year), for queries like "supports 5 players, plays in at
+#  most 60 minutes, weight under 2.5, published after 2015".  Each attribute
+#  is kept as a sorted float32 array (along with the rows in that order), so
+#  the number of games matching each condition is found by binary search.  A
+#  query starts from the rows of its most selective condition and checks the
+#  others only for those rows, unless none of the conditions is selective,
+#  in which case the conditions are combined as boolean masks.  There are
+#  also bitmaps of the games of each subtype, and of the games that support
+#  each player count.
+
+import pandas as pd
+import numpy as np
+
+from game_store import GameStore
+
+#  The columns of the games DataFrame used by the index
+CATALOG_COLUMNS = ['subtype', 'minplayers', 'maxplayers', 'playingtime', 'minplaytime',
+                   'maxplaytime', 'averageweight', 'yearpublished']
+
+#  A bitmap of the games that support each player count up to this.
+MAX_PLAYERS_BITMAP = 12
+
+#  The fraction of the games below which a condition counts as selective.
+SELECTIVE = 1 / 16
+
+
+class CatalogIndex():
+    '''A class for the index of the catalog:  the game ids (self.ids), and
+       for each attribute, the values (float32, in the order of self.ids)
+       and the sorted values along with the rows in that order (games
+       without a value are left out of the sorted arrays).
+
+       The playing time of a game is the range from minplaytime to
+       maxplaytime, which fall back on playingtime when they are missing,
+       and the player counts are the range from minplayers to maxplayers.
+    '''
+    def __init__(self, games):
+        self.ids = games.index.to_numpy(dtype=np.int64)
+        self._rows = pd.Index(self.ids)
+        subtype = games['subtype'].fillna('').astype(str).to_numpy()
+        self.subtypes = {name: subtype == name for name in np.unique(subtype)}
+
+        def number(column):
+            return pd.to_numeric(games[column], errors='coerce').to_numpy(dtype=np.float32)
+
+        playingtime = number('playingtime')
+        self.values = {'minplayers': number('minplayers'),
+                       'maxplayers': number('maxplayers'),
+                       'minplaytime': np.where(np.isnan(number('minplaytime')), playingtime,
+                                               number('minplaytime')),
+                       'maxplaytime': np.where(np.isnan(number('maxplaytime')), playingtime,
+                                               number('maxplaytime')),
+                       'averageweight': number('averageweight'),
+                       'yearpublished': number('yearpublished')}
+        #  A weight of 0 means that nobody has voted on it
+        self.values['averageweight'][self.values['averageweight'] <= 0] = np.nan
+
+        self.sorted = dict()
+        for column, values in self.values.items():
+            known = np.flatnonzero(~np.isnan(values))
+            order = known[np.argsort(values[known], kind='stable')].astype(np.int32)
+            self.sorted[column] = (values[order], order)
+
+        low, high = self.values['minplayers'], self.values['maxplayers']
+        self.players = {p: (low <= p) & (high >= p) for p in range(1, MAX_PLAYERS_BITMAP + 1)}
+
+    def __repr__(self):
+        return f'CatalogIndex: {len(self.ids)} games'
+
+    @classmethod
+    def from_store(cls, store=None):
+        '''Build the index from the (relevant columns of the) game store.'''
+        store = store if store is not None else GameStore()
+        return cls(store.load(columns=CATALOG_COLUMNS))
+
+    def _range(self, column, low=-np.inf, high=np.inf, low_open=False, high_open=False):
+        #  The (start, end) positions in the sorted values of the rows with
+        #  low <= value <= high (or < for the open ends).
+        values, _ = self.sorted[column]
+        start = np.searchsorted(values, low, side='right' if low_open else 'left')
+        end = np.searchsorted(values, high, side='left' if high_open else 'right')
+        return start, max(start, end)
+
+    def _conditions(self, subtype=None, players=None, min_players=None, max_players=None,
+                    max_playtime=None, min_playtime=None, max_weight=None, min_weight=None,
+                    yearpublished=None, published_before=None, published_after=None):
+        '''Turn the query into a list of conditions:  either ('range', column,
+           start, end) for a range of the sorted values, or ('mask', array).
+        '''
+        conditions = []
+        if subtype is not None:
+            conditions.append(('mask', self.subtypes.get(subtype, np.zeros(len(self.ids), dtype=bool))))
+        if players is not None:
+            if players in self.players:
+                conditions.append(('mask', self.players[players]))
+            else:
+                conditions.append(('range', 'minplayers') + self._range('minplayers', high=players))
+                conditions.append(('range', 'maxplayers') + self._range('maxplayers', low=players))
+        #  Player count ranges overlapping [min_players, max_players]
+        if min_players is not None:
+            conditions.append(('range', 'maxplayers') + self._range('maxplayers', low=min_players))
+        if max_players is not None:
+            conditions.append(('range', 'minplayers') + self._range('minplayers', high=max_players))
+        #  Games that always finish within max_playtime, and that take at
+        #  least min_playtime.
+        if max_playtime is not None:
+            conditions.append(('range', 'maxplaytime') + self._range('maxplaytime', high=max_playtime))
+        if min_playtime is not None:
+            conditions.append(('range', 'minplaytime') + self._range('minplaytime', low=min_playtime))
+        if max_weight is not None:
+            conditions.append(('range', 'averageweight') +
+                              self._range('averageweight', high=max_weight, high_open=True))
+        if min_weight is not None:
+            conditions.append(('range', 'averageweight') + self._range('averageweight', low=min_weight))
+        if yearpublished is not None:
+            conditions.append(('range', 'yearpublished') +
+                              self._range('yearpublished', yearpublished, yearpublished))
+        if published_before is not None:
+            conditions.append(('range', 'yearpublished') +
+                              self._range('yearpublished', high=published_before, high_open=True))
+        if published_after is not None:
+            conditions.append(('range', 'yearpublished') +
+                              self._range('yearpublished', low=published_after, low_open=True))
+        return conditions
+
+    def rows(self, **query):
+        '''Return the (sorted) rows of the games that match all of the
+           conditions of the query (see query).
+        '''
+        conditions = self._conditions(**query)
+        if not conditions:
+            return np.arange(len(self.ids))
+        sizes = [c[3] - c[2] if c[0] == 'range' else None for c in conditions]
+        ranges = [i for i, s in enumerate(sizes) if s is not None]
+        best = min(ranges, key=lambda i: sizes[i]) if ranges else None
+
+        if best is not None and sizes[best] <= SELECTIVE * len(self.ids):
+            #  Start from the rows of the most selective condition, and
+            #  check the others for just those rows.
+            _, column, start, end = conditions[best]
+            rows = np.sort(self.sorted[column][1][start:end])
+            for i, condition in enumerate(conditions):
+                if i == best:
+                    continue
+                if condition[0] == 'mask':
+                    rows = rows[condition[1][rows]]
+                else:
+                    _, column, start, end = condition
+                    values = self.sorted[column][0]
+                    found = self.values[column][rows]
+                    low = values[start] if end > start else np.inf
+                    high = values[end - 1] if end > start else -np.inf
+                    rows = rows[(found >= low) & (found <= high)]
+            return rows
+
+        mask = np.ones(len(self.ids), dtype=bool)
+        for condition in conditions:
+            if condition[0] == 'mask':
+                mask &= condition[1]
+            else:
+                _, column, start, end = condition
+                matched = np.zeros(len(self.ids), dtype=bool)
+                matched[self.sorted[column][1][start:end]] = True
+                mask &= matched
+        return np.flatnonzero(mask)
+
+    def query(self, **query):
+        '''Return the (sorted) ids of the games that match all of the
+           conditions of the query, any of:
+
+           subtype:                         'boardgame' or 'boardgameexpansion'
+           players:                         Supports this many players
+           min_players, max_players:        Supports some player count in this range
+           max_playtime:                    Always plays in at most this many minutes
+           min_playtime:                    Always takes at least this many minutes
+           max_weight (<), min_weight:      The range of the average weight
+           yearpublished:                   Published in this year
+           published_before, published_after:  (Strictly) before/after this year
+
+           Games without the information for a condition don't match it.
+        '''
+        return self.ids[self.rows(**query)]
+
+    def mask(self, ids, **query):
+        '''Return a boolean array of which of the games (ids) match the query.'''
+        rows = self._rows.get_indexer(np.asarray(ids, dtype=np.int64))
+        matched = np.zeros(len(self.ids) + 1, dtype=bool)
+        matched[self.rows(**query)] = True
+        #  Games that aren't in the index (row -1) look up the extra False
+        return matched[np.where(rows >= 0, rows, len(self.ids))]
@@ -1,149 +1,294 @@
 import pandas as pd
 import numpy as np
 import re
-import time
-import requests
 import dill
 import glob
 import os
 
-from bs4 import BeautifulSoup
+from lxml import etree
 from datetime import datetime, timedelta
 
-from constants import BASE_API, USER_DATA, GEEKBUDDIES_DATA, AUTHORIZATION_DICT
+from constants import (BASE_API, USER_DATA, GEEKBUDDIES_DATA, FULL_SYNC_INTERVAL, SYNC_OVERLAP,
+                       BUDDIES_PAGE_SIZE, STATUS_FLAGS)
+from http_client import get_client
+from expansion_index import ExpansionIndex
 
-#  Filter out some annoying warnings from the latest version of BeautifulSoup
-import warnings
-from bs4.builder import XMLParsedAsHTMLWarning
-warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
 
+COLLECTION_COLUMNS = ['name', 'subtype', 'yearpublished', 'status',
+       'lastmodified', 'rating', 'numplays', 'wishlistpriority',
+       'comment', 'username']
 
-def get_collection(bggUserName, cutoff=timedelta(days=7)):
-    '''For more information see:  https://boardgamegeek.com/wiki/page/BGG_XML_API2
+#  The bit of the "status" column used for each of BGG's collection status flags.
+STATUS_BITS = {flag: np.uint16(1 << bit) for bit, flag in enumerate(STATUS_FLAGS)}
 
-       Get the board games, and then get the board game 
-       expansions.  This is a quirk of the BGG xmlapi2 interface, 
-       in that it will incorrectly return the expansions as 
-       subtype="boardgame", so we make two calls to get the 
-       boardgames, and then the expansions separately.
-       
-       Returns:  A pandas DataFrame with the designated boardgames 
-       in the user's collection, with columns containing 
-       information about the games such as the user rating, 
-       number of plays, etc.  
-       
-       Note:  In an effort to reduce traffic, we will check
-       if we have previously retrieved the collections within
-       the previous week.  If so, we just load and
-       return that information, otherwise we will download the
-       collection.  
+
+def _parseCollection(text, bggUserName):
+    '''A utility method to parse the XML text of a BGG collection response
+       (with a single parse).
+
+       Returns:  A tuple of (error, rows), where error is the error message
+       returned by BGG (such as for an invalid username) or None, and rows
+       is a list of dictionaries, one for each item in the collection.
     '''
-    bggUserName = bggUserName.strip()
-    
-    #  Check:  Do we have a previous version of this
-    #  collection that was retrieved in the last 7 days (by default)? 
-    #  If so, we use that.  Otherwise we get the collection
-    #  information from BGG.
-    files_to_check = glob.glob(f'{USER_DATA}/{bggUserName}-*.*')
-    if files_to_check and (cutoff is not None):
-        name = files_to_check[0]
-        file_time_stamp = datetime(int(name[-18:-14]), int(name[-14:-12]), 
-                            int(name[-12:-10]), int(name[-9:-7]), 
-                            int(name[-7:-5]))
-        now = datetime.now()
-        if (now - file_time_stamp) <= cutoff:
-            with open(name, 'rb') as f:
-                glist = dill.load(f)
-                return glist
-    
-    result = []
-    for game_type in ['excludesubtype=boardgameexpansion', 
-                      'subtype=boardgameexpansion']:
-        url = f'{BASE_API}/collection?username={bggUserName.strip()}&{game_type}&stats=1'
+    root = etree.fromstring(re.sub('[\n\t]', '', text).encode('utf-8'))
+    error = root.find('.//error')
+    if error is not None:
+        return ''.join(error.itertext()), []
 
-        r = requests.get(url, headers=AUTHORIZATION_DICT)
-        if r.status_code == 404:
-            return 'Page not found'
-        else:
-            while r.status_code == 202:   ##  BGG says that it usually 
-                            ## queues requests for a collection, so we 
-                            ## must check for a 202 code, and sleep 
-                            ## and try again if necessary.  
-                time.sleep(12)
-                r = requests.get(url, headers=AUTHORIZATION_DICT)
-            initial_res = re.sub('[\n\t]', '', r.text)
-            #  Check if there was an error from BGG, such as 
-            #  an invalid username.  Return the error message if found.  
-            error = BeautifulSoup(initial_res, 'lxml').find('error')
-            if error:
-                return error.text
-            result.extend(list(BeautifulSoup(initial_res, 'lxml').find_all('item')))
-    
-    ##  Handle a special case where someone has not logged their collection, in
-    ##  order to avoid certain errors.  
-    if len(result) == 0:
-        with open(f'{USER_DATA}/______no_collection.dill', 'rb') as f:
-            glist = dill.load(f)
-        
-        now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
-        with open(f'{USER_DATA}/{bggUserName}-{now}.dill', 'wb') as f:
-            dill.dump(glist, f)
-        
-        return glist
-        
-    glist = []
-    for item in result:
+    rows = []
+    for item in root.iterfind('item'):
         d = dict()
-        d['id'] = int(item.attrs['objectid'])
-        d['name'] = item.find('name').text
-        d['subtype'] = item.attrs['subtype']
-        if item.find('yearpublished'):
-            d['yearpublished'] = int(item.find('yearpublished').text)
-
-        d.update(item.find("status").attrs)
-        d['numplays'] = int(item.find('numplays').text)
+        d['id'] = int(item.get('objectid'))
+        d['name'] = item.findtext('name')
+        d['subtype'] = item.get('subtype')
+        if item.find('yearpublished') is not None:
+            d['yearpublished'] = int(item.findtext('yearpublished'))
+
+        d.update(item.find('status').attrib)
+        d['numplays'] = int(item.findtext('numplays'))
         d['lastmodified'] = pd.to_datetime(d['lastmodified'])
-        if item.find('rating'):
-            d['rating'] = item.find('rating').attrs['value']
-            if d['rating'] == 'N/A':
-                d['rating'] = np.nan
-            else:
-                d['rating'] = float(d['rating'])
+        rating = item.find('.//rating')
+        if rating is not None and rating.get('value') != 'N/A':
+            d['rating'] = float(rating.get('value'))
         else:
             d['rating'] = np.nan
-        if item.find('wishlistpriority'):
-            d['wishlistpriority'] = item.find('wishlistpriority').text
-        else:
-            d['wishlistpriority'] = np.nan
-        if item.find('comment'):
-            d['comment'] = item.find('comment').text
-        else:
-            d['comment'] = np.nan
+        d['wishlistpriority'] = item.findtext('wishlistpriority',
+                                              d.get('wishlistpriority', np.nan))
+        d['comment'] = item.findtext('comment', np.nan)
         d['username'] = bggUserName
-        glist.append(d)
-    
-    glist = pd.DataFrame(glist).set_index('id').sort_values('name')
-    glist = glist[['name', 'subtype', 'yearpublished', 'own', 'prevowned', 'fortrade',
-       'want', 'wanttoplay', 'wanttobuy', 'wishlist', 'preordered',
-       'lastmodified', 'rating', 'numplays', 'wishlistpriority',
-       'comment', 'username']]
-    
-    for column in ['yearpublished', 'own', 'prevowned', 
-                   'fortrade', 'want', 'wanttoplay', 
-                   'wanttobuy', 'wishlist', 'preordered', 
-                   'numplays', 'wishlistpriority']:
-        glist[column] = glist[column].fillna(-1).astype(np.int32)
-    
-    #  Let's save the collection once we have it 
+        rows.append(d)
+    return None, rows
+
+
+def _collectionFrame(rows):
+    '''Build the collection DataFrame (indexed by game id) from the rows
+       returned by _parseCollection.
+    '''
+    glist = pd.DataFrame(rows).reindex(columns=['id'] + COLLECTION_COLUMNS + STATUS_FLAGS)
+    glist = glist.set_index('id').sort_values('name')
+
+    for column in ['yearpublished', 'numplays', 'wishlistpriority'] + STATUS_FLAGS:
+        glist[column] = pd.to_numeric(glist[column]).fillna(-1).astype(np.int32)
+    return _packCollection(glist)
+
+
+def _packCollection(glist):
+    '''Pack the status flag columns of a collection (if it still has them,
+       e.g. an older saved collection) into the uint16 "status" bitmask
+       column, and store the low-cardinality string columns as categoricals.
+    '''
+    if 'status' not in glist.columns or glist['status'].isna().all():
+        status = np.zeros(len(glist), dtype=np.uint16)
+        for flag, bit in STATUS_BITS.items():
+            status |= np.where(glist[flag].to_numpy() == 1, bit, np.uint16(0))
+        glist = glist.drop(columns=[c for c in STATUS_FLAGS if c in glist.columns])
+        glist['status'] = status
+    glist = glist.reindex(columns=COLLECTION_COLUMNS)
+    glist['status'] = glist['status'].astype(np.uint16)
+    for column in ['subtype', 'username']:
+        glist[column] = glist[column].astype('category')
+    return glist
+
+
+def unpack_status(collection):
+    '''Return a copy of a collection with the "status" bitmask expanded back
+       into separate (0/1) int32 columns, one for each status flag.
+    '''
+    result = collection.drop(columns='status')
+    status = collection['status'].to_numpy()
+    for flag, bit in STATUS_BITS.items():
+        result[flag] = ((status & bit) != 0).astype(np.int32)
+    return result
+
+
+def collection_mask(collection, subtype=None,
+                    own=None, prevowned=None,
+                    fortrade=None,
+                    want=None, wanttoplay=None, wanttobuy=None, wishlist=None,
+                    preordered=None,
+                    has_rating=None, has_comment=None,
+                    wishlistpriority=None,
+                    yearpublished=None, published_before=None, published_after=None,
+                    min_numplays=0, max_numplays=None, games=None):
+    '''Return a boolean array of which rows of a collection (or of many
+       collections together) match all of the criteria (see User.filter).
+       All of the status flags are checked together with a single comparison 
+       on the "status" bitmask.
+    '''
+    mask = np.ones(len(collection), dtype=bool)
+
+    if games is not None:
+        ids = collection['id'] if 'id' in collection.columns else collection.index
+        mask &= np.isin(ids.to_numpy(), np.asarray(games, dtype=np.int64))
+
+    if isinstance(subtype, str) and subtype in ['boardgame', 'boardgameexpansion']:
+        mask &= (collection['subtype'] == subtype).to_numpy()
+
+    required, expected = np.uint16(0), np.uint16(0)
+    for flag, value in [('own', own),
+                        ('prevowned', prevowned),
+                        ('fortrade', fortrade),
+                        ('want', want),
+                        ('wanttoplay', wanttoplay),
+                        ('wanttobuy', wanttobuy),
+                        ('wishlist', wishlist),
+                        ('preordered', preordered)]:
+        if isinstance(value, (int, bool)):
+            required |= STATUS_BITS[flag]
+            if value:
+                expected |= STATUS_BITS[flag]
+    if required:
+        mask &= (collection['status'].to_numpy() & required) == expected
+
+    for option, flag in [('rating', has_rating),
+                         ('comment', has_comment)]:
+        if isinstance(flag, (int, bool)):
+            mask &= collection[option].notna().to_numpy() == bool(flag)
+
+    if isinstance(wishlistpriority, int):
+        mask &= collection['wishlistpriority'].to_numpy() == wishlistpriority
+
+    year = collection['yearpublished'].to_numpy()
+    if isinstance(yearpublished, int):
+        mask &= year == yearpublished
+    if isinstance(published_before, int):
+        mask &= year < published_before
+    if isinstance(published_after, int):
+        mask &= year > published_after
+
+    numplays = collection['numplays'].to_numpy()
+    if isinstance(min_numplays, (int, float)):
+        mask &= numplays >= min_numplays
+    if isinstance(max_numplays, (int, float)):
+        mask &= numplays <= max_numplays
+
+    return mask
+
+
+#  The saved collections are named {username}-{time}.dill, with the time to
+#  the second, so that every refresh gives a new name (older files only have
+#  the minute).
+SAVED_COLLECTION = re.compile(r'([^/\\]+)-(\d{8}-\d{4}(?:\d{2})?)\.dill$')
+
+
+def saved_time(stamp):
+    '''Return the time in the name of a saved collection (the second group
+       of a SAVED_COLLECTION match).
+    '''
+    return datetime.strptime(stamp, '%Y%m%d-%H%M%S' if len(stamp) > 13 else '%Y%m%d-%H%M')
+
+
+def _savedCollection(bggUserName):
+    '''Return the most recently saved collection for a user, along with the
+       time that it was saved (taken from the file name), or (None, None).
+    '''
+    files = sorted(glob.glob(f'{USER_DATA}/{glob.escape(bggUserName)}-*.dill'))
+    for name in files[::-1]:
+        match = SAVED_COLLECTION.search(name)
+        if match and match.group(1) == bggUserName:
+            with open(name, 'rb') as f:
+                glist = dill.load(f)
+            attrs = dict(glist.attrs)
+            glist = _packCollection(glist)
+            glist.attrs.update(attrs)
+            return glist, saved_time(match.group(2))
+    return None, None
+
+
+def _saveCollection(bggUserName, glist, now):
     #  First remove any previous versions for this user
     files_to_delete = glob.glob(f'{USER_DATA}/{bggUserName}-*.dill')
     for f in files_to_delete:
         os.remove(f)
-        
-    now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
+
+    now = datetime.strftime(now, '%Y%m%d-%H%M%S')
     with open(f'{USER_DATA}/{bggUserName}-{now}.dill', 'wb') as f:
         dill.dump(glist, f)
-        
+
+
+def get_collection(bggUserName, cutoff=timedelta(days=7), full_sync=FULL_SYNC_INTERVAL):
+    '''For more information see:  https://boardgamegeek.com/wiki/page/BGG_XML_API2
+
+       Get the board games, and then get the board game
+       expansions.  This is a quirk of the BGG xmlapi2 interface,
+       in that it will incorrectly return the expansions as
+       subtype="boardgame", so we make two calls to get the
+       boardgames, and then the expansions separately.
+
+       Returns:  A pandas DataFrame with the designated boardgames
+       in the user's collection, with columns containing
+       information about the games such as the user rating,
+       number of plays, etc.
+
+       Note:  In an effort to reduce traffic, we will check
+       if we have previously retrieved the collection within
+       the cutoff (the previous week, by default).  If so, we
+       just load and return that information.  Otherwise we
+       only ask BGG for the items modified since we last
+       retrieved the collection, and merge those into it.  The
+       whole collection is downloaded if we don't have it yet,
+       or if the last full download is older than full_sync
+       (as items removed from a collection are only noticed
+       by a full download).  A cutoff of None always makes
+       a request.
+    '''
+    bggUserName = bggUserName.strip()
+    now = datetime.now()
+
+    previous, last_sync = _savedCollection(bggUserName)
+    if previous is not None:
+        if (cutoff is not None) and (now - last_sync) <= cutoff:
+            return previous
+        last_full_sync = previous.attrs.get('last_full_sync', last_sync)
+        incremental = (full_sync is not None) and (now - last_full_sync) < full_sync
+    else:
+        incremental = False
+
+    rows = []
+    for game_type in [{'excludesubtype': 'boardgameexpansion'},
+                      {'subtype': 'boardgameexpansion'}]:
+        params = dict(username=bggUserName, stats=1, **game_type)
+        if incremental:
+            #  Allow some overlap, since BGG's timestamps are in its own time zone.
+            since = last_sync - SYNC_OVERLAP
+            params['modifiedsince'] = since.strftime('%y-%m-%d %H:%M:%S')
+
+        ##  BGG says that it usually queues requests for a collection
+        ##  (with a 202 code), which the client retries with backoff.
+        ##  The collection is saved below, so it isn't put in the response
+        ##  cache (where it would only push out the entries that are reused).
+        r = get_client().get(f'{BASE_API}/collection', params, cache=False)
+        if r.status_code == 404:
+            return 'Page not found'
+        elif r.status_code != 200:
+            return f'Request failed with status {r.status_code}'
+        #  Check if there was an error from BGG, such as
+        #  an invalid username.  Return the error message if found.
+        error, items = _parseCollection(r.text, bggUserName)
+        if error:
+            return error
+        rows.extend(items)
+
+    if incremental:
+        glist = previous
+        if rows:
+            changes = _collectionFrame(rows)
+            glist = _packCollection(pd.concat([previous.drop(index=changes.index, errors='ignore'),
+                                               changes]).sort_values('name'))
+        glist.attrs['last_full_sync'] = last_full_sync
+    ##  Handle a special case where someone has not logged their collection, in
+    ##  order to avoid certain errors.
+    elif len(rows) == 0:
+        with open(f'{USER_DATA}/______no_collection.dill', 'rb') as f:
+            glist = _packCollection(dill.load(f))
+        glist.attrs['last_full_sync'] = now
+    else:
+        glist = _collectionFrame(rows)
+        glist.attrs['last_full_sync'] = now
+
+    #  Let's save the collection once we have it
+    _saveCollection(bggUserName, glist, now)
+
     return glist
 
 
@@ -165,9 +310,11 @@ class User():
     def __repr__(self):
         return f'BGG User: {self.bggUserName}'
     
-    def refresh_collection(self):
+    def refresh_collection(self, full=False):
         #  Force an immediate "refresh" of the collection information of a user
-        self.collection = get_collection(self.bggUserName, cutoff=timedelta(seconds=0))
+        #  (only asking for the changes since the last refresh, unless full=True)
+        self.collection = get_collection(self.bggUserName, cutoff=timedelta(seconds=0),
+                                         full_sync=timedelta(0) if full else FULL_SYNC_INTERVAL)
 
     def filter(self, subtype=None,
                own=None, prevowned=None, 
@@ -177,52 +324,26 @@ class User():
                has_rating=None, has_comment=None,
                wishlistpriority=None, 
                yearpublished=None, published_before=None, published_after=None,
-               min_numplays=0, max_numplays=None):
+               min_numplays=0, max_numplays=None, games=None):
         '''A method to filter the collection based on various 
            criteria and return a new DataFrame with the filtered 
            games.  This does not modify the underlying "collection" 
-           information of a user. 
+           information of a user.  All of the criteria are combined 
+           into a single mask (see collection_mask), which is then 
+           applied once.
+
+           games restricts the collection to the given game ids, e.g.
+           the result of a CatalogIndex query such as
+           catalog.query(players=5, max_playtime=60).
         '''
-        result = self.collection.copy()
-        
-        if isinstance(subtype, str) and subtype in ['boardgame', 'boardgameexpansion']:
-            result = result[result['subtype'] == subtype].copy()
-            
-        for option, flag in [('own', own),
-                             ('prevowned', prevowned), 
-                             ('fortrade', fortrade), 
-                             ('want', want), 
-                             ('wanttoplay', wanttoplay),
-                             ('wanttobuy', wanttobuy), 
-                             ('wishlist', wishlist), 
-                             ('preordered', preordered)]:
-            if isinstance(flag, (int, bool)):
-                result = result[result[option] == int(flag)].copy()
-        
-        for option, flag in [('rating', has_rating),
-                             ('comment', has_comment)]:
-            if isinstance(flag, (int, bool)):
-                if flag:
-                    result = result[~result[option].isna()].copy()
-                else:
-                    result = result[result[option].isna()].copy()
-
-        if isinstance(wishlistpriority, int):
-            result = result[result['wishlistpriority'] == wishlistpriority].copy()
-
-        if isinstance(yearpublished, int):
-            result = result[result['yearpublished'] == yearpublished].copy()
-        if isinstance(published_before, int):
-            result = result[result['yearpublished'] < published_before].copy()
-        if isinstance(published_after, int):
-            result = result[result['yearpublished'] > published_after] .copy()       
-
-        if isinstance(min_numplays, (int, float)):
-            result = result[result['numplays'] >= min_numplays].copy()
-        if isinstance(max_numplays, (int, float)):
-            result = result[result['numplays'] <= max_numplays].copy()
-            
-        return result.copy()
+        return self.collection[collection_mask(
+            self.collection, subtype=subtype, own=own, prevowned=prevowned,
+            fortrade=fortrade, want=want, wanttoplay=wanttoplay, wanttobuy=wanttobuy,
+            wishlist=wishlist, preordered=preordered, has_rating=has_rating,
+            has_comment=has_comment, wishlistpriority=wishlistpriority,
+            yearpublished=yearpublished, published_before=published_before,
+            published_after=published_after, min_numplays=min_numplays,
+            max_numplays=max_numplays, games=games)]
     
     def own(self):
         return self.filter(own=True)
@@ -260,36 +381,54 @@ class User():
     def expansion(self):
         return self.filter(subtype='boardgameexpansion')
     
+    def missing_expansions(self, index=None):
+        '''Return the ids of the expansions of games in the user's collection
+           that they own, which they don't own themselves.  Uses the saved
+           ExpansionIndex, unless one is given.
+        '''
+        index = index if index is not None else ExpansionIndex.load()
+        return index.missing_expansions(self.own().index)
+
+    def orphan_expansions(self, index=None):
+        '''Return the ids of the expansions that the user owns, without owning
+           any of their base games.
+        '''
+        index = index if index is not None else ExpansionIndex.load()
+        return index.orphan_expansions(self.own().index)
+
     def geekbuddies(self, cutoff=timedelta(days=7)):
-        '''Get the list of Geekbuddies of a user.  This 
-           assumes that the user has at most 1000 Geekbuddies 
-           (which is the current maximum number returned 
-           from the API call, without additional pagination, 
-           which I am not doing here).
+        '''Get the list of Geekbuddies of a user.  The API returns 
+           at most BUDDIES_PAGE_SIZE Geekbuddies per request, so 
+           the pages are requested in turn until a short page is 
+           returned.
         '''
 
-        #  Check to see if this has been retrieved recently, and, if so,
-        #  just load and return that data.  
-        files_to_check = glob.glob(f'{GEEKBUDDIES_DATA}/{self.bggUserName}-*.*')
-        if files_to_check and (cutoff is not None):
-            name = files_to_check[0]
-            file_time_stamp = datetime(int(name[-18:-14]), int(name[-14:-12]), 
-                                int(name[-12:-10]), int(name[-9:-7]), 
-                                int(name[-7:-5]))
-            now = datetime.now()
-            if (now - file_time_stamp) <= cutoff:
-                with open(name, 'rb') as f:
-                    buddies = dill.load(f)
-                return buddies
-
-        #  Otherwise, make the call to retrieve and store this information.
-        url = f'{BASE_API}/users?name={self.bggUserName}&buddies=1'
-        result = requests.get(url, headers=AUTHORIZATION_DICT)
-        error = BeautifulSoup(result.text, 'lxml').find('error')
-        if error:
-            return f'{error.text}'
-        
-        buddies = [(item.get('name'), item.get('id')) for item in BeautifulSoup(result.text, features='lxml').find_all('buddy')]
+        #  The raw responses are kept in the response cache, so if this has 
+        #  been retrieved recently (within the cutoff) no request is made.
+        ttl = cutoff if cutoff is not None else timedelta(0)
+        buddies = []
+        fresh = False
+        page = 1
+        while True:
+            result = get_client().get(f'{BASE_API}/users', 
+                                      {'name': self.bggUserName, 'buddies': 1, 'page': page}, ttl)
+            fresh = fresh or not result.from_cache
+            if result.status_code == 404:
+                return 'Page not found'
+            elif result.status_code != 200:
+                return f'Request failed with status {result.status_code}'
+            root = etree.fromstring(result.text.encode('utf-8'))
+            error = root.find('.//error')
+            if error is not None:
+                return ''.join(error.itertext())
+            
+            found = [(item.get('name'), item.get('id')) for item in root.iter('buddy')]
+            buddies.extend(found)
+            if len(found) < BUDDIES_PAGE_SIZE:
+                break
+            page += 1
+        if not fresh:
+            return buddies
 
         #  Let's save the list of geekbuddies once we have it 
         #  First remove any previous versions for this user
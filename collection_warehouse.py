@@ -0,0 +1,171 @@
+#  A single store for the collections of many users, so that questions about
+#  all of them (e.g. "which users own game X and rated it 8 or more?") can be
+#  answered with vectorized operations on one table, rather than by loading
+#  thousands of separate pickles.  On disk the table is kept as Parquet files,
+#  with each user's rows in one of WAREHOUSE_BUCKETS files (chosen by a hash
+#  of the username), so that refreshing one user only rewrites one file.
+
+import glob
+import os
+import re
+import zlib
+
+import pandas as pd
+import numpy as np
+
+import dill
+
+from classes import _packCollection, collection_mask, COLLECTION_COLUMNS, SAVED_COLLECTION
+from constants import USER_DATA, WAREHOUSE_DATA, WAREHOUSE_BUCKETS
+
+
+class CollectionWarehouse():
+    '''A class for the combined collections of many users, as one table
+       (with the game id as a column) sorted by (game id, username), so that
+       the rows for any set of games are found by binary search.
+
+       The rows are kept by bucket, as they are on disk, so that adding or
+       replacing a user's collection only touches the rows of their bucket.
+       The combined table is rebuilt from the buckets when it is next used,
+       so that many collections can be added (e.g. by a BuddyCrawler) for
+       the cost of one rebuild.
+
+       The query method takes the same criteria as User.filter (applied
+       with collection_mask) along with restrictions on the games, users
+       and ratings.
+    '''
+    def __init__(self, path=WAREHOUSE_DATA, buckets=WAREHOUSE_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        os.makedirs(self.path, exist_ok=True)
+        self._frames = dict()
+        for filename in sorted(glob.glob(f'{self.path}/bucket-*.parquet')):
+            bucket = int(re.search(r'bucket-(\d+)\.parquet$', filename).group(1))
+            self._frames[bucket] = pd.read_parquet(filename, memory_map=True)
+        self._table = None
+        self._game_ids = None
+
+    def __repr__(self):
+        return f'CollectionWarehouse: {self.path} ({len(self.users())} users, {len(self)} rows)'
+
+    def __len__(self):
+        return sum(len(frame) for frame in self._frames.values())
+
+    def _bucket(self, username):
+        return zlib.crc32(username.encode('utf-8')) % self.buckets
+
+    @property
+    def table(self):
+        '''The combined table of all of the collections, sorted by game id
+           and username.
+        '''
+        if self._table is None:
+            self._sort()
+        return self._table
+
+    def _sort(self):
+        frames = [frame for frame in self._frames.values() if len(frame)]
+        if frames:
+            table = pd.concat(frames, ignore_index=True)
+        else:
+            table = pd.DataFrame(columns=['id'] + COLLECTION_COLUMNS)
+        table['id'] = table['id'].astype(np.int64)
+        for column in ['subtype', 'username']:
+            table[column] = table[column].astype(str).astype('category')
+        self._table = table.sort_values(['id', 'username'], kind='stable', ignore_index=True)
+        self._game_ids = self._table['id'].to_numpy()
+
+    def users(self):
+        '''Return the (sorted) usernames in the warehouse.'''
+        return sorted(set().union(*(frame['username'].astype(str).unique()
+                                    for frame in self._frames.values())))
+
+    def upsert(self, collections):
+        '''Add (or replace) the collections of users.
+
+           collections:  A dictionary of {username: collection DataFrame}.
+        '''
+        new = dict()
+        for username, collection in collections.items():
+            collection = _packCollection(collection.copy())
+            collection['username'] = username
+            #  (The time of the last full sync isn't kept here.)
+            collection.attrs = dict()
+            new.setdefault(self._bucket(username), dict())[username] = collection.reset_index()
+        for bucket, added in new.items():
+            frames = list(added.values())
+            old = self._frames.get(bucket)
+            if old is not None:
+                frames.insert(0, old[~old['username'].astype(str).isin(list(added))])
+            frame = pd.concat(frames, ignore_index=True)
+            frame['username'] = frame['username'].astype(str)
+            self._frames[bucket] = frame
+            self._write(bucket)
+        if new:
+            self._table = None
+
+    def upsert_user(self, username, collection):
+        '''Add (or replace) the collection of a single user.'''
+        self.upsert({username: collection})
+
+    def add_user(self, user):
+        '''Add (or replace) the collection of a User (e.g. as the callback
+           of a BuddyCrawler, so that crawled collections are added as they
+           are gathered).
+        '''
+        self.upsert_user(user.bggUserName, user.collection)
+
+    def _write(self, bucket):
+        filename = f'{self.path}/bucket-{bucket:03d}.parquet'
+        self._frames[bucket].to_parquet(f'{filename}.tmp', index=False)
+        os.replace(f'{filename}.tmp', filename)
+
+    def ingest_files(self, pattern=f'{USER_DATA}/*-*.dill'):
+        '''Add the most recently saved collection of every user with a
+           saved collection (from get_collection) to the warehouse.
+        '''
+        latest = dict()
+        for name in sorted(glob.glob(pattern)):
+            match = SAVED_COLLECTION.search(name)
+            if match:
+                latest[match.group(1)] = name
+        collections = dict()
+        for username, name in latest.items():
+            with open(name, 'rb') as f:
+                collections[username] = dill.load(f)
+        self.upsert(collections)
+        return len(collections)
+
+    def _rows_for_games(self, games):
+        #  The positions of the rows for the games, found by binary search
+        games = np.unique(np.asarray(games, dtype=np.int64))
+        if self._table is None:
+            self._sort()
+        starts = np.searchsorted(self._game_ids, games, side='left')
+        ends = np.searchsorted(self._game_ids, games, side='right')
+        lengths = ends - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def query(self, games=None, users=None, min_rating=None, max_rating=None, **criteria):
+        '''Return the rows of the warehouse (sorted by game id and username)
+           for the given games and/or users, with a rating in the given range,
+           that match the criteria of User.filter (e.g. own=True).
+        '''
+        table = self.table
+        if games is not None:
+            table = table.iloc[self._rows_for_games(games)]
+        mask = collection_mask(table, **criteria)
+        if users is not None:
+            mask &= table['username'].isin(users).to_numpy()
+        rating = table['rating'].to_numpy()
+        if min_rating is not None:
+            mask &= rating >= min_rating
+        if max_rating is not None:
+            mask &= rating <= max_rating
+        return table[mask]
+
+    def collection(self, username):
+        '''Return the collection of one user, indexed by game id as in
+           get_collection.
+        '''
+        return self.query(users=[username]).set_index('id').sort_values('name')
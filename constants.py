@@ -1,19 +1,190 @@
-BASE_API = 'https://boardgamegeek.com/xmlapi2'
+import os
+
+from datetime import timedelta
+
+#  The API can be pointed elsewhere (e.g. at the stand-in server used by the
+#  benchmarks, see benchmarks/mock_bgg.py) with the BGG_BASE_API variable.
+BASE_API = os.environ.get('BGG_BASE_API', 'https://boardgamegeek.com/xmlapi2')
 
 USER_DATA = 'USERS'
 GEEKBUDDIES_DATA = 'GEEKBUDDIES'
 GAME_DATA = 'BGG_GAMES'
 EXTRA_DATA = 'EXTRA_DATA'
 
+#  The game information is kept in Parquet files, each covering a range
+#  of PARTITION_SIZE game ids.
+GAME_STORE = f'{GAME_DATA}/STORE'
+PARTITION_SIZE = 10000
+
+#  The ids that find_new_games.py found to be empty or not board games (see
+#  tombstones.py) and how often (in days) they are rechecked, along with the
+#  settings for probing for new games above the largest known id:  the size
+#  of the first window of ids, the largest window, and the number of windows
+#  in a row without any games before stopping.
+TOMBSTONE_FILE = f'{GAME_DATA}/tombstones.npz'
+TOMBSTONE_RECHECK_DAYS = 30
+TOMBSTONE_MAX_RECHECK_DAYS = 720
+FRONTIER_WINDOW = 100
+FRONTIER_MAX_WINDOW = 3200
+FRONTIER_PATIENCE = 3
+
+#  The link columns of the games, as ragged arrays of vocabulary codes
+#  (see taxonomy.py).
+TAXONOMY_DATA = f'{EXTRA_DATA}/TAXONOMY'
+
+#  The types of items (from BGG) kept in the game store.
+GAME_TYPES = ['boardgame', 'boardgameexpansion']
+
+#  The games refreshed by update_existing_games.py are chosen by their
+#  expected staleness (see update_scheduler.py), which uses these change
+#  rates (per day), within a budget of UPDATE_BUDGET requests per run.
+UPDATE_META = f'{GAME_DATA}/update_meta.parquet'
+UPDATE_BUDGET = 75
+INITIAL_CHANGE_RATE = 0.05
+MIN_CHANGE_RATE = 0.001
+CHANGE_RATE_SMOOTHING = 0.5
+
+#  The ingestion daemon (see daemon.py):  the port of its control endpoint
+#  (on localhost only), the number of requests to BGG that all of its tasks
+#  may make in each DAEMON_BUDGET_WINDOW, how often each task runs, how soon
+#  a task that failed is tried again, the number of users whose
+#  collections are synced at a time, and how long a user whose collection
+#  couldn't be synced (e.g. a deleted account) is left out of the syncs.
+DAEMON_PORT = 8001
+DAEMON_REQUEST_BUDGET = 1500
+DAEMON_BUDGET_WINDOW = timedelta(hours=1)
+DAEMON_INTERVALS = {'update_existing_games': timedelta(hours=1),
+                    'find_new_games': timedelta(days=1),
+                    'sync_collections': timedelta(hours=6)}
+DAEMON_RETRY_DELAY = timedelta(minutes=15)
+DAEMON_SYNC_USERS = 50
+DAEMON_SYNC_SKIP = timedelta(days=7)
+
+#  The history of the game statistics (see stats_history.py).
+STATS_HISTORY_DATA = f'{GAME_DATA}/HISTORY'
+
+#  The write-ahead logs of the runs of the cron jobs (see run_log.py), from
+#  which an interrupted run is resumed.
+RUN_LOG_DATA = f'{GAME_DATA}/RUNS'
+
 SLEEP_DELAY = 12 
 
+#  The status flags of the items in a collection, in the order of their bits
+#  in the "status" bitmask column.
+STATUS_FLAGS = ['own', 'prevowned', 'fortrade', 'want', 'wanttoplay',
+                'wanttobuy', 'wishlist', 'preordered']
+
+#  The combined collections of all users (see collection_warehouse.py), split
+#  into WAREHOUSE_BUCKETS files by a hash of the username.
+WAREHOUSE_DATA = f'{USER_DATA}/WAREHOUSE'
+WAREHOUSE_BUCKETS = 64
+
+#  The sparse user x game matrices (explicit ratings and implicit signals) used
+#  by the recommendation models, and the weights of each implicit signal:
+#  owning, wishlisting and rating a game, and log(1 + number of plays).
+RATING_MATRIX_DATA = f'{EXTRA_DATA}/RATINGS'
+IMPLICIT_WEIGHTS = {'own': 1.0, 'wishlist': 0.5, 'rated': 1.0, 'numplays': 0.5}
+
+#  The content-based similarity index (see similarity.py):  the number of
+#  neighbours kept for each game, the number of games handled at a time, the
+#  weights of each kind of feature, and the edges (in minutes) of the bins
+#  for the playing time.
+SIMILARITY_DATA = f'{EXTRA_DATA}/SIMILARITY'
+SIMILARITY_K = 50
+SIMILARITY_BLOCK = 256
+SIMILARITY_WEIGHTS = {'categories': 1.0, 'mechanics': 1.5, 'family': 0.5, 'designer': 0.75,
+                      'weight': 1.0, 'players': 0.5, 'playtime': 0.5}
+PLAYTIME_BINS = [15, 30, 45, 60, 90, 120, 180, 240]
+
+#  The implicit matrix factorization (see als.py):  the number of factors, the
+#  regularization, the scaling of the implicit signals into confidences, the
+#  number of epochs (and conjugate gradient steps per epoch), and the number
+#  of matrix entries handled at a time.
+ALS_DATA = f'{EXTRA_DATA}/ALS'
+ALS_FACTORS = 64
+ALS_REGULARIZATION = 0.05
+ALS_ALPHA = 10
+ALS_EPOCHS = 15
+ALS_CG_STEPS = 3
+ALS_BATCH_NNZ = 500000
+
+#  The recommendation server (see server.py):  the number of results cached
+#  (per worker) and the default and maximum numbers of results.
+SERVER_CACHE_SIZE = 10000
+SERVER_RESULTS = 20
+SERVER_MAX_RESULTS = 200
+
+#  The Geekbuddy graph (see social_graph.py), and the settings of the social
+#  scores:  the decay of the weight of a user's ratings with every hop away,
+#  and the number of "virtual" average ratings that each score starts with.
+SOCIAL_GRAPH_DATA = f'{EXTRA_DATA}/SOCIAL'
+SOCIAL_DECAY = 0.5
+SOCIAL_SHRINKAGE = 2.0
+
+#  The links between base games and their expansions (see expansion_index.py).
+EXPANSION_DATA = f'{GAME_DATA}/EXPANSIONS'
+
+#  The game descriptions are kept (compressed) apart from the game store, with
+#  a TF-IDF index over them for searching (see description_store.py), where
+#  the terms are hashed into TEXT_FEATURES columns.
+DESCRIPTION_FILE = f'{GAME_DATA}/descriptions.sqlite'
+TEXT_INDEX_DATA = f'{GAME_DATA}/TEXT_INDEX'
+TEXT_FEATURES = 2**20
+
+#  Collections are synced incrementally (asking only for the items modified
+#  since the last sync, less SYNC_OVERLAP), with a full download at least 
+#  every FULL_SYNC_INTERVAL.
+FULL_SYNC_INTERVAL = timedelta(days=30)
+SYNC_OVERLAP = timedelta(days=1)
+
+#  The number of Geekbuddies returned by BGG per page of results, and the
+#  state (frontier and visited users) of the Geekbuddy crawler.
+BUDDIES_PAGE_SIZE = 1000
+CRAWL_STATE = f'{EXTRA_DATA}/crawl_state.sqlite'
+
+#  Settings for the shared HTTP client (see http_client.py):  the rate limit
+#  (in requests per second, with bursts of up to REQUEST_BURST requests), the
+#  number of concurrent requests, and the retry/backoff settings (in seconds)
+#  used for the 202/429/5xx responses.
+REQUEST_RATE = 0.5
+REQUEST_BURST = 4
+MAX_WORKERS = 4
+MAX_RETRIES = 8
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+REQUEST_TIMEOUT = 60
+
+#  The pipeline used to fetch games (see pipeline.py):  the number of
+#  processes parsing the responses, the depth of the queues between the
+#  stages, and the (approximate) number of games committed at a time.
+PARSE_WORKERS = 2
+PIPELINE_QUEUE_DEPTH = 8
+PIPELINE_CHUNK_SIZE = 200
+
+#  The raw responses from BGG are cached (compressed) in a SQLite database
+#  (see response_cache.py), with a time-to-live for each API endpoint and 
+#  least-recently-used eviction once the cache is larger than CACHE_MAX_BYTES.
+CACHE_FILE = f'{EXTRA_DATA}/response_cache.sqlite'
+CACHE_MAX_BYTES = 2 * 1024**3
+CACHE_TTL = {'thing': timedelta(days=1),
+             'collection': timedelta(days=7),
+             'users': timedelta(days=7),
+             'default': timedelta(days=30)}
+
+#  The maximum number of ids that BGG will accept in a single "thing" request.
+MAX_THING_IDS = 20
+
 #  Set up the "Authorization dictionary" in order to pass credentials
 #  into BGG, as required.  
 #  See https://boardgamegeek.com/wiki/page/XML_API_Terms_of_Use#
 #  Import this dictionary as needed, in order to pass the authorization token
-#  in using the "requests" package.  
-with open('TOKENS/bgg-token.txt', 'r') as f:
-    AUTHORIZATION_TOKEN = f.readline().strip()
+#  in using the "requests" package.  The BGG_TOKEN variable, if set, is used
+#  instead of the token file.
+if 'BGG_TOKEN' in os.environ:
+    AUTHORIZATION_TOKEN = os.environ['BGG_TOKEN']
+else:
+    with open('TOKENS/bgg-token.txt', 'r') as f:
+        AUTHORIZATION_TOKEN = f.readline().strip()
 
 AUTHORIZATION_DICT = {'Authorization' :f'Bearer {AUTHORIZATION_TOKEN}'}
 
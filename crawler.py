@@ -0,0 +1,136 @@
+#  A crawler over the Geekbuddy graph, used to gather the collections (and so
+#  the ratings) of many BGG users.  Starting from some seed users, it does a
+#  breadth-first search over Geekbuddies, fetching the collection and the
+#  Geekbuddies of each user it visits.  The frontier and the set of visited
+#  users are kept in a SQLite database (and updated after every user), so an
+#  interrupted crawl can just be run again to pick up where it left off.
+
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+
+from classes import User
+from constants import CRAWL_STATE, MAX_WORKERS
+
+
+class BuddyCrawler():
+    '''A class for a resumable breadth-first crawl over Geekbuddies.
+
+       Each user is in the state database with the depth at which it was
+       found, and a status of "pending" (in the frontier), "done" or
+       "failed" (e.g. an invalid username).  Users are visited concurrently
+       (on up to max_workers threads), with all of the requests going through
+       the shared client and its rate limiter.
+
+       callback:  An optional function called as callback(user) for each
+       user visited, e.g. to add the collection to some other store.
+    '''
+    def __init__(self, path=CRAWL_STATE, max_depth=2, cutoff=timedelta(days=7),
+                 max_workers=MAX_WORKERS, callback=None):
+        self.path = path
+        self.max_depth = max_depth
+        self.cutoff = cutoff
+        self.max_workers = max_workers
+        self.callback = callback
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS users (
+                               name TEXT PRIMARY KEY, depth INTEGER, status TEXT,
+                               items INTEGER, buddies INTEGER, error TEXT, updated TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS users_status ON users (status, depth)')
+        self.db.commit()
+        self.counters = {'visited': 0, 'failed': 0, 'items': 0, 'new_users': 0}
+
+    def __repr__(self):
+        return f'BuddyCrawler: {self.path} {self.progress()}'
+
+    def seed(self, names, depth=0):
+        '''Add users to the frontier (ignoring any already known).'''
+        self.db.executemany('INSERT OR IGNORE INTO users (name, depth, status) VALUES (?, ?, ?)',
+                            [(name.strip(), depth, 'pending') for name in names])
+        self.db.commit()
+
+    def retry_failed(self):
+        '''Put the users whose visit failed back into the frontier.'''
+        self.db.execute("UPDATE users SET status = 'pending', error = NULL WHERE status = 'failed'")
+        self.db.commit()
+
+    def progress(self):
+        '''Return the number of users with each status, along with the
+           counters for this run of the crawler.
+        '''
+        result = dict(self.db.execute('SELECT status, COUNT(*) FROM users GROUP BY status'))
+        result.update(self.counters)
+        return result
+
+    def _visit(self, name):
+        #  Runs on a worker thread:  gather the collection and the Geekbuddies
+        #  of a user.  Returns (user, buddies), where user is None on failure.
+        try:
+            user = User(name, self.cutoff)
+        except ValueError as e:
+            return None, str(e)
+        buddies = user.geekbuddies(self.cutoff)
+        if isinstance(buddies, str):
+            return None, buddies
+        return user, buddies
+
+    def _record(self, name, depth, user, buddies):
+        now = datetime.now().isoformat(timespec='seconds')
+        if user is None:
+            self.db.execute("UPDATE users SET status = 'failed', error = ?, updated = ? WHERE name = ?",
+                            (buddies, now, name))
+            self.counters['failed'] += 1
+        else:
+            if depth < self.max_depth:
+                before = self.db.total_changes
+                self.db.executemany('INSERT OR IGNORE INTO users (name, depth, status) VALUES (?, ?, ?)',
+                                    [(b, depth + 1, 'pending') for b, _ in buddies if b])
+                self.counters['new_users'] += self.db.total_changes - before
+            self.db.execute("UPDATE users SET status = 'done', items = ?, buddies = ?, updated = ? WHERE name = ?",
+                            (len(user.collection), len(buddies), now, name))
+            self.counters['visited'] += 1
+            self.counters['items'] += len(user.collection)
+        self.db.commit()   #  Checkpoint after every user
+
+    def run(self, limit=None, report_every=100):
+        '''Visit users from the frontier (shallowest first) until it is
+           empty, or "limit" users have been visited.  Progress is printed
+           every "report_every" users.
+        '''
+        start = time.monotonic()
+        visited = 0
+        in_flight = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                #  Keep the workers busy with the next users in the frontier
+                wanted = 2 * self.max_workers - len(in_flight)
+                if limit is not None:
+                    wanted = min(wanted, limit - visited - len(in_flight))
+                if wanted > 0:
+                    rows = self.db.execute('''SELECT name, depth FROM users WHERE status = 'pending'
+                                              ORDER BY depth, rowid LIMIT ?''',
+                                           (wanted + len(in_flight),)).fetchall()
+                    running = {name for name, _ in in_flight.values()}
+                    for name, depth in rows:
+                        if name not in running and len(in_flight) < 2 * self.max_workers:
+                            in_flight[executor.submit(self._visit, name)] = (name, depth)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, depth = in_flight.pop(future)
+                    try:
+                        user, buddies = future.result()
+                    except Exception as e:   #  e.g. a network error, after retrying
+                        user, buddies = None, f'{type(e).__name__}: {e}'
+                    self._record(name, depth, user, buddies)
+                    if user is not None and self.callback is not None:
+                        self.callback(user)
+                    visited += 1
+                    if visited % report_every == 0:
+                        rate = visited / (time.monotonic() - start)
+                        print(f'{datetime.now()}  {self.progress()}  ({rate:.2f} users/s)')
+        return self.progress()
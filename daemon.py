@@ -0,0 +1,311 @@
+#  A long-running ingestion process, in place of the cron jobs that each
+#  started a fresh interpreter, reloaded everything and exited.  The daemon
+#  keeps the game store, the update scheduler's metadata, the tombstones, the
+#  statistics history, the indexes updated by the runs (see update_indexes)
+#  and the collection warehouse in memory (along with the shared HTTP client,
+#  its pooled connections and the response cache), and runs its tasks in turn:
+#
+#      update_existing_games   Refresh the games that are the most out of date
+#      find_new_games          Look for new games
+#      sync_collections        Sync the saved collections that are out of date
+#
+#  All of the tasks share one budget of DAEMON_REQUEST_BUDGET requests to BGG
+#  in any DAEMON_BUDGET_WINDOW (as well as the client's rate limiter), so
+#  they take turns with the headroom rather than competing for it.  A task
+#  that is due is only started when the budget has room for it, and is told
+#  how many requests are left, which it doesn't go beyond.
+#
+#  There is a control and status endpoint on localhost:
+#
+#      GET  /status                The tasks, the budget and the client
+#      POST /tasks/<name>/run      Run a task as soon as possible
+#      POST /pause, POST /resume   Stop (or restart) starting tasks
+#      POST /stop                  Stop, once the current task is finished
+#
+#  Run with:  uv run daemon.py
+#
+#  Stopping the process part way through a task is safe:  the games are
+#  committed in chunks, and an interrupted update run is resumed (see
+#  run_log.py).
+
+import glob
+import threading
+import time
+import traceback
+
+from collections import deque
+from datetime import datetime
+
+from flask import Flask, jsonify
+from werkzeug.serving import make_server
+
+from constants import (USER_DATA, UPDATE_BUDGET, DAEMON_PORT, DAEMON_REQUEST_BUDGET,
+                       DAEMON_BUDGET_WINDOW, DAEMON_INTERVALS, DAEMON_RETRY_DELAY,
+                       DAEMON_SYNC_USERS, DAEMON_SYNC_SKIP)
+from classes import get_collection, saved_time, SAVED_COLLECTION
+from collection_warehouse import CollectionWarehouse
+from find_new_games import find_new_games, FRONTIER_COST
+from game_store import load_store
+from http_client import get_client
+from pipeline import load_indexes
+from stats_history import StatsHistory
+from tombstones import TombstoneIndex
+from update_existing_games import update_existing_games
+from update_scheduler import UpdateScheduler
+
+
+def _staleUsers(cutoff, n, skip=()):
+    '''Return the (at most n) users with a saved collection last synced
+       longer ago than the cutoff, the least recently synced first, other
+       than the users in skip.
+    '''
+    synced = dict()
+    for name in glob.glob(f'{USER_DATA}/*-*.dill'):
+        match = SAVED_COLLECTION.search(name)
+        if match:
+            synced[match.group(1)] = saved_time(match.group(2))
+    now = datetime.now()
+    stale = sorted((when, user) for user, when in synced.items()
+                   if now - when > cutoff and user not in skip)
+    return [user for _, user in stale[:n]]
+
+
+class Task():
+    '''A class for a task run by the daemon every interval (a timedelta).
+
+       function:  Called as function(budget), with the number of requests
+                  left in the budget, which it must not make more than.
+       cost:      The number of requests that must be left in the budget
+                  for the task to be started.
+    '''
+    def __init__(self, name, function, interval, cost):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.cost = cost
+        self.next_run = datetime.now()
+        self.last_run = None
+        self.last_result = None
+        self.last_error = None
+        self.runs = 0
+        self.running = False
+
+    def __repr__(self):
+        return f'Task: {self.name} (next run {self.next_run})'
+
+    def status(self):
+        return {'name': self.name, 'interval': str(self.interval), 'cost': self.cost,
+                'next_run': self.next_run.isoformat(timespec='seconds'),
+                'last_run': self.last_run.isoformat(timespec='seconds') if self.last_run else None,
+                'last_result': self.last_result, 'last_error': self.last_error,
+                'runs': self.runs, 'running': self.running}
+
+
+class Daemon():
+    '''A class for the scheduler of the ingestion tasks, which are run one
+       at a time (on the thread calling run) whenever they are due and the
+       request budget has room for them.
+    '''
+    def __init__(self, budget=DAEMON_REQUEST_BUDGET, window=DAEMON_BUDGET_WINDOW,
+                 client=None):
+        self.budget = budget
+        self.window = window
+        self.client = client if client is not None else get_client()
+        self.tasks = dict()
+        self.paused = False
+        self.started = datetime.now()
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        #  Samples of (time, client.requests), from which the requests made
+        #  within the last window are found.
+        self._samples = deque([(time.monotonic(), self.client.requests)])
+
+    def __repr__(self):
+        return f'Daemon: {len(self.tasks)} tasks, {self.remaining()} of {self.budget} requests left'
+
+    def add(self, name, function, interval, cost=1):
+        self.tasks[name] = Task(name, function, interval, cost)
+
+    def used(self):
+        '''Return the number of requests made within the last window.'''
+        now = time.monotonic()
+        with self.lock:
+            self._samples.append((now, self.client.requests))
+            #  Keep the last sample from before the window, as the baseline
+            while len(self._samples) > 1 and self._samples[1][0] <= now - self.window.total_seconds():
+                self._samples.popleft()
+            return self._samples[-1][1] - self._samples[0][1]
+
+    def remaining(self):
+        return max(0, self.budget - self.used())
+
+    def _next(self):
+        #  The task that has been due the longest among those that fit into
+        #  the budget (or None).
+        now = datetime.now()
+        remaining = self.remaining()
+        due = [task for task in self.tasks.values()
+               if task.next_run <= now and task.cost <= remaining]
+        return min(due, key=lambda task: task.next_run) if due else None
+
+    def run_task(self, task):
+        '''Run a task, and schedule its next run.'''
+        with self.lock:
+            task.running = True
+        start = datetime.now()
+        try:
+            result = task.function(self.remaining())
+            error = None
+        except Exception:
+            result, error = None, traceback.format_exc()
+        with self.lock:
+            task.running = False
+            task.runs += 1
+            task.last_run = start
+            task.last_error = error
+            if error is None:
+                task.last_result = result
+                task.next_run = start + task.interval
+            else:
+                task.next_run = datetime.now() + DAEMON_RETRY_DELAY
+
+    def trigger(self, name):
+        '''Make a task due now.'''
+        with self.lock:
+            self.tasks[name].next_run = datetime.now()
+        self._wake.set()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run(self, poll=5):
+        '''Run the tasks as they fall due, until stopped.'''
+        while not self._stop.is_set():
+            task = None if self.paused else self._next()
+            if task is not None:
+                self.run_task(task)
+                continue
+            self._wake.wait(poll)
+            self._wake.clear()
+
+    def status(self):
+        with self.lock:
+            tasks = [task.status() for task in self.tasks.values()]
+        return {'started': self.started.isoformat(timespec='seconds'), 'paused': self.paused,
+                'stopping': self._stop.is_set(),
+                'budget': {'requests': self.budget, 'window': str(self.window),
+                           'used': self.used(), 'remaining': self.remaining()},
+                'client': {'requests': self.client.requests, 'rate': self.client.limiter.rate},
+                'tasks': tasks}
+
+
+def create_daemon():
+    '''Create the Daemon with the ingestion tasks, holding the store, the
+       update scheduler, the tombstones, the statistics history, the indexes
+       and the collection warehouse for all of them.
+    '''
+    store = load_store()
+    scheduler = UpdateScheduler()
+    tombstones = TombstoneIndex()
+    history = StatsHistory()
+    indexes = load_indexes()
+    warehouse = CollectionWarehouse()
+    daemon = Daemon()
+    #  The users whose collections couldn't be synced, and when they failed
+    failed_syncs = dict()
+
+    def update(budget):
+        return len(update_existing_games(store, scheduler, min(UPDATE_BUDGET, budget), history,
+                                         indexes))
+
+    def find(budget):
+        return len(find_new_games(store, tombstones, scheduler, history, budget, indexes))
+
+    def sync(budget):
+        #  Each sync is a request for the games and one for the expansions
+        #  (or more, while BGG is preparing the collection)
+        cutoff = DAEMON_INTERVALS['sync_collections']
+        now = datetime.now()
+        for user, when in list(failed_syncs.items()):
+            if now - when > DAEMON_SYNC_SKIP:
+                del failed_syncs[user]
+        users = _staleUsers(cutoff, min(DAEMON_SYNC_USERS, budget // 2), failed_syncs)
+        first_request = daemon.client.requests
+        synced = dict()
+        for user in users:
+            if daemon.client.requests - first_request + 2 > budget:
+                break
+            #  An error (e.g. for a user who no longer exists) is returned
+            #  as a message, and the user is left out for a while, so that
+            #  they don't keep their place at the front of the queue.
+            collection = get_collection(user, cutoff)
+            if isinstance(collection, str):
+                failed_syncs[user] = now
+            else:
+                synced[user] = collection
+        #  Keep the warehouse current (rewriting each bucket once)
+        warehouse.upsert(synced)
+        return len(synced)
+
+    daemon.add('update_existing_games', update, DAEMON_INTERVALS['update_existing_games'],
+               cost=UPDATE_BUDGET)
+    #  At least the windows probed above the largest known id
+    daemon.add('find_new_games', find, DAEMON_INTERVALS['find_new_games'],
+               cost=FRONTIER_COST)
+    daemon.add('sync_collections', sync, DAEMON_INTERVALS['sync_collections'], cost=2)
+    return daemon
+
+
+def create_control_app(daemon):
+    '''Create the Flask app for the control and status endpoint.'''
+    app = Flask(__name__)
+
+    @app.get('/status')
+    def status():
+        return jsonify(daemon.status())
+
+    @app.post('/tasks/<name>/run')
+    def run(name):
+        if name not in daemon.tasks:
+            return jsonify(error=f'No task {name}'), 404
+        daemon.trigger(name)
+        return jsonify(daemon.tasks[name].status())
+
+    @app.post('/pause')
+    def pause():
+        daemon.pause()
+        return jsonify(paused=True)
+
+    @app.post('/resume')
+    def resume():
+        daemon.resume()
+        return jsonify(paused=False)
+
+    @app.post('/stop')
+    def stop():
+        daemon.stop()
+        return jsonify(stopping=True)
+
+    return app
+
+
+if __name__ == '__main__':
+    daemon = create_daemon()
+    server = make_server('127.0.0.1', DAEMON_PORT, create_control_app(daemon), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Control endpoint on http://127.0.0.1:{DAEMON_PORT}/status')
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
@@ -0,0 +1,236 @@
+#  The game descriptions, kept apart from the rest of the game information:
+#  they are by far the largest column, and most uses of the games never read
+#  them.  The descriptions are stored zlib-compressed in a SQLite database,
+#  keyed by the game id, so that any of them can be read on its own.
+#
+#  TextIndex is a TF-IDF matrix over the descriptions, for keyword search and
+#  for the similarity of the descriptions of games.  The terms are hashed
+#  (with scikit-learn's HashingVectorizer), so that there is no vocabulary to
+#  refit:  updating a game just replaces its row of term counts, along with
+#  the document frequencies, and the IDF weighting is applied from those.
+
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from constants import DESCRIPTION_FILE, TEXT_INDEX_DATA, TEXT_FEATURES
+
+
+class DescriptionStore():
+    '''A class for the store of game descriptions, stored zlib-compressed
+       in a SQLite database.  Safe to share between threads.
+    '''
+    def __init__(self, path=DESCRIPTION_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS descriptions (
+                               id INTEGER PRIMARY KEY, updated REAL, body BLOB)''')
+        self.db.commit()
+
+    def __repr__(self):
+        return f'DescriptionStore: {self.path} ({len(self)} games)'
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM descriptions').fetchone()[0]
+
+    def __contains__(self, bggGameId):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM descriptions WHERE id = ?',
+                                   (int(bggGameId),)).fetchone() is not None
+
+    def get(self, bggGameId):
+        '''Return the description of a game (or None).'''
+        with self.lock:
+            row = self.db.execute('SELECT body FROM descriptions WHERE id = ?',
+                                  (int(bggGameId),)).fetchone()
+        return None if row is None else zlib.decompress(row[0]).decode('utf-8')
+
+    def get_many(self, ids=None):
+        '''Return a Series of the descriptions of the games (all of them, if
+           ids is None), indexed by game id.  Games without a description
+           are left out.
+        '''
+        with self.lock:
+            if ids is None:
+                rows = self.db.execute('SELECT id, body FROM descriptions ORDER BY id').fetchall()
+            else:
+                rows = []
+                ids = [int(i) for i in ids]
+                #  In chunks, to stay within SQLite's limit on parameters
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start+500]
+                    rows.extend(self.db.execute(
+                        f'SELECT id, body FROM descriptions WHERE id IN ({",".join("?" * len(chunk))})',
+                        chunk).fetchall())
+                rows.sort()
+        return pd.Series([zlib.decompress(body).decode('utf-8') for _, body in rows],
+                         index=pd.Index([i for i, _ in rows], name='id', dtype=np.int64),
+                         name='description', dtype=object)
+
+    def ids(self):
+        '''Return the (sorted) ids of the games with a description.'''
+        with self.lock:
+            rows = self.db.execute('SELECT id FROM descriptions ORDER BY id').fetchall()
+        return np.array([r[0] for r in rows], dtype=np.int64)
+
+    def put(self, descriptions):
+        '''Store (or replace) the descriptions in a Series indexed by game id.
+           Missing (NaN) descriptions are skipped.
+        '''
+        descriptions = descriptions.dropna()
+        now = time.time()
+        rows = [(int(i), now, zlib.compress(str(d).encode('utf-8')))
+                for i, d in descriptions.items()]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)', rows)
+            self.db.commit()
+
+
+def _vectorizer():
+    return HashingVectorizer(n_features=TEXT_FEATURES, alternate_sign=False, norm=None,
+                             stop_words='english', strip_accents='unicode')
+
+
+class TextIndex():
+    '''A class for the TF-IDF index of the descriptions:  a CSR matrix of
+       the (sublinear) term counts of each game in self.ids, and the number
+       of games with each (hashed) term.
+    '''
+    def __init__(self, ids, counts, df):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.counts = counts
+        self.df = np.asarray(df, dtype=np.int64)
+        self._rows = pd.Index(self.ids)
+        self._weighted = None
+
+    def __repr__(self):
+        return f'TextIndex: {len(self.ids)} games, {self.counts.nnz} terms'
+
+    @staticmethod
+    def _count(descriptions):
+        counts = _vectorizer().transform(descriptions.fillna('').astype(str)).tocsr()
+        counts.data = (1 + np.log(counts.data)).astype(np.float32)
+        return counts
+
+    @classmethod
+    def from_descriptions(cls, descriptions):
+        '''Build the index from a Series of descriptions (indexed by game id),
+           e.g. DescriptionStore().get_many().
+        '''
+        counts = cls._count(descriptions)
+        return cls(descriptions.index, counts, np.bincount(counts.indices, minlength=TEXT_FEATURES))
+
+    def idf(self):
+        return (np.log((1 + len(self.ids)) / (1 + self.df)) + 1).astype(np.float32)
+
+    def weighted(self):
+        '''Return the (row normalized) TF-IDF matrix.'''
+        if self._weighted is None:
+            weighted = self.counts @ sp.diags(self.idf())
+            norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+            norms[norms == 0] = 1
+            self._weighted = (sp.diags(1 / norms) @ weighted).tocsr().astype(np.float32)
+        return self._weighted
+
+    def update(self, descriptions):
+        '''Replace (or add) the rows for the games in a Series of descriptions.'''
+        descriptions = descriptions[~descriptions.index.duplicated(keep='last')]
+        rows = self._rows.get_indexer(descriptions.index)
+        old = self.counts[rows[rows >= 0]]
+        self.df -= np.bincount(old.indices, minlength=TEXT_FEATURES)
+
+        new_ids = descriptions.index.to_numpy(dtype=np.int64)[rows < 0]
+        self.ids = np.concatenate([self.ids, new_ids])
+        self._rows = pd.Index(self.ids)
+        rows = self._rows.get_indexer(descriptions.index)
+
+        size = len(self.ids)
+        counts = sp.csr_matrix((self.counts.data, self.counts.indices, self.counts.indptr),
+                               shape=self.counts.shape)
+        counts.resize((size, TEXT_FEATURES))
+        keep = np.ones(size, dtype=np.float32)
+        keep[rows] = 0
+        new = self._count(descriptions)
+        self.df += np.bincount(new.indices, minlength=TEXT_FEATURES)
+        placed = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, np.arange(len(rows)))),
+                               shape=(size, len(rows)))
+        self.counts = (sp.diags(keep) @ counts + placed @ new).tocsr().astype(np.float32)
+        self._weighted = None
+
+    def _query(self, text):
+        query = self._count(pd.Series([text])).multiply(self.idf()).tocsr()
+        norm = np.sqrt(query.multiply(query).sum())
+        return query / norm if norm > 0 else query
+
+    def search(self, text, n=10):
+        '''Return a Series of the n games whose descriptions best match the
+           keywords of the text, with their scores, indexed by game id.
+        '''
+        scores = (self.weighted() @ self._query(text).T).toarray().ravel()
+        return self._top(scores, n)
+
+    def similar(self, bggGameId, n=10):
+        '''Return a Series of the n games with the descriptions most similar
+           to that of a game.
+        '''
+        row = self._rows.get_loc(bggGameId)
+        weighted = self.weighted()
+        scores = (weighted @ weighted[row].T).toarray().ravel()
+        scores[row] = 0
+        return self._top(scores, n)
+
+    def _top(self, scores, n):
+        n = min(n, int((scores > 0).sum()))
+        if n == 0:
+            return pd.Series([], index=pd.Index([], name='id', dtype=np.int64), name='score',
+                             dtype=np.float32)
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return pd.Series(scores[top], index=pd.Index(self.ids[top], name='id'), name='score')
+
+    def save(self, path=TEXT_INDEX_DATA):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/ids.npy', self.ids)
+        np.save(f'{path}/df.npy', self.df)
+        for component in ['data', 'indices', 'indptr']:
+            np.save(f'{path}/counts-{component}.npy', getattr(self.counts, component))
+
+    @classmethod
+    def load(cls, path=TEXT_INDEX_DATA, mmap_mode='r'):
+        '''Load a saved index, with the arrays memory-mapped by default (use
+           mmap_mode=None for an index that is going to be updated).
+        '''
+        ids = np.load(f'{path}/ids.npy', mmap_mode=mmap_mode)
+        data, indices, indptr = [np.load(f'{path}/counts-{component}.npy', mmap_mode=mmap_mode)
+                                 for component in ['data', 'indices', 'indptr']]
+        counts = sp.csr_matrix((data, indices, indptr), shape=(len(ids), TEXT_FEATURES), copy=False)
+        return cls(ids, counts, np.load(f'{path}/df.npy'))
+
+
+def update_text_index(games, path=TEXT_INDEX_DATA, index=None):
+    '''Update the saved text index (if there is one) for the descriptions of
+       new or changed games, and return it (or None).  An index kept in
+       memory (loaded with mmap_mode=None) can be given, rather than loading
+       it.
+    '''
+    if index is None:
+        if not os.path.exists(f'{path}/ids.npy'):
+            return None
+        index = TextIndex.load(path, mmap_mode=None)
+    if 'description' in games:
+        index.update(games['description'])
+        index.save(path)
+    return index
@@ -0,0 +1,184 @@
+#  An index between base games and their expansions, in both directions.  The
+#  links come from both ends:  a base game lists its expansions (the
+#  "expansions" column of the games DataFrame) and an expansion lists its base
+#  games (the "basegames" column), and either is enough for a link.  The links
+#  asserted by each game are kept, so that updating a game replaces just its
+#  own links, and the two CSR structures (base -> expansions, and expansion ->
+#  bases) are rebuilt from the links.  Queries like "expansions of the games I
+#  own that I don't own" are then slices of those arrays for one user, or a
+#  sparse matrix product for many users at once.
+
+import os
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from constants import EXPANSION_DATA
+
+
+def _links(games, column):
+    '''Return the (game, linked game) pairs of a list column of a games
+       DataFrame, as an n x 2 int64 array.
+    '''
+    if column not in games:
+        return np.zeros((0, 2), dtype=np.int64)
+    lists = [x if isinstance(x, (list, np.ndarray)) else [] for x in games[column]]
+    lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+    linked = np.fromiter((v for x in lists for v in x), dtype=np.int64, count=int(lengths.sum()))
+    return np.column_stack([np.repeat(games.index.to_numpy(dtype=np.int64), lengths), linked])
+
+
+class ExpansionIndex():
+    '''A class for the links between base games and expansions.
+
+       from_base:       The (base, expansion) links asserted by base games.
+       from_expansion:  The (expansion, base) links asserted by expansions.
+
+       The union of the links is held as CSR matrices over self.ids (all of
+       the game ids involved):  row i of self.matrix holds the expansions of
+       game self.ids[i], and row i of self.transposed its base games.
+    '''
+    def __init__(self, from_base=None, from_expansion=None):
+        self.from_base = from_base if from_base is not None else np.zeros((0, 2), dtype=np.int64)
+        self.from_expansion = (from_expansion if from_expansion is not None
+                               else np.zeros((0, 2), dtype=np.int64))
+        self._build()
+
+    def __repr__(self):
+        return f'ExpansionIndex: {self.matrix.nnz} links between {len(self.ids)} games'
+
+    def _build(self):
+        pairs = np.concatenate([self.from_base, self.from_expansion[:, ::-1]])
+        self.ids = np.unique(pairs)
+        rows = np.searchsorted(self.ids, pairs)
+        n = len(self.ids)
+        #  matrix[base, expansion] = 1 (with repeated links merged)
+        self.matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows[:, 0], rows[:, 1])),
+                                    shape=(n, n))
+        self.matrix.sum_duplicates()
+        self.matrix.data[:] = 1
+        self.transposed = self.matrix.T.tocsr()
+        self._index = pd.Index(self.ids)
+
+    @classmethod
+    def from_games(cls, games):
+        '''Build the index from a games DataFrame (indexed by the game id).'''
+        return cls(_links(games, 'expansions'), _links(games, 'basegames'))
+
+    def update(self, games):
+        '''Replace the links asserted by the games in the DataFrame (e.g. the
+           games that were just updated) with their current links.
+        '''
+        ids = games.index.to_numpy(dtype=np.int64)
+        self.from_base = np.concatenate([self.from_base[~np.isin(self.from_base[:, 0], ids)],
+                                         _links(games, 'expansions')])
+        self.from_expansion = np.concatenate([self.from_expansion[~np.isin(self.from_expansion[:, 0], ids)],
+                                              _links(games, 'basegames')])
+        self._build()
+
+    def _linked(self, matrix, games):
+        rows = self._index.get_indexer(np.asarray(list(games), dtype=np.int64))
+        rows = rows[rows >= 0]
+        starts, ends = matrix.indptr[rows], matrix.indptr[rows + 1]
+        lengths = ends - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.unique(self.ids[matrix.indices[positions]])
+
+    def expansions_of(self, games):
+        '''Return the (sorted) ids of all of the expansions of the games.'''
+        return self._linked(self.matrix, games)
+
+    def bases_of(self, games):
+        '''Return the (sorted) ids of all of the base games of the games.'''
+        return self._linked(self.transposed, games)
+
+    def missing_expansions(self, owned):
+        '''Return the ids of the expansions of the owned games that aren't
+           owned themselves.
+        '''
+        owned = np.asarray(list(owned), dtype=np.int64)
+        return np.setdiff1d(self.expansions_of(owned), owned)
+
+    def orphan_expansions(self, owned):
+        '''Return the ids of the owned expansions for which none of their
+           base games are owned.
+        '''
+        owned = np.asarray(list(owned), dtype=np.int64)
+        rows = self._index.get_indexer(owned)
+        expansions = rows[rows >= 0]
+        expansions = expansions[np.diff(self.transposed.indptr)[expansions] > 0]
+        mask = np.zeros(len(self.ids), dtype=np.float32)
+        mask[rows[rows >= 0]] = 1
+        owned_bases = self.transposed[expansions] @ mask
+        return np.sort(self.ids[expansions[owned_bases == 0]])
+
+    def _ownership(self, owned):
+        #  The sparse users x games (in self.ids) ownership matrix for a long
+        #  format table of (username, id), along with the usernames.
+        users, user_rows = np.unique(owned['username'].astype(str).to_numpy(), return_inverse=True)
+        columns = self._index.get_indexer(owned['id'].to_numpy(dtype=np.int64))
+        known = columns >= 0
+        O = sp.csr_matrix((np.ones(known.sum(), dtype=np.float32), (user_rows[known], columns[known])),
+                          shape=(len(users), len(self.ids)))
+        O.sum_duplicates()
+        O.data[:] = 1
+        return users, O
+
+    def _frame(self, users, matrix):
+        matrix = matrix.tocoo()
+        order = np.lexsort([matrix.col, matrix.row])
+        return pd.DataFrame({'username': users[matrix.row[order]],
+                             'id': self.ids[matrix.col[order]]})
+
+    def missing_for_users(self, owned):
+        '''missing_expansions for many users at once.
+
+           owned:  A long format table with the username and (game) id of
+                   each owned game, e.g. CollectionWarehouse.query(own=True).
+
+           Returns a DataFrame with the username and id of each missing
+           expansion, as (O @ E) with the owned games masked out, where O is
+           the ownership matrix and E the base -> expansion matrix.
+        '''
+        users, O = self._ownership(owned)
+        missing = (O @ self.matrix).tocsr()
+        missing.data[:] = 1
+        missing = missing - missing.multiply(O)
+        missing.eliminate_zeros()
+        return self._frame(users, missing)
+
+    def orphans_for_users(self, owned):
+        '''orphan_expansions for many users at once (see missing_for_users).'''
+        users, O = self._ownership(owned)
+        has_bases = (np.diff(self.transposed.indptr) > 0).astype(np.float32)
+        owned_expansions = O @ sp.diags(has_bases)
+        #  covered[u, e] > 0 if user u owns one of the base games of e
+        covered = (O @ self.matrix).tocsr()
+        covered.data[:] = 1
+        orphans = (owned_expansions - owned_expansions.multiply(covered)).tocsr()
+        orphans.eliminate_zeros()
+        return self._frame(users, orphans)
+
+    def save(self, path=EXPANSION_DATA):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/from_base.npy', self.from_base)
+        np.save(f'{path}/from_expansion.npy', self.from_expansion)
+
+    @classmethod
+    def load(cls, path=EXPANSION_DATA):
+        return cls(np.load(f'{path}/from_base.npy'), np.load(f'{path}/from_expansion.npy'))
+
+
+def update_expansions(games, path=EXPANSION_DATA, index=None):
+    '''Update the saved expansion index (if there is one) for new or changed
+       games, and return it (or None).  An index kept in memory can be
+       given, rather than loading it.
+    '''
+    if index is None:
+        if not os.path.exists(f'{path}/from_base.npy'):
+            return None
+        index = ExpansionIndex.load(path)
+    index.update(games)
+    index.save(path)
+    return index
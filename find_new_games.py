@@ -1,63 +1,149 @@
-'''Designed to search for new games that aren't already in the database, update
-the file that contains all games, and update the "guard" value that is used
-to search in the future.  Will also copy the new "all games" file to the 
-BACKUP directory, and delete all files in the BGG_GAMES directory except for
-the latest file.  
-'''
-import dill
-import glob
-import re
-import time
-import shutil
-import os
+'''Designed to search for new games that aren't already in the database, and
+update the game store with any that are found.  Only the partitions of the
+store that receive new games are rewritten, and the previous version of each
+of those partitions is copied to the BACKUP directory.  The games are fetched,
+parsed and written in chunks as they arrive (see pipeline.py).
+
+Ids that come back empty, or as something other than a board game or an
+expansion, are tombstoned (see tombstones.py) and only rechecked occasionally.
+The ids whose requests failed (e.g. during an outage) are not, since nothing
+was learned about them.
+Above the largest known id, we probe in windows of ids that widen while games
+are being found, and stop after a few windows in a row without any.
 
+A run can be given a budget of requests (as the daemon does), in which case
+the ids below the largest known id are only checked as far as the budget
+allows (keeping enough for probing above it), and the rest are left for the
+next run.
+'''
 import pandas as pd
+import numpy as np
 
 from datetime import datetime
 
-from constants import GAME_DATA
-from api_functions import getGame
+from constants import (GAME_DATA, GAME_TYPES, MAX_THING_IDS, FRONTIER_WINDOW,
+                       FRONTIER_MAX_WINDOW, FRONTIER_PATIENCE)
+from game_store import load_store
+from http_client import get_client
+from pipeline import run_pipeline, update_indexes
+from stats_history import StatsHistory
+from tombstones import TombstoneIndex
+from update_scheduler import UpdateScheduler
 
-if __name__ == '__main__':
-    game_file = sorted(glob.glob(f'{GAME_DATA}/all-to-*.dill'), key=lambda x: int(re.search(r'[\d]+',x).group(0)))[-1]
 
-    with open(game_file, 'rb') as f:
-        all_games = dill.load(f)
+#  The requests needed to probe the fewest windows above the largest known id
+FRONTIER_COST = FRONTIER_PATIENCE * FRONTIER_WINDOW // MAX_THING_IDS
+
+
+def _search(ids, store, scheduler, history, backed_up, max_requests=None, vocabularies=None):
+    '''Look up the ids on BGG, and write the board games and expansions among
+       them into the store as they arrive (see pipeline.py), recording them
+       with the update scheduler and the statistics history so that their
+       statistics are tracked from now on.  Each partition is backed up
+       before its first write in the run (backed_up holds the keys of those
+       already backed up).  At most max_requests requests are made, if given,
+       and the link terms of the games are added to the vocabularies, if given
+       (see run_pipeline).
+
+       Returns:  The ids of the games found, and those whose requests failed.
+    '''
+    found = []
+
+    def commit(games, attempted):
+        if len(games):
+            games = games[games['subtype'].isin(GAME_TYPES)]
+        if len(games):
+            now = datetime.now()
+            history.append(games, now)
+            store.upsert(games, backup_dir=f'{GAME_DATA}/BACKUPS', backed_up=backed_up)
+            scheduler.record(games, now=now)
+            scheduler.save()
+            found.extend(games.index)
+
+    failed = run_pipeline(ids, commit, max_requests=max_requests, vocabularies=vocabularies)
+    return pd.Index(found, dtype=np.int64), pd.Index(failed, dtype=np.int64)
 
-    with open('find_new_games_guard.txt', 'r') as f:
-        limit = int(f.readline())
 
-    rest = pd.Index(range(1, limit)).difference(all_games.index).tolist()
-    step_size = 50
+def find_new_games(store=None, tombstones=None, scheduler=None, history=None, budget=None,
+                   indexes=None):
+    '''Look for new games, below the largest known id and above it, write
+       them into the store and update the indexes.  The store, tombstones,
+       scheduler and statistics history are opened if they aren't given (the
+       daemon keeps them, see daemon.py), as are the indexes (see
+       update_indexes).  If a budget is given, at most (about) that many
+       requests are made.
+
+       Returns:  The ids of the games found.
+    '''
+    store = store if store is not None else load_store()
+    tombstones = tombstones if tombstones is not None else TombstoneIndex()
+    scheduler = scheduler if scheduler is not None else UpdateScheduler()
+    history = history if history is not None else StatsHistory()
+    known_max = store.max_id()
     new_found = []
+    backed_up = set()
+    links = dict()
+    client = get_client()
+    first_request = client.requests
+
+    def remaining():
+        return None if budget is None else max(0, budget - (client.requests - first_request))
+
     start = datetime.now()
     print('----------------------')
     print(f'Start time: {start}')
 
-    for index in range(0, len(rest) + 1, step_size):
-        games = getGame(rest[index:index+step_size])
-        if games is not None:
-            new_found.append(games)
-        time.sleep(4)
+    #  First, any ids below the largest known id that aren't in the store,
+    #  skipping the tombstoned ids that aren't yet due to be rechecked.
+    rest = pd.Index(range(1, known_max + 1)).difference(store.ids())
+    rest = rest[tombstones.due(rest)].tolist()
+    gap_budget = None if budget is None else max(0, budget - FRONTIER_COST)
+    if gap_budget is not None:
+        rest = rest[:gap_budget * MAX_THING_IDS]
+    print(f'Checking {len(rest)} ids up to {known_max}.')
+    found_ids, failed = _search(rest, store, scheduler, history, backed_up, gap_budget, links)
+    new_found.extend(found_ids)
+    tombstones.bury(pd.Index(rest).difference(found_ids).difference(failed))
+    tombstones.revive(found_ids)
+
+    #  Then probe above the largest known id, widening the window while we
+    #  find games (and going back to the smallest window when we don't),
+    #  until there are FRONTIER_PATIENCE windows in a row without any.
+    first, window, misses = known_max + 1, FRONTIER_WINDOW, 0
+    frontier_max = known_max
+    frontier_found, frontier_failed = [], []
+    while misses < FRONTIER_PATIENCE and remaining() != 0:
+        ids = list(range(first, first + window))
+        found_ids, failed = _search(ids, store, scheduler, history, backed_up, remaining(), links)
+        frontier_failed.extend(failed)
+        first += len(ids)
+        if len(found_ids):
+            frontier_found.extend(found_ids)
+            frontier_max = max(frontier_max, found_ids.max())
+            window, misses = min(2 * window, FRONTIER_MAX_WINDOW), 0
+        else:
+            window, misses = FRONTIER_WINDOW, misses + 1
+    new_found.extend(frontier_found)
+    #  The ids past the last game found don't exist (yet), so only those
+    #  before it are tombstoned.
+    tombstones.bury(pd.Index(range(known_max + 1, frontier_max)).difference(frontier_found)
+                    .difference(frontier_failed))
+    print(f'Probed up to {first - 1}.')
 
     end = datetime.now()
     print(f'End time: {end}')
 
     if new_found:
-        new_found = pd.concat(new_found)
         print(f'Found {len(new_found)} games in {end - start}')
+        #  The games were written to the store as they were found, so only
+        #  the indexes are left to update.
+        update_indexes(store, new_found, links, indexes)
+    else:
+        print('Found no new games.')
 
-        new_all = pd.concat([all_games, new_found]).sort_index()
-        new_max = new_all.index.max()
+    tombstones.save()
+    return pd.Index(new_found, dtype=np.int64)
 
-        with open(f'{GAME_DATA}/all-to-{new_max}.dill', 'wb') as f:
-            dill.dump(new_all, f)
-        with open('find_new_games_guard.txt', 'w') as f:
-            f.write(str(new_max + 10000))
 
-        all_files = sorted(glob.glob(f'{GAME_DATA}/all-to-*.dill'), key=lambda x: int(re.search(r'[\d]+',x).group(0)))
-        shutil.copy(all_files[-1], f'{GAME_DATA}/BACKUPS/')
-        for g in all_files[:-1]:
-            os.remove(g)
-    else:
-        print('Found no new games.')
+if __name__ == '__main__':
+    find_new_games()
@@ -0,0 +1,162 @@
+#  A store for the game information retrieved from BGG, kept as a set of
+#  Parquet files that are partitioned by ranges of the game id.  This
+#  replaces loading, concatenating and dumping the single (and ever growing)
+#  "all-to-N.dill" file on every run of the cron jobs.  The descriptions can
+#  be kept apart, in a DescriptionStore, as they are by far the largest column.
+
+import pandas as pd
+import dill
+import glob
+import os
+import re
+import shutil
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from constants import GAME_DATA, GAME_STORE, PARTITION_SIZE
+from description_store import DescriptionStore
+
+
+class GameStore():
+    '''A class to read and write the games DataFrame (indexed by the BGG id)
+       as Parquet files, each holding the games with ids in the range
+       [key, key + partition_size).
+
+       Reads are memory-mapped and can be restricted to a subset of the
+       columns and/or partitions, so that (for instance) getting the list of
+       known ids only reads the "id" column.  Writes only touch the
+       partitions containing the games being written, and each partition
+       is replaced atomically (write to a temporary file, then rename).
+
+       descriptions:  A DescriptionStore, where the "description" column of
+       the games being written is put, rather than in the partitions (and
+       the descriptions of the partitions that are rewritten are moved).
+    '''
+    def __init__(self, path=GAME_STORE, partition_size=PARTITION_SIZE, descriptions=None):
+        self.path = path
+        self.partition_size = partition_size
+        self.descriptions = descriptions
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self):
+        return f'GameStore: {self.path} ({len(self.partitions())} partitions)'
+
+    def _partition_file(self, key):
+        return f'{self.path}/part-{key:08d}.parquet'
+
+    def _key(self, bggGameId):
+        return (int(bggGameId) // self.partition_size) * self.partition_size
+
+    def partitions(self):
+        '''Return the (sorted) keys of the partitions in the store.'''
+        return sorted(int(re.search(r'part-(\d+)\.parquet$', f).group(1))
+                      for f in glob.glob(f'{self.path}/part-*.parquet'))
+
+    def _read(self, key, columns=None):
+        if columns is not None:
+            #  Partitions written before a column was added (or moved out)
+            #  just don't have it.
+            present = set(pq.read_schema(self._partition_file(key)).names)
+            columns = ['id'] + [c for c in columns if c != 'id' and c in present]
+        table = pq.read_table(self._partition_file(key), columns=columns,
+                              memory_map=True)
+        return table.to_pandas().set_index('id')
+
+    def load(self, columns=None, ids=None):
+        '''Load the games in the store as a DataFrame indexed by the game id.
+
+           columns:  Restrict the columns read (the id is always included).
+           ids:      Only read the partitions containing these ids, and only
+                     return the rows for these ids.
+        '''
+        keys = self.partitions()
+        if ids is not None:
+            ids = pd.Index(ids)
+            keys = sorted(set(keys).intersection(self._key(g) for g in ids))
+        frames = [self._read(key, columns) for key in keys]
+        if not frames:
+            return None
+        result = pd.concat(frames)
+        if ids is not None:
+            result = result.loc[result.index.intersection(ids)]
+        return result.sort_index()
+
+    def ids(self):
+        '''Return a (sorted) Index of all of the game ids in the store.'''
+        frames = [self._read(key, columns=[]).index for key in self.partitions()]
+        if not frames:
+            return pd.Index([], dtype='int64', name='id')
+        return frames[0].append(frames[1:]).sort_values()
+
+    def max_id(self):
+        '''Return the largest game id in the store (or 0 if it is empty).'''
+        keys = self.partitions()
+        if not keys:
+            return 0
+        return int(self._read(keys[-1], columns=[]).index.max())
+
+    def upsert(self, games, backup_dir=None, backed_up=None):
+        '''Write the games in the DataFrame (indexed by the game id) into
+           the store, replacing any rows already there with the same id.
+           Only the partitions containing these games are rewritten.  If
+           backup_dir is given, the previous version of each rewritten
+           partition is copied there first.
+
+           backed_up:  A set of the keys of the partitions already backed up
+                       (by earlier upserts in the same run), which aren't
+                       copied again, so that the backup stays the version
+                       from before the run.  The keys backed up are added.
+
+           Returns:  The list of partition keys that were written.
+        '''
+        keys = games.index.map(self._key)
+        backed_up = backed_up if backed_up is not None else set()
+        written = []
+        for key, part in games.groupby(keys):
+            filename = self._partition_file(key)
+            if os.path.exists(filename):
+                if backup_dir is not None and key not in backed_up:
+                    os.makedirs(backup_dir, exist_ok=True)
+                    shutil.copy(filename, backup_dir)
+                    backed_up.add(key)
+                existing = self._read(key)
+                part = pd.concat([existing.drop(index=part.index, errors='ignore'),
+                                  part])
+            self._write(key, self._moveDescriptions(part).sort_index())
+            written.append(key)
+        return written
+
+    def _moveDescriptions(self, games):
+        if self.descriptions is None or 'description' not in games:
+            return games
+        self.descriptions.put(games['description'])
+        return games.drop(columns='description')
+
+    def move_descriptions(self):
+        '''Move the descriptions out of every partition that still has them
+           (into the DescriptionStore).
+        '''
+        for key in self.partitions():
+            if 'description' in pq.read_schema(self._partition_file(key)).names:
+                self._write(key, self._moveDescriptions(self._read(key)))
+
+    def _write(self, key, games):
+        filename = self._partition_file(key)
+        table = pa.Table.from_pandas(games.reset_index(), preserve_index=False)
+        pq.write_table(table, f'{filename}.tmp', compression='zstd')
+        os.replace(f'{filename}.tmp', filename)
+
+
+def load_store(path=GAME_STORE):
+    '''Open the game store, and if it is empty then populate it from the
+       most recent of the (older style) "all-to-N.dill" files, if any.
+    '''
+    store = GameStore(path, descriptions=DescriptionStore())
+    if not store.partitions():
+        game_files = sorted(glob.glob(f'{GAME_DATA}/all-to-*.dill'),
+                            key=lambda x: int(re.search(r'all-to-(\d+)', x).group(1)))
+        if game_files:
+            with open(game_files[-1], 'rb') as f:
+                store.upsert(dill.load(f))
+    return store
@@ -0,0 +1,16 @@
+#  gunicorn settings for the recommendation server (see server.py), e.g.
+#      gunicorn -c gunicorn.conf.py "server:create_app()"
+#
+#  The app is loaded before the workers are forked (preload_app), so the
+#  models and game table are loaded once and shared by all of the workers.
+#  Each worker handles requests on several threads, which is what lets
+#  concurrent requests for the same user be coalesced.
+
+import multiprocessing
+
+bind = '127.0.0.1:8000'
+preload_app = True
+workers = max(2, multiprocessing.cpu_count())
+worker_class = 'gthread'
+threads = 8
+timeout = 120
@@ -0,0 +1,182 @@
+#  A single HTTP layer for all of the requests made to BGG.  Connections are
+#  pooled and kept alive, every request goes through one shared rate limiter
+#  (rather than fixed sleeps scattered around the code), and the responses
+#  that BGG uses to say "try again later" (202 for queued requests, 429 for
+#  too many requests, and 5xx errors) are retried with jittered exponential
+#  backoff.  Successful responses are kept in (and, while still fresh,
+#  served from) the persistent response cache.
+
+import random
+import threading
+import time
+
+import requests
+
+from collections import namedtuple
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from response_cache import ResponseCache
+from constants import (AUTHORIZATION_DICT, REQUEST_RATE, REQUEST_BURST, MAX_WORKERS,
+                       MAX_RETRIES, BACKOFF_BASE, BACKOFF_MAX, REQUEST_TIMEOUT)
+
+#  The result of a request:  the final URL, status code and body text, and
+#  whether it was served from the response cache.
+Response = namedtuple('Response', ['url', 'status_code', 'text', 'from_cache'],
+                      defaults=[False])
+
+RETRY_STATUS_CODES = {202, 429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    '''A thread-safe token bucket rate limiter.  Tokens are added at "rate"
+       per second, up to a maximum of "burst" tokens, and each request
+       must take a token (waiting if necessary) before it is made.
+    '''
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Take a token, sleeping until one is available.'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BGGClient():
+    '''A class to make (possibly many concurrent) GET requests to BGG,
+       sharing a rate limiter and pooled keep-alive sessions, and retrying
+       the responses in RETRY_STATUS_CODES with jittered exponential backoff.
+       If a ResponseCache is given, successful responses are stored there,
+       and requests are answered from it while the cached copy is fresh.
+
+       self.requests counts the requests actually made to BGG (including
+       retries, but not the responses served from the cache).
+    '''
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST,
+                 max_workers=MAX_WORKERS, max_retries=MAX_RETRIES,
+                 headers=AUTHORIZATION_DICT, cache=None):
+        self.limiter = TokenBucket(rate, burst)
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.headers = dict(headers)
+        self.requests = 0
+        self._local = threading.local()
+        self._count_lock = threading.Lock()
+
+    def __repr__(self):
+        return f'BGGClient: {self.limiter.rate} requests/s, {self.max_workers} workers'
+
+    def _session(self):
+        #  requests.Session is not guaranteed to be thread-safe, so each
+        #  thread keeps its own session (and its own connection pool).
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(self.headers)
+            self._local.session = session
+        return session
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def get(self, url, params=None, ttl=None, cache=True):
+        '''Make a GET request (waiting on the rate limiter first), retrying
+           as needed.  Returns a Response with the last status code seen.
+
+           ttl:    A timedelta for how old a cached response may be (None for
+                   the default of the endpoint, and timedelta(0) to always
+                   make the request).
+           cache:  Whether to use the response cache at all.  If False, the
+                   request is always made and the response isn't stored
+                   (e.g. for large responses that won't be asked for again).
+        '''
+        use_cache = cache and self.cache is not None
+        if use_cache and ttl != timedelta(0):
+            text = self.cache.get(url, params, ttl)
+            if text is not None:
+                return Response(url, 200, text, True)
+
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            with self._count_lock:
+                self.requests += 1
+            try:
+                r = self._session().get(url, params=params, timeout=REQUEST_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            if r.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                if r.status_code == 200 and use_cache:
+                    self.cache.put(url, params, r.text)
+                return Response(r.url, r.status_code, r.text)
+            time.sleep(self._backoff(attempt, r.headers.get('Retry-After')))
+
+    def fetch_many(self, requests_, ttl=None):
+        '''Make many GET requests concurrently (on up to max_workers threads,
+           all sharing the rate limiter).
+
+           requests_:  An iterable of (key, url, params) tuples.
+           ttl:        As for get.
+
+           Returns:  A generator of (key, Response) pairs, in the order
+           that the requests complete.  A request that still can't connect
+           (or times out) after retrying gives a Response with a status
+           code of None, rather than ending the generator.
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.get, url, params, ttl): (key, url)
+                       for key, url, params in requests_}
+            for future in as_completed(futures):
+                key, url = futures[future]
+                try:
+                    result = future.result()
+                except (requests.ConnectionError, requests.Timeout):
+                    result = Response(url, None, '')
+                yield key, result
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''Return the BGGClient shared by everything in this process.'''
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = BGGClient(cache=ResponseCache())
+    return _client
+
+
+def set_client(client):
+    '''Replace the shared BGGClient (e.g. with one that has a different
+       rate limit or no cache), and return the previous one.
+    '''
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
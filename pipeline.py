@@ -0,0 +1,287 @@
+#  A staged pipeline for fetching many games from BGG, used by the cron jobs:
+#
+#      fetch threads  ->  parse processes  ->  writer
+#
+#  The fetch threads make the "thing" requests (throttled only by the shared
+#  client's rate limiter), the XML of each response is parsed on a process
+#  pool, and the parsed games are handed to a single writer (the calling
+#  thread), which commits them in chunks as they arrive.  The stages are
+#  joined by bounded queues, so parsing overlaps with waiting on the network,
+#  and the memory used is bounded by the queue depths and the chunk size,
+#  rather than growing with the number of games fetched.
+#
+#  Games in a batch that come back without a description (see getGame) are
+#  requeued to be fetched on their own.  Since that can multiply the number of
+#  requests, a run can be given a budget of requests, after which the batches
+#  still to be fetched are given up (and reported as failed).
+#
+#  The parse processes are started with "forkserver" (where available), since
+#  forking a process that has threads holding locks (the HTTP sessions, the
+#  response cache) can leave the child deadlocked.  If a stage fails (e.g.
+#  the pool is broken by a worker being killed), the error is raised by the
+#  writer rather than leaving it waiting forever.
+#
+#  The saved indexes (similarity, expansions, text, taxonomy) are kept current
+#  by the runs (see update_indexes), once they have been built from the whole
+#  store with:  uv run pipeline.py
+
+import multiprocessing
+import os
+import queue
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from constants import (MAX_THING_IDS, MAX_WORKERS, PARSE_WORKERS, PIPELINE_QUEUE_DEPTH,
+                       PIPELINE_CHUNK_SIZE, SIMILARITY_DATA, EXPANSION_DATA, TEXT_INDEX_DATA,
+                       TAXONOMY_DATA)
+from api_functions import get_thing, _cleanGameItem
+from description_store import TextIndex, update_text_index
+from expansion_index import ExpansionIndex, update_expansions
+from game_store import load_store
+from http_client import get_client
+from similarity import SimilarityIndex, update_similarity
+from taxonomy import (LINK_COLUMNS, Taxonomy, Vocabulary, seed_vocabularies,
+                      update_taxonomy)
+
+
+def _parseBatch(text):
+    '''Parse the XML of a "thing" response (in a worker process), and return
+       the games along with the ids of those without a description, and the
+       vocabularies of the link terms in the response (with their BGG ids).
+    '''
+    vocabularies = {column: Vocabulary() for column in LINK_COLUMNS}
+    games = _cleanGameItem(text, vocabularies)
+    broken = games.index[games['description'].fillna('').astype(str).str.strip() == '']
+    return games, list(broken), vocabularies
+
+
+#  The result for a batch of ids:  the parsed games (or None, if the request
+#  or the parsing failed), the ids without a description and the vocabularies
+#  of the link terms.
+_Done = namedtuple('_Done', ['ids', 'games', 'broken', 'links'], defaults=[None, (), None])
+
+
+def run_pipeline(ids, commit, batch_size=MAX_THING_IDS, fetch_workers=MAX_WORKERS,
+                 parse_workers=PARSE_WORKERS, queue_depth=PIPELINE_QUEUE_DEPTH,
+                 chunk_size=PIPELINE_CHUNK_SIZE, ttl=None, max_requests=None, vocabularies=None):
+    '''Fetch the games with the given ids (in batches of batch_size ids per
+       request), and pass them to commit in chunks of about chunk_size games.
+       If max_requests is given, no more requests are started once the shared
+       client has made that many (including retries) since the run started.
+       If a dictionary of vocabularies (keyed by link column) is given, the
+       link terms of the games are added to it, along with their BGG ids.
+
+       commit:  A function commit(games, attempted), called from this thread,
+                where games is a DataFrame of the games parsed (possibly
+                empty) and attempted is the list of the ids whose response
+                came back, whether or not they were found in it.
+
+       Returns:  The list of the ids whose request (or parsing) failed, even
+                 after retrying, which are left out of attempted since
+                 nothing is known about them.
+    '''
+    ids = list(ids)
+    client = get_client()
+    first_request = client.requests
+    tasks = queue.Queue()
+    fetched = queue.Queue(maxsize=queue_depth)
+    parsed = queue.Queue(maxsize=queue_depth)
+    slots = threading.BoundedSemaphore(queue_depth)
+    #  Set when the writer stops (even on an error), so that no stage is
+    #  left waiting on a full queue.
+    stop = threading.Event()
+    #  The errors of the fetch and dispatch threads, raised by the writer
+    failures = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def guarded(stage):
+        def run(*args):
+            try:
+                stage(*args)
+            except BaseException as e:
+                failures.append(e)
+        return run
+
+    def fetch():
+        while True:
+            batch = get(tasks)
+            if batch is None:
+                return
+            if max_requests is not None and client.requests - first_request >= max_requests:
+                put(fetched, (batch, None))
+                continue
+            try:
+                text = get_thing(','.join(str(x) for x in batch), ttl=ttl, stats=1)
+            except Exception:
+                text = None
+            put(fetched, (batch, text))
+
+    def dispatch(executor):
+        #  Hand each response to the process pool, with at most queue_depth
+        #  of them being parsed at once.
+        while True:
+            item = get(fetched)
+            if item is None:
+                return
+            batch, text = item
+            if text is None:
+                put(parsed, _Done(batch))
+                continue
+            while not slots.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            future = executor.submit(_parseBatch, text)
+            future.add_done_callback(lambda f, batch=batch: finished(f, batch))
+
+    def finished(future, batch):
+        slots.release()
+        try:
+            games, broken, links = future.result()
+        except Exception:
+            put(parsed, _Done(batch))
+            return
+        #  A game fetched on its own is kept, with or without a description
+        put(parsed, _Done(batch, games, broken if len(batch) > 1 else [], links))
+
+    pending = 0
+    for index in range(0, len(ids), batch_size):
+        tasks.put(ids[index:index+batch_size])
+        pending += 1
+
+    def next_done():
+        while not failures:
+            try:
+                return parsed.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise failures[0]
+
+    failed = []
+    chunk, attempted, rows = [], [], 0
+    with ProcessPoolExecutor(max_workers=parse_workers, mp_context=_context()) as executor:
+        fetchers = [threading.Thread(target=guarded(fetch), daemon=True)
+                    for _ in range(fetch_workers)]
+        dispatcher = threading.Thread(target=guarded(dispatch), args=(executor,), daemon=True)
+        for thread in fetchers + [dispatcher]:
+            thread.start()
+        try:
+            while pending:
+                done = next_done()
+                pending -= 1
+                broken = set(done.broken)
+                for game in broken:
+                    tasks.put([game])
+                    pending += 1
+                if done.games is None:
+                    failed.extend(done.ids)
+                    continue
+                attempted.extend(x for x in done.ids if x not in broken)
+                if vocabularies is not None:
+                    for column, vocabulary in done.links.items():
+                        vocabularies.setdefault(column, Vocabulary()).merge(vocabulary)
+                if len(done.games):
+                    games = done.games.drop(index=list(broken))
+                    chunk.append(games)
+                    rows += len(games)
+                if rows >= chunk_size:
+                    _commit(commit, chunk, attempted)
+                    chunk, attempted, rows = [], [], 0
+            if chunk or attempted:
+                _commit(commit, chunk, attempted)
+        finally:
+            stop.set()
+    return failed
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _commit(commit, chunk, attempted):
+    chunk = [c for c in chunk if len(c)]
+    games = pd.concat(chunk) if chunk else pd.DataFrame()
+    commit(games, attempted)
+
+
+def load_indexes():
+    '''Load the saved similarity, expansion, text and taxonomy indexes (None
+       for any that haven't been built) into memory, as a dictionary to be
+       kept (e.g. by the daemon) and given to update_indexes.
+    '''
+    return {'similarity': _loaded(SimilarityIndex, f'{SIMILARITY_DATA}/ids.npy', mmap_mode=None),
+            'expansions': _loaded(ExpansionIndex, f'{EXPANSION_DATA}/from_base.npy'),
+            'text': _loaded(TextIndex, f'{TEXT_INDEX_DATA}/ids.npy', mmap_mode=None),
+            'taxonomy': _loaded(Taxonomy, f'{TAXONOMY_DATA}/ids.npy', mmap_mode=None)}
+
+
+def _loaded(cls, filename, **kwargs):
+    return cls.load(**kwargs) if os.path.exists(filename) else None
+
+
+def update_indexes(store, ids, vocabularies=None, indexes=None):
+    '''Update the saved similarity, expansion, text and taxonomy indexes for
+       the games with the given ids, as read back from the game store (along
+       with their descriptions, if the store keeps those apart).  The BGG ids
+       of the link terms in the vocabularies (from run_pipeline) are added to
+       the taxonomy.
+
+       indexes:  The indexes kept in memory (see load_indexes), which are
+                 updated (and saved) rather than loaded, and to which any
+                 index that had to be loaded is added.
+    '''
+    indexes = indexes if indexes is not None else dict()
+    ids = list(ids)
+    if not ids:
+        return
+    games = store.load(ids=ids)
+    if games is None:
+        return
+    if store.descriptions is not None:
+        games['description'] = store.descriptions.get_many(games.index).reindex(games.index)
+    indexes['similarity'] = update_similarity(games, index=indexes.get('similarity'))
+    indexes['expansions'] = update_expansions(games, index=indexes.get('expansions'))
+    indexes['text'] = update_text_index(games, index=indexes.get('text'))
+    indexes['taxonomy'] = update_taxonomy(games, vocabularies=vocabularies,
+                                          taxonomy=indexes.get('taxonomy'))
+
+
+def build_indexes(store, max_workers=None):
+    '''Build the similarity, expansion, text and taxonomy indexes from all of
+       the games in the store, replacing any saved ones.  (update_indexes only
+       updates indexes that have been built.)
+    '''
+    games = store.load()
+    if games is None:
+        return
+    if store.descriptions is not None:
+        descriptions = store.descriptions.get_many()
+    else:
+        descriptions = games['description'].dropna()
+    SimilarityIndex.from_games(games, max_workers=max_workers).save()
+    ExpansionIndex.from_games(games).save()
+    TextIndex.from_descriptions(descriptions).save()
+    Taxonomy.from_games(games, seed_vocabularies(save=True)).save()
+
+
+if __name__ == '__main__':
+    build_indexes(load_store())
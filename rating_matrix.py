@@ -0,0 +1,210 @@
+#  Turns the collections of many users into sparse user x game matrices, the
+#  input for the recommendation models:  one of the explicit ratings, and one
+#  of implicit "confidence" signals (owning, wishlisting, rating and playing a
+#  game).  The matrices are saved as separate .npy files for each of their
+#  CSR components, so that they can be memory-mapped (and so shared between
+#  processes without a copy) rather than loaded.
+
+import os
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from classes import STATUS_BITS
+from constants import RATING_MATRIX_DATA, IMPLICIT_WEIGHTS
+
+
+class RatingMatrix():
+    '''A class for the ratings and implicit signals of users for games, as
+       two CSR matrices (rows are users, columns are games) along with the
+       usernames and game ids for the rows and columns.  A zero entry in the
+       ratings matrix means that there is no rating.
+    '''
+    def __init__(self, users, games, ratings, implicit):
+        self.users = np.asarray(users)
+        self.games = np.asarray(games, dtype=np.int64)
+        self.ratings = ratings
+        self.implicit = implicit
+        self._user_index = None
+        self._game_index = None
+
+    def __repr__(self):
+        return f'RatingMatrix: {len(self.users)} users x {len(self.games)} games, ' + \
+               f'{self.ratings.nnz} ratings, {self.implicit.nnz} implicit'
+
+    @property
+    def shape(self):
+        return (len(self.users), len(self.games))
+
+    def user_index(self):
+        '''Return a pandas Index mapping usernames to row numbers.'''
+        if self._user_index is None:
+            self._user_index = pd.Index(self.users)
+        return self._user_index
+
+    def game_index(self):
+        '''Return a pandas Index mapping game ids to column numbers.'''
+        if self._game_index is None:
+            self._game_index = pd.Index(self.games)
+        return self._game_index
+
+    def by_game(self, name='implicit'):
+        '''Return one of the matrices in CSC format, for fast access to the
+           users of each game (a column).
+        '''
+        return getattr(self, name).tocsc()
+
+    def save(self, path=RATING_MATRIX_DATA):
+        '''Save the matrices, writing every array to a temporary file first and
+           then renaming each over the old one, so that the arrays memory-mapped
+           by other processes aren't changed under them.
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = {'users': self.users.astype(str), 'games': self.games}
+        for name, matrix in [('ratings', self.ratings), ('implicit', self.implicit)]:
+            for component in ['data', 'indices', 'indptr']:
+                arrays[f'{name}-{component}'] = getattr(matrix, component)
+        for name, array in arrays.items():
+            with open(f'{path}/{name}.npy.tmp', 'wb') as f:
+                np.save(f, array)
+        for name in arrays:
+            os.replace(f'{path}/{name}.npy.tmp', f'{path}/{name}.npy')
+
+    @classmethod
+    def load(cls, path=RATING_MATRIX_DATA, mmap_mode='r'):
+        '''Load saved matrices, with the arrays memory-mapped by default.'''
+        users = np.load(f'{path}/users.npy', mmap_mode=mmap_mode)
+        games = np.load(f'{path}/games.npy', mmap_mode=mmap_mode)
+        matrices = []
+        for name in ['ratings', 'implicit']:
+            data, indices, indptr = [np.load(f'{path}/{name}-{component}.npy', mmap_mode=mmap_mode)
+                                     for component in ['data', 'indices', 'indptr']]
+            matrices.append(sp.csr_matrix((data, indices, indptr),
+                                          shape=(len(users), len(games)), copy=False))
+        return cls(users, games, *matrices)
+
+
+def _implicit(table):
+    '''The implicit confidence of each row of a (long format) collection table.'''
+    status = table['status'].to_numpy()
+    result = np.zeros(len(table), dtype=np.float32)
+    for flag in ['own', 'wishlist']:
+        result += IMPLICIT_WEIGHTS[flag] * ((status & STATUS_BITS[flag]) != 0)
+    result += IMPLICIT_WEIGHTS['rated'] * table['rating'].notna().to_numpy()
+    result += IMPLICIT_WEIGHTS['numplays'] * np.log1p(table['numplays'].clip(lower=0).to_numpy())
+    return result
+
+
+class RatingMatrixBuilder():
+    '''A class to build a RatingMatrix from users' collections, added one at
+       a time (add_collection) or many at once (add_table, e.g. with the
+       table of a CollectionWarehouse), possibly starting from an existing
+       RatingMatrix.  Users and games keep their row and column numbers, new
+       users and games are appended, and a user that is added again has
+       their row replaced.
+    '''
+    def __init__(self, matrix=None):
+        self.users = [str(u) for u in matrix.users] if matrix is not None else []
+        self.games = [int(g) for g in matrix.games] if matrix is not None else []
+        self.user_codes = {u: i for i, u in enumerate(self.users)}
+        self.game_codes = {int(g): i for i, g in enumerate(self.games)}
+        self.matrix = matrix
+        self.pending = []   #  (rows, columns, ratings, implicit) to add
+        self.added = set()  #  The rows of the users added since the last build
+
+    def __repr__(self):
+        return f'RatingMatrixBuilder: {len(self.users)} users, {len(self.games)} games'
+
+    def _codes(self, values, codes, names):
+        result = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(names)
+                names.append(value)
+            result[i] = code
+        return result
+
+    def add_table(self, table):
+        '''Add the rows of a long format table of collections, i.e. with the
+           columns username, id (the game), rating, numplays and status.
+        '''
+        table = table[['username', 'id', 'rating', 'numplays', 'status']].copy()
+        table['username'] = table['username'].astype(str)
+        #  Combine the entries for a game that appears more than once in a
+        #  collection (e.g. two copies of it).  Only those few are grouped,
+        #  and the status bits are OR-ed as the maximum of each bit.
+        repeated = table.duplicated(['username', 'id'], keep=False).to_numpy()
+        if repeated.any():
+            repeats = table[repeated]
+            bits = {flag: repeats['status'] & bit for flag, bit in STATUS_BITS.items()}
+            combined = repeats.assign(**bits).groupby(['username', 'id'], sort=False, observed=True).agg(
+                           rating=('rating', 'max'), numplays=('numplays', 'sum'),
+                           **{flag: (flag, 'max') for flag in bits}).reset_index()
+            combined['status'] = combined[list(bits)].sum(axis=1).astype(table['status'].dtype)
+            table = pd.concat([table[~repeated], combined[table.columns]], ignore_index=True)
+        implicit = _implicit(table)
+        ratings = table['rating'].fillna(0).to_numpy(dtype=np.float32)
+
+        #  The users (even those left without any entries) get a row, which
+        #  replaces what was pending for them from an earlier add.
+        users = table['username'].unique()
+        user_codes = self._codes(users, self.user_codes, self.users)
+        self.pending = [tuple(x[~np.isin(entry[0], user_codes)] for x in entry)
+                        for entry in self.pending]
+        self.added.update(int(code) for code in user_codes)
+
+        keep = (implicit > 0) | (ratings > 0)
+        table, implicit, ratings = table[keep], implicit[keep], ratings[keep]
+        rows = pd.Series(user_codes, index=users)[table['username']].to_numpy()
+        games = table['id'].unique()
+        game_codes = self._codes([int(g) for g in games], self.game_codes, self.games)
+        columns = pd.Series(game_codes, index=games)[table['id']].to_numpy()
+        self.pending.append((rows.astype(np.int32), columns, ratings, implicit))
+
+    def add_collection(self, username, collection):
+        '''Add (or replace) one user's collection (as from get_collection).'''
+        table = collection.reset_index()
+        table['username'] = username
+        self.add_table(table)
+
+    def build(self):
+        '''Return the RatingMatrix with all of the collections added so far.'''
+        shape = (len(self.users), len(self.games))
+        if self.pending:
+            rows, columns, ratings, implicit = [np.concatenate(x) for x in zip(*self.pending)]
+        else:
+            rows = columns = np.zeros(0, dtype=np.int32)
+            ratings = implicit = np.zeros(0, dtype=np.float32)
+
+        matrices = []
+        for name, values in [('ratings', ratings), ('implicit', implicit)]:
+            new = sp.coo_matrix((values, (rows, columns)), shape=shape).tocsr()
+            new.sum_duplicates()
+            if self.matrix is not None:
+                #  Keep the existing rows of the users that weren't added again
+                old = getattr(self.matrix, name)
+                old = sp.csr_matrix((old.data, old.indices, old.indptr), shape=old.shape)
+                old.resize(shape)
+                replaced = np.zeros(shape[0], dtype=bool)
+                replaced[list(self.added)] = True
+                keep = sp.diags((~replaced).astype(np.float32))
+                new = (keep @ old + new).tocsr()
+            new.eliminate_zeros()
+            new.data = new.data.astype(np.float32)
+            matrices.append(new)
+
+        self.matrix = RatingMatrix(np.array(self.users, dtype=object), self.games, *matrices)
+        self.pending = []
+        self.added = set()
+        return self.matrix
+
+
+def build_from_warehouse(warehouse, matrix=None):
+    '''Build (or extend) a RatingMatrix from all of the collections in a
+       CollectionWarehouse.
+    '''
+    builder = RatingMatrixBuilder(matrix)
+    builder.add_table(warehouse.table)
+    return builder.build()
@@ -0,0 +1,128 @@
+#  A persistent cache of the raw responses from BGG, so that re-running a
+#  script (or a notebook) that asks for the same games, collections or
+#  geekbuddies doesn't need to make the same requests again.  The responses
+#  are stored compressed in a SQLite database, keyed by a hash of the
+#  normalized URL and query parameters, with a time-to-live for each type of
+#  request (i.e. each API endpoint) and least-recently-used eviction when
+#  the cache grows beyond a size budget.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from urllib.parse import urlsplit, parse_qsl
+
+from constants import CACHE_FILE, CACHE_MAX_BYTES, CACHE_TTL
+
+
+def _normalize(url, params=None):
+    '''Return the endpoint name and a normalized form of the URL and query
+       parameters, so that the same request always gives the same key
+       (regardless of the order of the parameters, or whether they were
+       given in the URL or as a dictionary).
+    '''
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query.extend((str(k), str(v)) for k, v in params.items())
+    query = sorted((k.strip().lower(), v.strip()) for k, v in query)
+    endpoint = parts.path.rstrip('/').rsplit('/', 1)[-1]
+    normalized = f'{parts.netloc.lower()}{parts.path.rstrip("/")}?' + \
+                 '&'.join(f'{k}={v}' for k, v in query)
+    return endpoint, normalized
+
+
+class ResponseCache():
+    '''A class for the cache of raw (text) responses, stored zlib-compressed
+       in a SQLite database.  Safe to share between threads.
+
+       ttl arguments are timedeltas, where None means to use the default
+       for the endpoint (from CACHE_TTL).
+    '''
+    def __init__(self, path=CACHE_FILE, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                               key TEXT PRIMARY KEY, endpoint TEXT, url TEXT,
+                               fetched REAL, accessed REAL, size INTEGER, body BLOB)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.commit()
+        self.total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def __repr__(self):
+        return f'ResponseCache: {self.path} ({self.total} bytes)'
+
+    def _ttl(self, endpoint, ttl):
+        if ttl is None:
+            ttl = CACHE_TTL.get(endpoint, CACHE_TTL['default'])
+        return ttl.total_seconds()
+
+    def get(self, url, params=None, ttl=None):
+        '''Return the cached text for the request, or None if it isn't in
+           the cache or is older than the ttl.
+        '''
+        endpoint, normalized = _normalize(url, params)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT fetched, body FROM responses WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None or now - row[0] > self._ttl(endpoint, ttl):
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.db.commit()
+        return zlib.decompress(row[1]).decode('utf-8')
+
+    def put(self, url, params, text):
+        '''Store the text of a response in the cache, and evict the least
+           recently used responses if the cache is now over its budget.
+        '''
+        endpoint, normalized = _normalize(url, params)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        body = zlib.compress(text.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, endpoint, normalized, now, now, len(body), body))
+            self.total += len(body) - (old[0] if old else 0)
+            self._evict()
+            self.db.commit()
+
+    def invalidate(self, url, params=None):
+        '''Remove a response from the cache.'''
+        key = hashlib.sha1(_normalize(url, params)[1].encode('utf-8')).hexdigest()
+        with self.lock:
+            old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if old:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total -= old[0]
+                self.db.commit()
+
+    def _evict(self):
+        #  Remove the least recently accessed responses, in blocks, until
+        #  the total size is within the budget.  Called holding the lock.
+        while self.total > self.max_bytes:
+            rows = self.db.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total -= size
+                if self.total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        '''Remove everything from the cache.'''
+        with self.lock:
+            self.db.execute('DELETE FROM responses')
+            self.db.commit()
+            self.total = 0
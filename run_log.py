@@ -0,0 +1,160 @@
+#  A write-ahead log for the long runs of the cron jobs, so that a run that
+#  is interrupted (a crash, a reboot, a killed job) can be resumed without
+#  repeating the requests already made.  A run is kept in a directory of
+#  its own:
+#
+#      ids.npy                 The ids to be fetched in the run
+#      chunk-NNNNNN.parquet    The games parsed in each chunk, along with the
+#                              ids attempted (in the Parquet metadata)
+#      manifest.json           The number of chunks committed
+#
+#  Each chunk is written to the log (atomically, as a temporary file that is
+#  then renamed) before it is applied to the game store and the update
+#  scheduler, and the manifest is replaced (in the same way) once both have
+#  been saved.  So after a crash at any point, the store and the scheduler
+#  are brought back into agreement by applying again the chunks that were
+#  logged but not committed (which are idempotent, see apply in RunLog.run),
+#  and the run carries on with the ids that hadn't been attempted.
+
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import datetime
+
+from constants import RUN_LOG_DATA
+from pipeline import run_pipeline
+
+
+class RunLog():
+    '''A class for the write-ahead log of the current run of a job (name),
+       if there is one.
+    '''
+    def __init__(self, name, path=RUN_LOG_DATA):
+        self.path = f'{path}/{name}'
+        self.manifest = None
+        if os.path.exists(f'{self.path}/manifest.json'):
+            with open(f'{self.path}/manifest.json') as f:
+                self.manifest = json.load(f)
+
+    def __repr__(self):
+        if self.manifest is None:
+            return f'RunLog: {self.path} (no run)'
+        return (f'RunLog: {self.path} (started {self.manifest["started"]}, '
+                f'{self.manifest["committed"]} chunks committed)')
+
+    @property
+    def resuming(self):
+        '''Whether there is an unfinished run to resume.'''
+        return self.manifest is not None
+
+    def _chunk_file(self, n):
+        return f'{self.path}/chunk-{n:06d}.parquet'
+
+    def _chunks(self):
+        return sorted(glob.glob(f'{self.path}/chunk-*.parquet'))
+
+    def _save_manifest(self, manifest):
+        with open(f'{self.path}/manifest.json.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{self.path}/manifest.json.tmp', f'{self.path}/manifest.json')
+        self.manifest = manifest
+
+    def start(self, ids):
+        '''Start a new run, to fetch the games with the given ids.'''
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
+        np.save(f'{self.path}/ids.npy', np.asarray(ids, dtype=np.int64))
+        self._save_manifest({'started': datetime.now().isoformat(), 'committed': 0})
+
+    def ids(self):
+        return np.load(f'{self.path}/ids.npy')
+
+    def append(self, games, attempted, now):
+        '''Write a chunk of games (and the ids attempted) to the log, and
+           return its number.
+        '''
+        n = len(self._chunks())
+        if len(games):
+            table = pa.Table.from_pandas(games.reset_index(), preserve_index=False)
+        else:
+            table = pa.table({'id': pa.array([], type=pa.int64())})
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'attempted'] = json.dumps([int(x) for x in attempted]).encode()
+        metadata[b'time'] = now.isoformat().encode()
+        table = table.replace_schema_metadata(metadata)
+        pq.write_table(table, f'{self._chunk_file(n)}.tmp', compression='zstd')
+        os.replace(f'{self._chunk_file(n)}.tmp', self._chunk_file(n))
+        return n
+
+    def commit(self, n):
+        '''Record that the chunks up to and including n have been applied.'''
+        self._save_manifest(dict(self.manifest, committed=n + 1))
+
+    @staticmethod
+    def _metadata(filename):
+        metadata = pq.read_schema(filename).metadata
+        return (json.loads(metadata[b'attempted']),
+                datetime.fromisoformat(metadata[b'time'].decode()))
+
+    def read(self, n):
+        '''Return the games, the ids attempted, and the time of a chunk.'''
+        filename = self._chunk_file(n)
+        attempted, now = self._metadata(filename)
+        return pq.read_table(filename).to_pandas().set_index('id'), attempted, now
+
+    def attempted(self):
+        '''Return the ids attempted in all of the chunks logged so far.'''
+        attempted = [self._metadata(filename)[0] for filename in self._chunks()]
+        return np.unique(np.concatenate([np.asarray(a, dtype=np.int64) for a in attempted]
+                                        + [np.zeros(0, dtype=np.int64)]))
+
+    def updated(self):
+        '''Return the ids of the games written in all of the chunks logged.'''
+        ids = [pq.read_table(filename, columns=['id'])['id'].to_numpy()
+               for filename in self._chunks()]
+        return np.unique(np.concatenate(ids + [np.zeros(0, dtype=np.int64)]))
+
+    def run(self, ids, apply, **kwargs):
+        '''Fetch the games with the given ids (see run_pipeline, which gets
+           any other arguments), logging each chunk, then applying it with
+           apply(games, attempted, now) and committing it.  If there is an
+           unfinished run, it is resumed instead:  the chunks that weren't
+           committed are applied, and the rest of its ids are fetched (and
+           the ids given are ignored).
+
+           apply must be idempotent, since a chunk is applied again if the
+           run is interrupted before it is committed.  (Upserting the games
+           into the store is, and UpdateScheduler.record skips the games
+           already recorded at that time.)
+
+           Returns:  The ids of the games written in the whole run.  Call
+                     finish once they have been dealt with.
+        '''
+        if self.manifest is None:
+            self.start(ids)
+        else:
+            for n in range(self.manifest['committed'], len(self._chunks())):
+                apply(*self.read(n))
+                self.commit(n)
+
+        def commit(games, attempted):
+            now = datetime.now()
+            n = self.append(games, attempted, now)
+            apply(games, attempted, now)
+            self.commit(n)
+
+        ids = self.ids()
+        run_pipeline(ids[~np.isin(ids, self.attempted())].tolist(), commit, **kwargs)
+        return self.updated()
+
+    def finish(self):
+        '''Remove the log of a finished run.'''
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.manifest = None
@@ -0,0 +1,282 @@
+#  An HTTP service for recommendations:  GET /recommend/<username> returns
+#  the games with the highest predicted preference for a BGG user, using the
+#  ALS model (folding the user in, if they weren't in its training data) or,
+#  without one, the content-based similarity index.  Games the user owns or
+#  has previously owned are excluded, and the results can be restricted in
+#  the style of User.filter (e.g. ?subtype=boardgame&players=4), and to the
+#  games with all of the given terms of the link columns, from the saved
+#  taxonomy (e.g. ?mechanics=Cooperative Game&mechanics=Hand Management).
+#
+#  The models and the game table are loaded once, when the app is created,
+#  with the model arrays memory-mapped so that gunicorn workers (forked
+#  after the app is loaded, see gunicorn.conf.py) share them.  Results are
+#  kept in an LRU cache for each worker, keyed by the saved version of the
+#  user's collection, so that a refreshed collection is never served stale
+#  results.  Concurrent requests for the same results are coalesced, so
+#  that only one of them does the work.
+#
+#  Run with:  gunicorn -c gunicorn.conf.py "server:create_app()"
+
+import glob
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timedelta
+
+import pandas as pd
+import numpy as np
+
+from flask import Flask, jsonify, request
+
+from constants import (ALS_DATA, SIMILARITY_DATA, TAXONOMY_DATA, USER_DATA, FULL_SYNC_INTERVAL,
+                       SERVER_CACHE_SIZE, SERVER_RESULTS, SERVER_MAX_RESULTS)
+from classes import User, collection_mask, get_collection, SAVED_COLLECTION
+from game_store import GameStore
+from als import ALSModel
+from similarity import SimilarityIndex
+from catalog_index import CatalogIndex, CATALOG_COLUMNS
+from taxonomy import Taxonomy, LINK_COLUMNS
+
+#  The columns of the game table used to restrict (and describe) the results
+GAME_INFO = ['name', 'bayesaverage'] + CATALOG_COLUMNS
+
+
+def _collectionVersion(bggUserName):
+    '''The name of the most recently saved collection of a user (which changes
+       whenever the collection is refreshed, in any process), or None.  The
+       directory is only listed again once its modification time changes
+       (i.e. some collection has been saved since).
+    '''
+    changed = os.stat(USER_DATA).st_mtime_ns
+    cached = _versions.get(bggUserName)
+    if cached is not None and cached[0] == changed:
+        return cached[1]
+    #  Only this user's files (not, e.g., those of "name-other" for "name")
+    matches = [SAVED_COLLECTION.search(f)
+               for f in glob.glob(f'{USER_DATA}/{glob.escape(bggUserName)}-*.dill')]
+    files = [m.group(0) for m in matches if m and m.group(1) == bggUserName]
+    version = max(files) if files else None
+    _versions.put(bggUserName, (changed, version))
+    return version
+
+
+class LRUCache():
+    '''A thread-safe, least recently used cache of a maximum size.'''
+    def __init__(self, size=SERVER_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def invalidate(self, username):
+        '''Remove all of the entries for a user (the first element of the key).'''
+        with self.lock:
+            for key in [k for k in self.items if k[0] == username]:
+                del self.items[key]
+
+
+#  The versions of the users' collections found by _collectionVersion, along
+#  with the modification time of USER_DATA when they were found.
+_versions = LRUCache()
+
+
+class Recommender():
+    '''A class holding the models and game table, that produces (and caches)
+       the recommendations for users.
+    '''
+    def __init__(self, model=None, similarity=None, games=None, taxonomy=None,
+                 cache_size=SERVER_CACHE_SIZE):
+        self.model = model
+        self.similarity = similarity
+        self.taxonomy = taxonomy
+        self.cache = LRUCache(cache_size)
+        self._inflight = dict()
+        self._lock = threading.Lock()
+
+        #  The game table, aligned with the candidate games (those of the
+        #  model, or of the similarity index), and the catalog index of the
+        #  candidates that the constraints are pushed down into.
+        candidates = model.games if model is not None else similarity.ids
+        self.games = np.asarray(candidates, dtype=np.int64)
+        if games is None:
+            games = pd.DataFrame(columns=GAME_INFO)
+        self.info = games.reindex(index=pd.Index(self.games, name='id'), columns=GAME_INFO)
+        self.catalog = CatalogIndex(self.info)
+        self.index = pd.Index(self.games)
+        #  The candidate row of each game of the taxonomy (or -1)
+        if taxonomy is not None:
+            self._taxonomy_rows = self.index.get_indexer(taxonomy.ids)
+
+    def _links(self, column, terms):
+        '''Return a boolean array over the candidates of whether each game
+           has all of the terms of a link column.
+        '''
+        rows = self._taxonomy_rows[self.taxonomy.mask(column, list(terms), match='all')]
+        found = np.zeros(len(self.games), dtype=bool)
+        found[rows[rows >= 0]] = True
+        return found
+
+    def _scores(self, user):
+        '''Return the scores of the candidate games for a User.'''
+        collection = user.collection
+        if self.model is not None:
+            vector = self.model.user_vector(user.bggUserName)
+            if vector is None:
+                vector = self.model.fold_in(collection)
+            return np.asarray(self.model.item_factors @ vector, dtype=np.float32)
+        seeds = collection[collection_mask(collection, own=True)].index.union(
+                    collection[collection_mask(collection, has_rating=True)].index)
+        similar = self.similarity.recommend(seeds, n=SERVER_MAX_RESULTS * 10)
+        scores = np.zeros(len(self.games), dtype=np.float32)
+        scores[self.index.get_indexer(similar.index)] = similar.to_numpy()
+        return scores
+
+    def _compute(self, user, n, constraints):
+        collection = user.collection
+        scores = self._scores(user)
+        links = {c: terms for c, terms in constraints.items() if c in LINK_COLUMNS}
+        mask = np.zeros(len(self.games), dtype=bool)
+        mask[self.catalog.rows(**{c: v for c, v in constraints.items() if c not in links})] = True
+        for column, terms in links.items():
+            mask &= self._links(column, terms)
+        owned = collection[collection_mask(collection, own=True) |
+                           collection_mask(collection, prevowned=True)].index
+        excluded = self.index.get_indexer(owned)
+        mask[excluded[excluded >= 0]] = False
+
+        candidates = np.flatnonzero(mask)
+        n = min(n, len(candidates))
+        if n == 0:
+            return []
+        top = candidates[np.argpartition(-scores[candidates], n - 1)[:n]]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        info = self.info.iloc[top]
+        return [{'id': int(self.games[row]), 'name': str(name), 'score': float(scores[row]),
+                 'yearpublished': None if pd.isna(year) else int(year)}
+                for row, name, year in zip(top, info['name'], info['yearpublished'])]
+
+    def recommend(self, bggUserName, n=SERVER_RESULTS, **constraints):
+        '''Return the list of recommendations (dicts of the game id, name,
+           score and year) for a user, from the cache if possible.
+        '''
+        key = (bggUserName, _collectionVersion(bggUserName), n, tuple(sorted(constraints.items())))
+        result = self.cache.get(key)
+        if result is not None and key[1] is not None:
+            return result
+
+        #  If another thread is already working on the same request, wait
+        #  for its result rather than repeating the work.
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            user = User(bggUserName)
+            result = self._compute(user, n, constraints)
+            #  Loading the User may have synced (and saved) the collection
+            key = (bggUserName, _collectionVersion(bggUserName)) + key[2:]
+            self.cache.put(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight = {k: f for k, f in self._inflight.items() if f is not future}
+
+    def refresh(self, bggUserName, full=False):
+        '''Refresh a user's collection from BGG, and drop their cached results.
+           (Only the one sync of User.refresh_collection is made, rather than
+           loading the User first, which may sync as well.)
+        '''
+        collection = get_collection(bggUserName, cutoff=timedelta(0),
+                                    full_sync=timedelta(0) if full else FULL_SYNC_INTERVAL)
+        if isinstance(collection, str):
+            raise ValueError(collection)
+        self.cache.invalidate(bggUserName)
+        return len(collection)
+
+
+def _loadRecommender(als_path=ALS_DATA, similarity_path=SIMILARITY_DATA,
+                     taxonomy_path=TAXONOMY_DATA, store=None):
+    model = ALSModel.load(als_path) if os.path.exists(f'{als_path}/item_factors.npy') else None
+    similarity = (SimilarityIndex.load(similarity_path)
+                  if os.path.exists(f'{similarity_path}/ids.npy') else None)
+    if model is None and similarity is None:
+        raise RuntimeError('No ALS model or similarity index to serve.')
+    taxonomy = (Taxonomy.load(taxonomy_path)
+                if os.path.exists(f'{taxonomy_path}/ids.npy') else None)
+    games = (store if store is not None else GameStore()).load(columns=GAME_INFO)
+    return Recommender(model, similarity, games, taxonomy)
+
+
+#  The request parameters for the constraints, and their types
+_CONSTRAINTS = {'subtype': str, 'players': int, 'min_players': int, 'max_players': int,
+                'max_playtime': float, 'min_playtime': float, 'max_weight': float,
+                'min_weight': float, 'yearpublished': int, 'published_before': int,
+                'published_after': int}
+
+
+def create_app(recommender=None):
+    '''Create the Flask app, loading the models and game table (unless a
+       Recommender is given).
+    '''
+    app = Flask(__name__)
+    recommender = recommender if recommender is not None else _loadRecommender()
+    app.config['RECOMMENDER'] = recommender
+
+    @app.get('/health')
+    def health():
+        return jsonify(status='ok', games=len(recommender.games),
+                       model=repr(recommender.model), similarity=repr(recommender.similarity))
+
+    @app.get('/recommend/<username>')
+    def recommend(username):
+        try:
+            n = min(int(request.args.get('n', SERVER_RESULTS)), SERVER_MAX_RESULTS)
+            constraints = {k: t(request.args[k]) for k, t in _CONSTRAINTS.items() if k in request.args}
+        except ValueError as e:
+            return jsonify(error=f'Invalid parameter: {e}'), 400
+        links = {c: tuple(sorted(request.args.getlist(c))) for c in LINK_COLUMNS if c in request.args}
+        if links and recommender.taxonomy is None:
+            return jsonify(error='No taxonomy to restrict the games by'), 400
+        constraints.update(links)
+        if n < 1:
+            return jsonify(error='Invalid parameter: n must be at least 1'), 400
+        try:
+            games = recommender.recommend(username, n, **constraints)
+        except ValueError as e:
+            #  The User couldn't be loaded (e.g. an invalid username)
+            return jsonify(error=str(e)), 404
+        return jsonify(username=username, games=games)
+
+    @app.post('/users/<username>/refresh')
+    def refresh(username):
+        full = request.args.get('full', 'false').lower() in ('1', 'true', 'yes')
+        try:
+            items = recommender.refresh(username, full)
+        except ValueError as e:
+            return jsonify(error=str(e)), 404
+        return jsonify(username=username, items=items)
+
+    return app
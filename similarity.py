@@ -0,0 +1,365 @@
+#  Content-based similarity between games.  Each game is described by a sparse
+#  feature vector:  its categories, mechanics, families and designers (each
+#  term weighted by its column weight and its inverse document frequency), and
+#  bins for its weight, player counts and playing time.  The vectors are
+#  normalized, so that their dot products are cosine similarities, and the
+#  top SIMILARITY_K neighbours of every game are precomputed, in blocks of
+#  rows spread over a pool of processes.
+
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+from constants import (SIMILARITY_DATA, SIMILARITY_K, SIMILARITY_BLOCK, SIMILARITY_WEIGHTS,
+                       PLAYTIME_BINS)
+from taxonomy import Vocabulary
+
+#  The number of player count bins (1, 2, ..., MAX_PLAYERS_BIN or more), and
+#  weight bins (averageweight rounded to the nearest half, from 0.5 to 5).
+MAX_PLAYERS_BIN = 10
+WEIGHT_BINS = 10
+
+#  The link columns used as features.
+_LINKS = ['categories', 'mechanics', 'family', 'designer']
+
+
+def _normalize(features):
+    norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sp.diags(1 / norms) @ features).tocsr().astype(np.float32)
+
+
+def _numberFeatures(games):
+    '''Return the (rows, columns, values) of the binned numeric features,
+       with the columns counted from 0 (weight, then players, then playtime).
+    '''
+    rows, columns, values = [], [], []
+    n = len(games)
+
+    weight = pd.to_numeric(games['averageweight'], errors='coerce').to_numpy(dtype=float)
+    valid = np.flatnonzero(weight > 0)
+    rows.append(valid)
+    columns.append(np.clip(np.rint(weight[valid] * 2).astype(np.int64), 1, WEIGHT_BINS) - 1)
+    values.append(np.full(len(valid), SIMILARITY_WEIGHTS['weight']))
+
+    #  One feature for each player count that the game supports, sharing
+    #  the weight of the player count between them.
+    low = pd.to_numeric(games['minplayers'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    high = pd.to_numeric(games['maxplayers'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    low, high = np.clip(low, 1, MAX_PLAYERS_BIN), np.clip(np.maximum(high, low), 1, MAX_PLAYERS_BIN)
+    known = (pd.to_numeric(games['minplayers'], errors='coerce').fillna(0).to_numpy() > 0)
+    lengths = np.where(known, high - low + 1, 0)
+    game_rows = np.repeat(np.arange(n), lengths)
+    first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows.append(game_rows)
+    columns.append(WEIGHT_BINS + np.repeat(low, lengths) - 1 + np.arange(lengths.sum()) - first)
+    values.append(SIMILARITY_WEIGHTS['players'] / np.sqrt(np.repeat(np.maximum(lengths, 1), lengths)))
+
+    playtime = pd.to_numeric(games['playingtime'], errors='coerce').to_numpy(dtype=float)
+    valid = np.flatnonzero(playtime > 0)
+    rows.append(valid)
+    columns.append(WEIGHT_BINS + MAX_PLAYERS_BIN + np.searchsorted(PLAYTIME_BINS, playtime[valid]))
+    values.append(np.full(len(valid), SIMILARITY_WEIGHTS['playtime']))
+
+    return np.concatenate(rows), np.concatenate(columns), np.concatenate(values)
+
+
+def _topk(sims, rows, k):
+    '''Return the (neighbours, scores) arrays of the k most similar games for
+       each row of a dense block of similarities, where rows are the games of
+       the block (which are excluded from their own neighbours).  If there are
+       fewer than k other games, the remaining neighbours are -1.
+    '''
+    sims[np.arange(len(rows)), rows] = -1
+    if sims.shape[1] > k:
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(sims.shape[1]), (len(rows), 1))
+    scores = np.take_along_axis(sims, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    top, scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(scores, order, axis=1)
+    if top.shape[1] < k:
+        pad = k - top.shape[1]
+        top = np.hstack([top, np.full((len(rows), pad), -1)])
+        scores = np.hstack([scores, np.full((len(rows), pad), -1)])
+    top[scores < 0] = -1
+    return top.astype(np.int32), scores.astype(np.float32)
+
+
+#  The feature matrix (and its transpose) in each worker process.
+_FEATURES = None
+
+
+def _initWorker(features):
+    global _FEATURES
+    _FEATURES = (features, features.T.tocsr())
+
+
+def _topkRows(rows, k):
+    features, transposed = _FEATURES
+    sims = (features[rows] @ transposed).toarray()
+    return rows, _topk(sims, rows, k)
+
+
+class SimilarityIndex():
+    '''A class for the feature vectors of the games (a CSR matrix with a row
+       for each id in self.ids), along with the precomputed neighbours:  the
+       rows (and cosine similarities) of the SIMILARITY_K most similar games
+       to each game, most similar first.
+
+       The feature layout (the terms of each link column and their inverse
+       document frequencies) is fixed when the index is built.  Terms that
+       appear later are ignored until the index is rebuilt.
+    '''
+    def __init__(self, ids, features, neighbours, scores, vocabularies, idf):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.features = features
+        self.neighbours = neighbours
+        self.scores = scores
+        self.vocabularies = vocabularies
+        self.idf = idf
+        self._rows = pd.Index(self.ids)
+
+    def __repr__(self):
+        return f'SimilarityIndex: {len(self.ids)} games, {self.features.shape[1]} features, ' + \
+               f'k={self.neighbours.shape[1]}'
+
+    def _featureMatrix(self, games):
+        '''Return the (unnormalized) feature matrix for a games DataFrame.'''
+        rows, columns, values = [], [], []
+        offset = 0
+        for column in _LINKS:
+            idf = self.idf[column]
+            codes = [self.vocabularies[column].encode(terms) for terms in games[column]]
+            lengths = np.fromiter((len(c) for c in codes), dtype=np.int64, count=len(codes))
+            codes = np.concatenate(codes) if len(codes) else np.zeros(0, dtype=np.int32)
+            game_rows = np.repeat(np.arange(len(games)), lengths)
+            known = codes >= 0
+            rows.append(game_rows[known])
+            columns.append(offset + codes[known])
+            values.append(SIMILARITY_WEIGHTS[column] * idf[codes[known]])
+            offset += len(idf)
+        number_rows, number_columns, number_values = _numberFeatures(games)
+        rows.append(number_rows)
+        columns.append(offset + number_columns)
+        values.append(number_values)
+        size = offset + WEIGHT_BINS + MAX_PLAYERS_BIN + len(PLAYTIME_BINS) + 1
+        return sp.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                             shape=(len(games), size), dtype=np.float32)
+
+    @classmethod
+    def from_games(cls, games, k=SIMILARITY_K, max_workers=None):
+        '''Build the index for a games DataFrame (indexed by the game id),
+           e.g. GameStore().load().
+        '''
+        vocabularies, idf = dict(), dict()
+        for column in _LINKS:
+            vocabulary = Vocabulary()
+            #  The number of games with each term (counting each term once per game)
+            codes = [np.unique(vocabulary.encode(terms, add=True)) for terms in games[column]]
+            counts = np.bincount(np.concatenate(codes + [np.zeros(0, dtype=np.int32)]),
+                                 minlength=len(vocabulary))
+            vocabularies[column] = vocabulary
+            idf[column] = np.log((1 + len(games)) / (1 + counts)).astype(np.float32) + 1
+        index = cls(games.index, None, None, None, vocabularies, idf)
+        index.features = _normalize(index._featureMatrix(games))
+        index.neighbours = np.full((len(games), k), -1, dtype=np.int32)
+        index.scores = np.full((len(games), k), -1, dtype=np.float32)
+        index._compute(np.arange(len(games)), max_workers)
+        return index
+
+    def _compute(self, rows, max_workers=None):
+        '''(Re)compute the neighbours of the given rows, in blocks of
+           SIMILARITY_BLOCK rows across a pool of processes.
+        '''
+        k = self.neighbours.shape[1]
+        blocks = [rows[i:i+SIMILARITY_BLOCK] for i in range(0, len(rows), SIMILARITY_BLOCK)]
+        if len(blocks) <= 1 or max_workers == 1:
+            _initWorker(self.features)
+            results = [_topkRows(block, k) for block in blocks]
+        else:
+            #  Not forked, as this runs in the (threaded) daemon too, see
+            #  pipeline.py (imported here, since it imports this module)
+            from pipeline import _context
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=_context(),
+                                     initializer=_initWorker, initargs=(self.features,)) as executor:
+                results = list(executor.map(_topkRows, blocks, [k] * len(blocks)))
+        for block, (neighbours, scores) in results:
+            self.neighbours[block] = neighbours
+            self.scores[block] = scores
+
+    def neighbours_of(self, bggGameId):
+        '''Return a Series of the similarities of the most similar games to
+           a game, indexed by their game ids.
+        '''
+        row = self._rows.get_loc(bggGameId)
+        found = self.neighbours[row] >= 0
+        return pd.Series(self.scores[row][found], index=pd.Index(self.ids[self.neighbours[row][found]], name='id'),
+                         name='similarity')
+
+    def _seedMatrix(self, seed_lists):
+        rows, columns = [], []
+        for i, seeds in enumerate(seed_lists):
+            found = self._rows.get_indexer(np.asarray(list(seeds), dtype=np.int64))
+            found = np.unique(found[found >= 0])
+            rows.append(np.full(len(found), i))
+            columns.append(found)
+        rows, columns = np.concatenate(rows + [[]]).astype(np.int64), np.concatenate(columns + [[]]).astype(np.int64)
+        return sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, columns)),
+                             shape=(len(seed_lists), len(self.ids)))
+
+    def recommend_many(self, seed_lists, n=10, exclude_seeds=True):
+        '''"More like these games", for many sets of games at once:  return a
+           list (one for each set of game ids in seed_lists) of Series of the
+           n games most similar to the set, as a whole, with their scores.
+
+           The scores of the games for a batch of sets are (seeds @ F) @ F.T,
+           where seeds is the sparse indicator matrix of the sets and F the
+           feature matrix, so the batch is handled by two sparse products.
+        '''
+        transposed = self.features.T.tocsr()
+        results = []
+        for start in range(0, len(seed_lists), SIMILARITY_BLOCK):
+            seeds = self._seedMatrix(seed_lists[start:start+SIMILARITY_BLOCK])
+            profiles = seeds @ self.features
+            scores = (profiles @ transposed).toarray()
+            counts = np.maximum(np.asarray(seeds.sum(axis=1)).ravel(), 1)
+            scores /= counts[:, None]
+            if exclude_seeds:
+                scores[seeds.nonzero()] = -np.inf
+            if scores.shape[1] > n:
+                top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+            else:
+                top = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+            order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            for row in range(len(scores)):
+                keep = top[row][np.isfinite(scores[row, top[row]]) & (scores[row, top[row]] > 0)]
+                results.append(pd.Series(scores[row, keep], index=pd.Index(self.ids[keep], name='id'),
+                                         name='similarity'))
+        return results
+
+    def recommend(self, games, n=10, exclude_seeds=True):
+        '''Return a Series of the n games most similar to the set of games.'''
+        return self.recommend_many([games], n, exclude_seeds)[0]
+
+    def recommend_for_user(self, user, n=10, source='own'):
+        '''Return the games most similar to a User's collection, using the
+           games from one of its filters (e.g. 'own' or 'has_rating').
+        '''
+        return self.recommend(getattr(user, source)().index, n)
+
+    def update_games(self, games, max_workers=None):
+        '''Update the index for new or changed games (a games DataFrame, e.g.
+           the result of getGame).  Only the neighbour lists that can change
+           are recomputed:  those of the games themselves, and of the games
+           that had one of them as a neighbour.  Any other game gets one of
+           them as a neighbour if it is more similar than its current least
+           similar neighbour.
+        '''
+        games = games[~games.index.duplicated(keep='last')]
+        k = self.neighbours.shape[1]
+        new_ids = np.setdiff1d(games.index.to_numpy(dtype=np.int64), self.ids)
+        size = len(self.ids) + len(new_ids)
+        self.ids = np.concatenate([self.ids, new_ids])
+        self._rows = pd.Index(self.ids)
+        self.neighbours = np.vstack([self.neighbours, np.full((len(new_ids), k), -1, dtype=np.int32)])
+        self.scores = np.vstack([self.scores, np.full((len(new_ids), k), -1, dtype=np.float32)])
+
+        #  Swap in the new feature rows for the games
+        changed = self._rows.get_indexer(games.index)
+        old = sp.csr_matrix((self.features.data, self.features.indices, self.features.indptr),
+                            shape=self.features.shape)
+        old.resize((size, old.shape[1]))
+        keep = np.ones(size, dtype=np.float32)
+        keep[changed] = 0
+        new = _normalize(self._featureMatrix(games))
+        placed = sp.csr_matrix((np.ones(len(changed), dtype=np.float32), (changed, np.arange(len(changed)))),
+                               shape=(size, len(changed)))
+        self.features = (sp.diags(keep) @ old + placed @ new).tocsr().astype(np.float32)
+
+        #  Games that had a changed game as a neighbour are recomputed in full
+        #  (since that game may now be less similar than some other game).
+        dirty = np.isin(self.neighbours, changed).any(axis=1)
+        touched = np.zeros(size, dtype=bool)
+        lowest = self.scores.argmin(axis=1)
+        everything = np.arange(size)
+        for start in range(0, len(changed), SIMILARITY_BLOCK):
+            block = changed[start:start+SIMILARITY_BLOCK]
+            sims = (self.features[block] @ self.features.T).toarray()
+            for i, row in enumerate(block):
+                column = sims[i].copy()
+                column[row] = -1
+                column[changed] = -1    # handled below, since they're dirty
+                better = np.flatnonzero((column > self.scores[everything, lowest]) & ~dirty)
+                self.neighbours[better, lowest[better]] = row
+                self.scores[better, lowest[better]] = column[better]
+                lowest[better] = self.scores[better].argmin(axis=1)
+                touched[better] = True
+        dirty[changed] = True
+        self._compute(np.flatnonzero(dirty), max_workers)
+
+        #  Keep the neighbours of the games that gained one sorted
+        touched = np.flatnonzero(touched & ~dirty)
+        order = np.argsort(-self.scores[touched], axis=1, kind='stable')
+        self.neighbours[touched] = np.take_along_axis(self.neighbours[touched], order, axis=1)
+        self.scores[touched] = np.take_along_axis(self.scores[touched], order, axis=1)
+
+    def save(self, path=SIMILARITY_DATA):
+        '''Save the index, writing every file to a temporary file first and
+           then renaming each over the old one, since the server has the
+           arrays memory-mapped while the runs update them.
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = {'ids': self.ids, 'neighbours': self.neighbours, 'scores': self.scores}
+        for component in ['data', 'indices', 'indptr']:
+            arrays[f'features-{component}'] = getattr(self.features, component)
+        for column in _LINKS:
+            arrays[f'{column}-idf'] = self.idf[column]
+        files = []
+        for name, array in arrays.items():
+            with open(f'{path}/{name}.npy.tmp', 'wb') as f:
+                np.save(f, array)
+            files.append(f'{path}/{name}.npy')
+        for column in _LINKS:
+            filename = f'{path}/{column}-vocabulary.parquet'
+            self.vocabularies[column].to_frame().to_parquet(f'{filename}.tmp')
+            files.append(filename)
+        for filename in files:
+            os.replace(f'{filename}.tmp', filename)
+
+    @classmethod
+    def load(cls, path=SIMILARITY_DATA, mmap_mode='r'):
+        '''Load a saved index, with the arrays memory-mapped by default (use
+           mmap_mode=None for an index that is going to be updated).
+        '''
+        ids = np.load(f'{path}/ids.npy', mmap_mode=mmap_mode)
+        data, indices, indptr = [np.load(f'{path}/features-{component}.npy', mmap_mode=mmap_mode)
+                                 for component in ['data', 'indices', 'indptr']]
+        vocabularies, idf = dict(), dict()
+        for column in _LINKS:
+            idf[column] = np.load(f'{path}/{column}-idf.npy')
+            vocabularies[column] = Vocabulary.from_frame(
+                pd.read_parquet(f'{path}/{column}-vocabulary.parquet'))
+        size = sum(len(idf[c]) for c in _LINKS) + WEIGHT_BINS + MAX_PLAYERS_BIN + len(PLAYTIME_BINS) + 1
+        features = sp.csr_matrix((data, indices, indptr), shape=(len(ids), size), copy=False)
+        return cls(ids, features, np.load(f'{path}/neighbours.npy', mmap_mode=mmap_mode),
+                   np.load(f'{path}/scores.npy', mmap_mode=mmap_mode), vocabularies, idf)
+
+
+def update_similarity(games, path=SIMILARITY_DATA, index=None):
+    '''Update the saved similarity index (if there is one) for new or
+       changed games, and return it (or None).  An index kept in memory
+       (loaded with mmap_mode=None) can be given, rather than loading it.
+    '''
+    if index is None:
+        if not os.path.exists(f'{path}/ids.npy'):
+            return None
+        index = SimilarityIndex.load(path, mmap_mode=None)
+    index.update_games(games)
+    index.save(path)
+    return index
@@ -0,0 +1,187 @@
+#  The Geekbuddy lists of all of the users (as saved by User.geekbuddies) put
+#  together into one graph, stored as a CSR adjacency structure:  each user is
+#  a node (numbered by their position in self.names), and the buddies of node
+#  i are indices[indptr[i]:indptr[i+1]].  Expanding a set of users to their
+#  buddies (and the buddies of those) is then a matter of gathering slices of
+#  one array, and the "social" scores of the games (the ratings of a user's
+#  buddies, weighted by how close each buddy is to the user) are a sparse
+#  matrix-vector product.
+
+import glob
+import os
+import re
+import weakref
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+import dill
+
+from constants import GEEKBUDDIES_DATA, SOCIAL_GRAPH_DATA, SOCIAL_DECAY, SOCIAL_SHRINKAGE
+
+
+class SocialGraph():
+    '''A class for the Geekbuddy graph:  the usernames (and BGG user ids,
+       -1 where unknown) of the nodes, and the CSR adjacency structure
+       (indptr, and int32 indices of the buddies of each node).
+    '''
+    def __init__(self, names, bgg_ids, indptr, indices):
+        self.names = np.asarray(names)
+        self.bgg_ids = np.asarray(bgg_ids, dtype=np.int64)
+        self.adjacency = sp.csr_matrix((np.ones(len(indices), dtype=np.float32),
+                                        np.asarray(indices, dtype=np.int32),
+                                        np.asarray(indptr, dtype=np.int64)),
+                                       shape=(len(self.names), len(self.names)), copy=False)
+        self._nodes = pd.Index(self.names)
+        self._rows = weakref.WeakKeyDictionary()
+
+    def __repr__(self):
+        return f'SocialGraph: {len(self.names)} users, {self.adjacency.nnz} edges'
+
+    @classmethod
+    def from_buddies(cls, buddies, symmetric=True):
+        '''Build the graph from a dictionary of {username: list of (name, id)
+           of their Geekbuddies}.  With symmetric=True, a user is connected
+           to anyone that has them as a Geekbuddy, as well as their own.
+        '''
+        names, bgg_ids, codes = [], [], dict()
+
+        def code(name, bgg_id=-1):
+            node = codes.get(name)
+            if node is None:
+                node = codes[name] = len(names)
+                names.append(name)
+                bgg_ids.append(-1)
+            if bgg_id != -1 and bgg_ids[node] == -1:
+                bgg_ids[node] = bgg_id
+            return node
+
+        sources, targets = [], []
+        for username, found in buddies.items():
+            node = code(username)
+            for name, bgg_id in found:
+                sources.append(node)
+                targets.append(code(name, int(bgg_id) if bgg_id is not None else -1))
+        sources = np.array(sources, dtype=np.int64)
+        targets = np.array(targets, dtype=np.int64)
+        if symmetric:
+            sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+        n = len(names)
+        #  Drop repeated edges (and self loops) by sorting the edges as numbers
+        edges = np.unique(sources[sources != targets] * n + targets[sources != targets])
+        sources, targets = edges // max(n, 1), edges % max(n, 1)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+        return cls(np.array(names, dtype=object), bgg_ids, indptr, targets.astype(np.int32))
+
+    @classmethod
+    def from_files(cls, pattern=f'{GEEKBUDDIES_DATA}/*-*.dill', symmetric=True):
+        '''Build the graph from the most recently saved Geekbuddies of every
+           user (from User.geekbuddies).
+        '''
+        latest = dict()
+        for name in sorted(glob.glob(pattern)):
+            match = re.search(r'([^/\\]+)-(\d{8}-\d{4})\.dill$', name)
+            if match:
+                latest[match.group(1)] = name
+        buddies = dict()
+        for username, name in latest.items():
+            with open(name, 'rb') as f:
+                buddies[username] = dill.load(f)
+        return cls.from_buddies(buddies, symmetric)
+
+    def nodes(self, usernames):
+        '''Return an array of the nodes of the users (-1 if not in the graph).'''
+        if isinstance(usernames, str):
+            usernames = [usernames]
+        return self._nodes.get_indexer(list(usernames))
+
+    def buddies(self, username):
+        '''Return the usernames of the Geekbuddies of a user.'''
+        node = self.nodes(username)[0]
+        if node < 0:
+            return []
+        return list(self.names[self.adjacency.indices[self.adjacency.indptr[node]:self.adjacency.indptr[node+1]]])
+
+    def _expand(self, nodes):
+        #  All of the buddies of the nodes (with repeats), by taking the
+        #  slices of the indices for the nodes in one go
+        indptr, indices = self.adjacency.indptr, self.adjacency.indices
+        starts, lengths = indptr[nodes], indptr[nodes + 1] - indptr[nodes]
+        offsets = np.cumsum(lengths) - lengths
+        return indices[np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())]
+
+    def hops(self, usernames, max_hops=2):
+        '''Return an int8 array over the nodes of the number of hops from the
+           given users to each node (0 for the users, -1 if not reached within
+           max_hops).
+        '''
+        distance = np.full(len(self.names), -1, dtype=np.int8)
+        frontier = self.nodes(usernames)
+        frontier = np.unique(frontier[frontier >= 0])
+        distance[frontier] = 0
+        for hop in range(1, max_hops + 1):
+            reached = self._expand(frontier)
+            frontier = np.unique(reached[distance[reached] < 0])
+            distance[frontier] = hop
+        return distance
+
+    def neighbourhood(self, usernames, max_hops=2):
+        '''Return a Series of the number of hops to every user within max_hops
+           of the given users (not including themselves), indexed by username.
+        '''
+        distance = self.hops(usernames, max_hops)
+        reached = np.flatnonzero(distance > 0)
+        return pd.Series(distance[reached], index=pd.Index(self.names[reached], name='username'),
+                         name='hops')
+
+    def _matrixRows(self, matrix):
+        #  The row of each node in a RatingMatrix (-1 if not there), and the
+        #  average of all of its ratings, kept for as long as the matrix is
+        if matrix not in self._rows:
+            self._rows[matrix] = (matrix.user_index().get_indexer(self.names),
+                                  float(matrix.ratings.sum() / max(matrix.ratings.nnz, 1)))
+        return self._rows[matrix]
+
+    def social_scores(self, username, matrix, max_hops=2, decay=SOCIAL_DECAY,
+                      shrinkage=SOCIAL_SHRINKAGE, prior=None):
+        '''Return a DataFrame (indexed by game id) of the social score of the
+           games for a user:  the average of the ratings (in a RatingMatrix)
+           of the users within max_hops of them, weighted by decay ** (hops - 1)
+           and shrunk towards the prior (the average rating of everyone, by
+           default) by shrinkage "virtual" ratings.  The total weight of the
+           ratings is given as the support, and the games without any
+           ratings from the neighbourhood are left out.
+        '''
+        distance = self.hops(username, max_hops)
+        rows, average = self._matrixRows(matrix)
+        reached = np.flatnonzero((distance > 0) & (rows >= 0))
+        weights = decay ** (distance[reached].astype(np.float32) - 1)
+
+        #  Only the rows of the users in the neighbourhood are needed
+        ratings = matrix.ratings[rows[reached]]
+        totals = ratings.T @ weights
+        rated = sp.csr_matrix((np.ones(ratings.nnz, dtype=np.float32), ratings.indices, ratings.indptr),
+                              shape=ratings.shape)
+        support = rated.T @ weights
+        if prior is None:
+            prior = average
+        games = np.flatnonzero(support > 0)
+        return pd.DataFrame({'score': (totals[games] + shrinkage * prior) / (support[games] + shrinkage),
+                             'support': support[games]},
+                            index=pd.Index(matrix.games[games], name='id')).sort_values(
+                                'score', ascending=False)
+
+    def save(self, path=SOCIAL_GRAPH_DATA):
+        os.makedirs(path, exist_ok=True)
+        np.save(f'{path}/names.npy', self.names.astype(str))
+        np.save(f'{path}/bgg_ids.npy', self.bgg_ids)
+        np.save(f'{path}/indptr.npy', self.adjacency.indptr)
+        np.save(f'{path}/indices.npy', self.adjacency.indices)
+
+    @classmethod
+    def load(cls, path=SOCIAL_GRAPH_DATA, mmap_mode='r'):
+        '''Load a saved graph, with the arrays memory-mapped by default.'''
+        return cls(*[np.load(f'{path}/{name}.npy', mmap_mode=mmap_mode)
+                     for name in ['names', 'bgg_ids', 'indptr', 'indices']])
@@ -0,0 +1,200 @@
+#  The history of the statistics of the games (number of ratings, average
+#  and Bayes average rating, rank and weight), which the game store only
+#  keeps the latest values of.  Every time games are fetched, a row for each
+#  game is appended to the history, as a new Parquet file in the directory
+#  for the month, so that old data is never rewritten (other than by
+#  compact, which merges the files of a month that is over, as the update
+#  runs do for every month that has ended, see compact_finished).
+#
+#  The files are sorted by game id and use Parquet's delta encoding for the
+#  integer columns (the ids, times, numbers of ratings and ranks, which
+#  change little from one row to the next), and byte stream split encoding
+#  for the floats, which compress much better than the defaults.
+#
+#  The queries (the values as of a time, the changes over a period, the top
+#  risers and the rate of change of each game) are vectorized over all of
+#  the games at once, and only read the months (and columns) they need.
+
+import glob
+import os
+import re
+
+import pandas as pd
+import numpy as np
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datetime import datetime, timedelta
+
+from constants import STATS_HISTORY_DATA
+
+#  The statistics kept in the history, and their types
+HISTORY_COLUMNS = {'numratings': pa.int32(), 'averating': pa.float32(),
+                   'bayesaverage': pa.float32(), 'bggrank': pa.int32(),
+                   'averageweight': pa.float32()}
+
+_SCHEMA = pa.schema([('id', pa.int64()), ('time', pa.timestamp('ms'))] +
+                    list(HISTORY_COLUMNS.items()))
+
+_ENCODINGS = {name: 'DELTA_BINARY_PACKED' if pa.types.is_integer(t) or pa.types.is_timestamp(t)
+              else 'BYTE_STREAM_SPLIT' for name, t in zip(_SCHEMA.names, _SCHEMA.types)}
+
+
+class StatsHistory():
+    '''A class for the append-only history of the game statistics, kept as
+       Parquet files in a directory for each month (month=YYYY-MM).
+    '''
+    def __init__(self, path=STATS_HISTORY_DATA):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return f'StatsHistory: {self.path} ({len(self.months())} months)'
+
+    def months(self):
+        '''Return the (sorted) months in the history, as "YYYY-MM".'''
+        return sorted(re.search(r'month=(\d{4}-\d{2})$', d).group(1)
+                      for d in glob.glob(f'{self.path}/month=*'))
+
+    def _files(self, since=None, until=None):
+        first = since.strftime('%Y-%m') if since is not None else None
+        last = until.strftime('%Y-%m') if until is not None else None
+        files = []
+        for month in self.months():
+            if (first is None or month >= first) and (last is None or month <= last):
+                files.extend(sorted(glob.glob(f'{self.path}/month={month}/*.parquet')))
+        return files
+
+    @staticmethod
+    def _write(table, filename):
+        pq.write_table(table, f'{filename}.tmp', compression='zstd', use_dictionary=False,
+                       column_encoding=_ENCODINGS)
+        os.replace(f'{filename}.tmp', filename)
+
+    def append(self, games, now=None):
+        '''Append the statistics of the games (a DataFrame indexed by game
+           id, e.g. from getGame) as observed at a time (now, by default).
+           Appending the same games at the same time again just replaces
+           the file written the first time, so that a replayed chunk (see
+           run_log.py) isn't recorded twice.
+        '''
+        if not len(games):
+            return
+        now = now or datetime.now()
+        games = games.sort_index()
+        columns = {'id': pa.array(games.index.to_numpy(dtype=np.int64)),
+                   'time': pa.array(np.full(len(games), np.datetime64(now, 'ms')))}
+        for column, kind in HISTORY_COLUMNS.items():
+            values = pd.to_numeric(games[column], errors='coerce') if column in games else \
+                     pd.Series(np.nan, index=games.index)
+            columns[column] = pa.array(values.to_numpy(dtype=np.float64),
+                                       mask=values.isna().to_numpy()).cast(kind)
+        directory = f'{self.path}/month={now:%Y-%m}'
+        os.makedirs(directory, exist_ok=True)
+        self._write(pa.table(columns, schema=_SCHEMA), f'{directory}/part-{now:%Y%m%dT%H%M%S%f}.parquet')
+
+    def compact(self, month):
+        '''Merge the files of a month (that is over) into one, sorted by game
+           id and time.
+        '''
+        files = sorted(glob.glob(f'{self.path}/month={month}/part-*.parquet'))
+        if len(files) < 2:
+            return
+        table = pa.concat_tables(pq.read_table(f, schema=_SCHEMA) for f in files)
+        table = table.sort_by([('id', 'ascending'), ('time', 'ascending')])
+        compacted = f'{self.path}/month={month}/part-{month.replace("-", "")}.parquet'
+        self._write(table, compacted)
+        #  Until the old files are removed their rows are duplicated, which
+        #  load ignores.
+        for f in files:
+            if f != compacted:
+                os.remove(f)
+
+    def compact_finished(self, now=None):
+        '''Compact every month before the current one (now, by default) that
+           still has more than one file, and return those months.
+        '''
+        current = (now or datetime.now()).strftime('%Y-%m')
+        months = [month for month in self.months() if month < current and
+                  len(glob.glob(f'{self.path}/month={month}/part-*.parquet')) > 1]
+        for month in months:
+            self.compact(month)
+        return months
+
+    def load(self, since=None, until=None, ids=None, columns=None):
+        '''Return a DataFrame of the observations (with columns id, time and
+           the statistics) between the times since and until, sorted by game
+           id and time.
+        '''
+        columns = ['id', 'time'] + (list(columns) if columns is not None else list(HISTORY_COLUMNS))
+        filters = []
+        if since is not None:
+            filters.append(('time', '>=', pd.Timestamp(since)))
+        if until is not None:
+            filters.append(('time', '<=', pd.Timestamp(until)))
+        if ids is not None:
+            filters.append(('id', 'in', [int(i) for i in ids]))
+        files = self._files(since, until)
+        if not files:
+            return pd.DataFrame({c: pd.Series(dtype=_SCHEMA.field(c).type.to_pandas_dtype())
+                                 for c in columns})
+        table = pq.read_table(files, columns=columns, filters=filters or None, schema=_SCHEMA)
+        observed = table.sort_by([('id', 'ascending'), ('time', 'ascending')]).to_pandas()
+        return observed.drop_duplicates(['id', 'time'], keep='last', ignore_index=True)
+
+    @staticmethod
+    def _last(observed, column, when=None):
+        #  The last value of each game observed (at or before when)
+        if when is not None:
+            observed = observed[observed['time'] <= pd.Timestamp(when)]
+        last = observed.drop_duplicates('id', keep='last')
+        return pd.Series(last[column].to_numpy(), index=pd.Index(last['id'], name='id'),
+                         name=column)
+
+    def at(self, when, column, lookback=timedelta(days=90)):
+        '''Return a Series (indexed by game id) of the last value of a
+           statistic observed at or before a time, looking back at most
+           lookback.  Games without a value in that period are left out.
+        '''
+        observed = self.load(when - lookback, when, columns=[column]).dropna(subset=[column])
+        return self._last(observed, column)
+
+    def change(self, column, days=30, now=None, lookback=timedelta(days=90)):
+        '''Return a Series of the change in a statistic over the last days,
+           for the games observed both then and now (as for at).
+        '''
+        now = now or datetime.now()
+        then = now - timedelta(days=days)
+        observed = self.load(then - lookback, now, columns=[column]).dropna(subset=[column])
+        new = self._last(observed[observed['time'] >= pd.Timestamp(now - lookback)], column)
+        new, old = new.align(self._last(observed, column, then), join='inner')
+        return (new.astype(float) - old.astype(float)).rename(column)
+
+    def top_risers(self, days=30, n=20, column='bggrank', now=None):
+        '''Return the n games whose statistic rose the most over the last
+           days, i.e. whose rank improved (went down) by the most places, or
+           whose other statistic went up the most, with the size of the rise.
+        '''
+        change = self.change(column, days, now)
+        rise = -change if column == 'bggrank' else change
+        return rise[rise > 0].nlargest(n).rename('rise')
+
+    def velocity(self, column='averating', days=30, now=None, min_observations=2):
+        '''Return a Series of the rate of change (per day) of a statistic for
+           each game, as the least squares slope of its observations over the
+           last days, for the games with at least min_observations of them.
+        '''
+        now = now or datetime.now()
+        observed = self.load(now - timedelta(days=days), now, columns=[column]).dropna(subset=[column])
+        ids, codes = np.unique(observed['id'].to_numpy(), return_inverse=True)
+        x = (observed['time'] - pd.Timestamp(now)).dt.total_seconds().to_numpy() / 86400
+        y = observed[column].to_numpy(dtype=np.float64)
+        count = np.bincount(codes, minlength=len(ids))
+        sx, sy = np.bincount(codes, x, len(ids)), np.bincount(codes, y, len(ids))
+        sxx, sxy = np.bincount(codes, x * x, len(ids)), np.bincount(codes, x * y, len(ids))
+        denominator = count * sxx - sx * sx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (count * sxy - sx * sy) / denominator
+        keep = (count >= min_observations) & (denominator > 1e-12)
+        return pd.Series(slope[keep], index=pd.Index(ids[keep], name='id'), name='velocity')
@@ -0,0 +1,298 @@
+#  A compact representation of the "link" columns of the games DataFrame
+#  (categories, mechanics, family, designer, artist and publisher).  Rather
+#  than a Python list of strings in every row, each column is stored as a
+#  ragged array of int32 codes into a vocabulary of the names (along with
+#  their BGG ids, where known), with an inverted index from each term to the
+#  games that have it.  This makes queries like "games with mechanic X"
+#  vectorized, and is much smaller in memory than the lists of strings.
+#
+#  The taxonomy of the catalog is saved (in TAXONOMY_DATA) alongside the other
+#  indexes, and kept current by the update runs (see pipeline.py); the
+#  recommendation server filters by it.  The game store itself keeps the
+#  lists, which Parquet already stores dictionary encoded, since the other
+#  indexes are built from them.  As the store only has the names, the BGG ids
+#  of the terms come from the lists of categories and mechanics that BGG uses
+#  (see seed_vocabularies), and from the <link>s of the games fetched by the
+#  runs, as they are parsed.
+
+import os
+import dill
+
+import pandas as pd
+import numpy as np
+
+from constants import EXTRA_DATA, TAXONOMY_DATA
+from api_functions import getBGGCategories, getBGGMechanisms
+
+LINK_COLUMNS = ['categories', 'mechanics', 'family', 'designer', 'artist', 'publisher']
+
+
+class Vocabulary():
+    '''A class for the terms of one link column:  each term has a code
+       (its position in the vocabulary), a name and a BGG id (-1 if unknown).
+    '''
+    def __init__(self, names=None, bgg_ids=None):
+        self.names = list(names) if names is not None else []
+        self.bgg_ids = list(bgg_ids) if bgg_ids is not None else [-1] * len(self.names)
+        self.codes = {name: code for code, name in enumerate(self.names)}
+
+    def __repr__(self):
+        return f'Vocabulary: {len(self)} terms'
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, bgg_id=-1):
+        '''Add a term (if it isn't already there), and return its code.'''
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+            self.bgg_ids.append(int(bgg_id))
+        elif bgg_id != -1 and self.bgg_ids[code] == -1:
+            self.bgg_ids[code] = int(bgg_id)
+        return code
+
+    def merge(self, other):
+        '''Add the terms of another vocabulary (and any BGG ids that this one
+           doesn't have yet), keeping the codes of the terms already here.
+        '''
+        for name, bgg_id in zip(other.names, other.bgg_ids):
+            self.add(name, bgg_id)
+
+    def encode(self, names, add=False):
+        '''Return an int32 array of the codes of the names, where unknown
+           names are either added (add=True) or given the code -1.
+        '''
+        if add:
+            return np.array([self.add(n) for n in names], dtype=np.int32)
+        return np.array([self.codes.get(n, -1) for n in names], dtype=np.int32)
+
+    def decode(self, codes):
+        '''Return the list of names for the codes.'''
+        return [self.names[c] for c in codes]
+
+    def to_frame(self):
+        return pd.DataFrame({'name': self.names, 'bgg_id': np.array(self.bgg_ids, dtype=np.int64)},
+                            index=pd.RangeIndex(len(self), name='code'))
+
+    @classmethod
+    def from_frame(cls, frame):
+        return cls(frame['name'].tolist(), frame['bgg_id'].tolist())
+
+
+class RaggedArray():
+    '''A class for a list of variable length lists of integers, stored as
+       a flat array of int32 values along with an array of offsets, so that
+       row i is values[offsets[i]:offsets[i+1]].
+    '''
+    def __init__(self, offsets, values):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int32)
+
+    def __repr__(self):
+        return f'RaggedArray: {len(self)} rows, {len(self.values)} values'
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def rows(self):
+        '''Return the row number of each of the values.'''
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.lengths())
+
+    @classmethod
+    def from_lists(cls, lists):
+        lengths = np.fromiter((len(x) for x in lists), dtype=np.int64, count=len(lists))
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((v for x in lists for v in x), dtype=np.int32, count=int(offsets[-1]))
+        return cls(offsets, values)
+
+    def take(self, rows):
+        '''Return a new RaggedArray with just the given rows (in that order).'''
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.lengths()[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        #  The position in self.values of every value of the selected rows
+        positions = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(offsets, self.values[positions])
+
+    def concat(self, other):
+        return RaggedArray(np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]),
+                           np.concatenate([self.values, other.values]))
+
+    def invert(self, size):
+        '''Return the inverted RaggedArray, i.e. where row v holds the (sorted)
+           rows of this array that contain the value v, for v in range(size).
+        '''
+        order = np.argsort(self.values, kind='stable')
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.values, minlength=size), out=offsets[1:])
+        return RaggedArray(offsets, self.rows()[order])
+
+
+class Taxonomy():
+    '''A class for the link columns of a set of games, as a RaggedArray of
+       vocabulary codes for each column, with rows in the order of self.ids
+       (the BGG game ids), and inverted indexes from each term to the rows
+       that have it (built when first needed).
+    '''
+    def __init__(self, ids, vocabularies, columns):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vocabularies = vocabularies
+        self.columns = columns
+        self._inverted = dict()
+        self._rows = pd.Index(self.ids)
+
+    def __repr__(self):
+        return f'Taxonomy: {len(self.ids)} games, ' + \
+               ', '.join(f'{c} ({len(self.vocabularies[c])})' for c in self.columns)
+
+    @classmethod
+    def from_games(cls, games, vocabularies=None):
+        '''Build the taxonomy from the link columns of a games DataFrame
+           (indexed by the game id), adding any new terms to the vocabularies.
+        '''
+        vocabularies = vocabularies if vocabularies is not None else dict()
+        columns = dict()
+        for column in LINK_COLUMNS:
+            vocabulary = vocabularies.setdefault(column, Vocabulary())
+            columns[column] = RaggedArray.from_lists(
+                [vocabulary.encode(terms, add=True) for terms in games[column]])
+        return cls(games.index, vocabularies, columns)
+
+    def update(self, games):
+        '''Replace (or add) the rows for the games in the DataFrame.'''
+        keep = np.flatnonzero(~np.isin(self.ids, games.index))
+        new = Taxonomy.from_games(games, self.vocabularies)
+        self.columns = {c: self.columns[c].take(keep).concat(new.columns[c]) for c in LINK_COLUMNS}
+        self.ids = np.concatenate([self.ids[keep], new.ids])
+        self._rows = pd.Index(self.ids)
+        self._inverted = dict()
+
+    def inverted(self, column):
+        '''Return the inverted index (term code -> rows) for a column.'''
+        if column not in self._inverted:
+            self._inverted[column] = self.columns[column].invert(len(self.vocabularies[column]))
+        return self._inverted[column]
+
+    def mask(self, column, terms, match='any'):
+        '''Return a boolean array over the rows (games) of whether each game
+           has any (match='any') or all (match='all') of the terms.
+        '''
+        if isinstance(terms, str):
+            terms = [terms]
+        codes = self.vocabularies[column].encode(terms)
+        inverted = self.inverted(column)
+        counts = np.zeros(len(self.ids), dtype=np.int32)
+        for code in codes:
+            if code >= 0:
+                counts[inverted[code]] += 1
+        if match == 'all':
+            return counts == len(codes)
+        return counts > 0
+
+    def games_with(self, column, terms, match='any'):
+        '''Return an array of the ids of the games with any (or all) of the terms.'''
+        return np.sort(self.ids[self.mask(column, terms, match)])
+
+    def terms(self, bggGameId, column):
+        '''Return the list of terms of a column for a game.'''
+        return self.vocabularies[column].decode(self.columns[column][self._rows.get_loc(bggGameId)])
+
+    def to_lists(self, column):
+        '''Return a column as a Series (indexed by game id) of lists of names.'''
+        names = np.array(self.vocabularies[column].names, dtype=object)
+        ragged = self.columns[column]
+        return pd.Series([list(names[ragged[i]]) for i in range(len(ragged))],
+                         index=pd.Index(self.ids, name='id'), name=column)
+
+    def save(self, path=TAXONOMY_DATA):
+        '''Save the taxonomy, writing every file to a temporary file first and
+           then renaming each over the old one, since the server has the
+           arrays memory-mapped while the runs update them.
+        '''
+        os.makedirs(path, exist_ok=True)
+        arrays = {'ids': self.ids}
+        for column in LINK_COLUMNS:
+            arrays[f'{column}-offsets'] = self.columns[column].offsets
+            arrays[f'{column}-values'] = self.columns[column].values
+        files = []
+        for name, array in arrays.items():
+            with open(f'{path}/{name}.npy.tmp', 'wb') as f:
+                np.save(f, array)
+            files.append(f'{path}/{name}.npy')
+        for column in LINK_COLUMNS:
+            filename = f'{path}/{column}-vocabulary.parquet'
+            self.vocabularies[column].to_frame().to_parquet(f'{filename}.tmp')
+            files.append(filename)
+        for filename in files:
+            os.replace(f'{filename}.tmp', filename)
+
+    @classmethod
+    def load(cls, path=TAXONOMY_DATA, mmap_mode='r'):
+        '''Load a saved taxonomy, with the arrays memory-mapped by default.'''
+        ids = np.load(f'{path}/ids.npy', mmap_mode=mmap_mode)
+        vocabularies, columns = dict(), dict()
+        for column in LINK_COLUMNS:
+            columns[column] = RaggedArray(np.load(f'{path}/{column}-offsets.npy', mmap_mode=mmap_mode),
+                                          np.load(f'{path}/{column}-values.npy', mmap_mode=mmap_mode))
+            vocabularies[column] = Vocabulary.from_frame(
+                pd.read_parquet(f'{path}/{column}-vocabulary.parquet'))
+        return cls(ids, vocabularies, columns)
+
+
+def update_taxonomy(games, path=TAXONOMY_DATA, vocabularies=None, taxonomy=None):
+    '''Update the saved taxonomy (if there is one) for new or changed games,
+       and return it (or None).  A taxonomy kept in memory (loaded with
+       mmap_mode=None) can be given, rather than loading it.  The BGG ids of
+       the terms are filled in from the seeded vocabularies (see
+       seed_vocabularies), and from the vocabularies given (those recorded
+       while parsing the games, see run_pipeline).
+    '''
+    if taxonomy is None:
+        if not os.path.exists(f'{path}/ids.npy'):
+            return None
+        taxonomy = Taxonomy.load(path, mmap_mode=None)
+    for found in [seed_vocabularies(save=True), vocabularies or dict()]:
+        for column, vocabulary in found.items():
+            taxonomy.vocabularies[column].merge(vocabulary)
+    taxonomy.update(games)
+    taxonomy.save(path)
+    return taxonomy
+
+
+def compact(games, vocabularies=None):
+    '''Split a games DataFrame into the DataFrame without the link columns
+       and a Taxonomy holding those columns.
+    '''
+    return games.drop(columns=LINK_COLUMNS), Taxonomy.from_games(games, vocabularies)
+
+
+def seed_vocabularies(save=False):
+    '''Return vocabularies for the categories and mechanics seeded with all
+       of the terms (and their BGG ids) that BGG uses, from the saved files
+       in EXTRA_DATA if they exist, otherwise retrieved from BGG.
+    '''
+    vocabularies = dict()
+    for column, filename, label, retrieve in [
+            ('categories', 'boardGameCategories.dill', 'category', getBGGCategories),
+            ('mechanics', 'boardGameMechanisms.dill', 'mechanism', getBGGMechanisms)]:
+        if os.path.exists(f'{EXTRA_DATA}/{filename}'):
+            with open(f'{EXTRA_DATA}/{filename}', 'rb') as f:
+                terms = dill.load(f)
+        else:
+            terms = retrieve(save=save)
+        vocabulary = Vocabulary()
+        for bgg_id, name in terms[label].items():
+            vocabulary.add(name, int(bgg_id))
+        vocabularies[column] = vocabulary
+    return vocabularies
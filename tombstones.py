@@ -0,0 +1,91 @@
+#  A compact, persistent record of the BGG ids that we have found to be
+#  "dead" for our purposes:  ids that returned nothing, or that are some other
+#  type of item (accessories, video games, etc.) rather than board games and
+#  expansions.  find_new_games.py skips these ids, other than rechecking each
+#  one occasionally, on a schedule that slows down each time the id is found
+#  to still be dead.
+
+import os
+
+import numpy as np
+
+from datetime import date
+
+from constants import TOMBSTONE_FILE, TOMBSTONE_RECHECK_DAYS, TOMBSTONE_MAX_RECHECK_DAYS
+
+#  Days are counted from this date, so that they fit into a uint16.
+_EPOCH = date(2000, 1, 1)
+
+
+def _today():
+    return (date.today() - _EPOCH).days
+
+
+class TombstoneIndex():
+    '''A class for the set of tombstoned ids, stored as two arrays indexed
+       by the id:  the number of times in a row that the id has been found
+       to be dead (a uint8, where 0 means not tombstoned), and the day it was
+       last checked (a uint16).  That is 3 bytes per id in memory, and much
+       less on disk, since the arrays are saved compressed.
+
+       A tombstoned id is due to be rechecked TOMBSTONE_RECHECK_DAYS after it
+       was last checked, doubling with every further time it is found to be
+       dead, up to TOMBSTONE_MAX_RECHECK_DAYS.
+    '''
+    def __init__(self, path=TOMBSTONE_FILE):
+        self.path = path
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self.strikes = data['strikes']
+                self.checked = data['checked']
+        else:
+            self.strikes = np.zeros(0, dtype=np.uint8)
+            self.checked = np.zeros(0, dtype=np.uint16)
+
+    def __repr__(self):
+        return f'TombstoneIndex: {self.path} ({len(self)} ids)'
+
+    def __len__(self):
+        return int(np.count_nonzero(self.strikes))
+
+    def __contains__(self, bggGameId):
+        return bggGameId < len(self.strikes) and self.strikes[bggGameId] > 0
+
+    def _grow(self, size):
+        if size > len(self.strikes):
+            size = max(size, 2 * len(self.strikes))
+            self.strikes = np.concatenate([self.strikes, np.zeros(size - len(self.strikes), dtype=np.uint8)])
+            self.checked = np.concatenate([self.checked, np.zeros(size - len(self.checked), dtype=np.uint16)])
+
+    def due(self, ids, today=None):
+        '''Return a boolean array, for each of the ids, of whether it should
+           be queried:  i.e. it isn't tombstoned, or is due to be rechecked.
+        '''
+        today = _today() if today is None else today
+        ids = np.asarray(ids, dtype=np.int64)
+        self._grow(int(ids.max()) + 1 if len(ids) else 0)
+        strikes = self.strikes[ids].astype(np.int64)
+        interval = np.minimum(TOMBSTONE_RECHECK_DAYS * 2.0 ** np.maximum(strikes - 1, 0),
+                              TOMBSTONE_MAX_RECHECK_DAYS)
+        return (strikes == 0) | (today - self.checked[ids].astype(np.int64) >= interval)
+
+    def bury(self, ids, today=None):
+        '''Tombstone the ids (or add another strike, if already tombstoned).'''
+        today = _today() if today is None else today
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        if len(ids):
+            self._grow(int(ids.max()) + 1)
+            self.strikes[ids] = np.minimum(self.strikes[ids].astype(np.int64) + 1, 255)
+            self.checked[ids] = today
+
+    def revive(self, ids):
+        '''Remove the ids from the tombstones (e.g. when they come back as games).'''
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[ids < len(self.strikes)]
+        self.strikes[ids] = 0
+
+    def save(self):
+        '''Write the tombstones to disk (atomically).'''
+        with open(f'{self.path}.tmp', 'wb') as f:
+            np.savez_compressed(f, strikes=self.strikes, checked=self.checked)
+        os.replace(f'{self.path}.tmp', self.path)
@@ -1,68 +1,84 @@
-'''A script to update the existing game information.  Takes a block of indices
-and attempts to scrape the game information from BGG.  Then combines this
-new information with other info for games that haven't been updated, and
-writes out the data to the same dill file.
+'''A script to update the existing game information.  Chooses the games whose
+information is expected to be the most out of date (see update_scheduler.py),
+within a budget of UPDATE_BUDGET requests, and attempts to scrape the game
+information from BGG.  The budget caps the requests actually made (including
+those to refetch the games that came back without a description), and any
+games not reached within it are left for the next run.  The games are
+fetched, parsed and written in a pipeline (see pipeline.py), and each chunk
+of games is written into the game store as it arrives, which only rewrites
+the partitions that contain those games.
+
+Each chunk is logged before it is written (see run_log.py), so if a run is
+interrupted, the next run picks up where it left off rather than starting
+over with a new selection of games.
 '''
-import time
-import dill
-import glob
-import re
+from datetime import datetime
 
-import pandas as pd
-import numpy as np 
+from constants import MAX_THING_IDS, UPDATE_BUDGET
+from game_store import load_store
+from pipeline import update_indexes
+from run_log import RunLog
+from stats_history import StatsHistory
+from update_scheduler import UpdateScheduler
 
-from datetime import datetime
 
-from constants import GAME_DATA, SLEEP_DELAY
-from api_functions import getGame
+def update_existing_games(store=None, scheduler=None, budget=UPDATE_BUDGET, history=None,
+                          indexes=None):
+    '''Refresh the (about budget * MAX_THING_IDS) games expected to be the
+       most out of date, or resume an interrupted run, and update the indexes.
+       The store, scheduler and statistics history are opened if they
+       aren't given (the daemon keeps them, see daemon.py), as are the
+       indexes (see update_indexes).
 
-WINDOW = 1500
-STEP_SIZE = 5 
+       Returns:  The ids of the games updated.
+    '''
+    store = store if store is not None else load_store()
+    scheduler = scheduler if scheduler is not None else UpdateScheduler()
+    history = history if history is not None else StatsHistory()
+    all_ids = store.ids()
 
-if __name__ == '__main__':
-    game_file = sorted(glob.glob(f'{GAME_DATA}/all-to-*.dill'), key=lambda x: int(re.search(r'[\d]+',x).group(0)))[-1]
+    log = RunLog('update_existing_games')
+    #  The games to update are only chosen for a new run (a resumed run
+    #  carries on with the games it chose).
+    to_update = [] if log.resuming else scheduler.select(all_ids, budget * MAX_THING_IDS)
 
-    with open(game_file, 'rb') as f:
-        all_games = dill.load(f)
-    
-    with open('update_existing_games_start.txt', 'r') as f:
-        first = int(f.readline())
-    
-    to_update = all_games.index[first:first+WINDOW].tolist()
-    
-    result = []
     start_time = datetime.now()
     print('---------------------------')
     print(f'Start time: {start_time}')
-    print(f'{len(all_games)} games in the starting collection.')
-    
-    for index in range(0, len(to_update), STEP_SIZE):
-        games = getGame(to_update[index:index+STEP_SIZE])
-        if games is not None:
-            result.append(games)
-        time.sleep(SLEEP_DELAY)
-    
+    print(f'{len(all_ids)} games in the starting collection.')
+    if log.resuming:
+        print(f'Resuming the run started {log.manifest["started"]}.')
+
+    #  Note that we may not quite capture all the data for game indices that were in
+    #  the store, but the games for which we didn't get a valid result are simply
+    #  left as they were, since the store only replaces the rows that we write.
+    #  The statistics are also appended to their history, as the store only
+    #  keeps the latest values.
+    def apply(games, attempted, now):
+        if len(games):
+            history.append(games, now)
+            store.upsert(games)
+        scheduler.record(games.reindex(columns=['numratings', 'averating', 'bggrank']),
+                         attempted=attempted, now=now)
+        scheduler.save()
+
+    links = dict()
+    updated = log.run(to_update, apply, max_requests=budget, vocabularies=links)
+
     end_time = datetime.now()
     print(f'End time: {end_time}')
-    
-    #  Note that we may not quite capture all the data for game indices that were in the original 
-    #  all_games DataFrame, hence this is why we are taking the difference between the 
-    #  set of indices in the "result" and the portion of "all_games" that we are trying to update.  
-    #  We don't want to lose those games for which we might not have gotten a valid result in 
-    #  the update portion of this script.  
-    if result:
-        result = pd.concat(result)
-        print(f'Updated {len(result)} games in {end_time - start_time}.')
-        new = pd.concat([all_games.loc[list(set(to_update).difference(result.index))], 
-                         all_games.iloc[:first], all_games.iloc[first+WINDOW:], 
-                         result]).sort_index()
-    
-        print(f'{len(new)} games in the updated collection.')
-        with open(game_file, 'wb') as f:
-            dill.dump(new, f)
-        
-        first += WINDOW
-        if first > len(new):
-            first = 0
-        with open('update_existing_games_start.txt', 'w') as f:
-            f.write(str(first))
+    print(f'Updated {len(updated)} games in {end_time - start_time}.')
+    print(f'{len(all_ids.union(updated))} games in the updated collection.')
+
+    #  Keep the similarity, expansion and text indexes current (only the parts
+    #  affected by the updated games are recomputed).
+    update_indexes(store, updated, links, indexes)
+    log.finish()
+    #  Merge the many small files of the statistics history written over a
+    #  month, once the month is over, so that the queries don't open them all.
+    history.compact_finished()
+    return updated
+
+
+if __name__ == '__main__':
+    update_existing_games()
@@ -0,0 +1,111 @@
+#  Chooses which games to refresh on each run of update_existing_games.py.
+#  Rather than walking through the catalog in fixed windows, we keep (for each
+#  game) the time it was last fetched and an estimate of how quickly its
+#  statistics (number of ratings, average rating, rank) are changing, and
+#  refresh the games whose information is expected to be the most stale.
+
+import os
+
+import pandas as pd
+import numpy as np
+
+from datetime import datetime
+
+from constants import (UPDATE_META, INITIAL_CHANGE_RATE, MIN_CHANGE_RATE,
+                       CHANGE_RATE_SMOOTHING)
+
+META_COLUMNS = ['last_fetched', 'numratings', 'averating', 'bggrank', 'change_rate']
+
+
+def _changeScore(old, new):
+    '''A measure of how much the statistics of games changed between two
+       observations:  the relative change in the number of ratings and in
+       the rank, plus the absolute change in the average rating.
+    '''
+    ratings = (new['numratings'] - old['numratings']).abs() / (old['numratings'].fillna(0) + 10)
+    rank = (new['bggrank'] - old['bggrank']).abs() / old['bggrank']
+    average = (new['averating'] - old['averating']).abs()
+    return ratings.fillna(0) + rank.fillna(0) + average.fillna(0)
+
+
+class UpdateScheduler():
+    '''A class to keep the per-game update metadata (stored as a Parquet
+       file, indexed by the game id) and to select the games to refresh.
+
+       The change rate of a game is an exponentially smoothed estimate of
+       its _changeScore per day, and the expected staleness of a game is its
+       change rate (at least MIN_CHANGE_RATE) times the days since it was
+       last fetched.  Games that have never been fetched come first.
+    '''
+    def __init__(self, path=UPDATE_META):
+        self.path = path
+        if os.path.exists(path):
+            self.meta = pd.read_parquet(path)
+        else:
+            self.meta = pd.DataFrame(columns=META_COLUMNS,
+                                     index=pd.Index([], dtype='int64', name='id'))
+            self.meta['last_fetched'] = pd.to_datetime(self.meta['last_fetched'])
+
+    def __repr__(self):
+        return f'UpdateScheduler: {self.path} ({len(self.meta)} games)'
+
+    def staleness(self, ids, now=None):
+        '''Return a Series (indexed by game id) of the expected staleness
+           of the games, which is infinite for games never fetched.
+        '''
+        now = now or datetime.now()
+        meta = self.meta.reindex(pd.Index(ids, name='id'))
+        days = (now - meta['last_fetched']).dt.total_seconds() / 86400
+        rate = meta['change_rate'].astype(float).fillna(INITIAL_CHANGE_RATE).clip(lower=MIN_CHANGE_RATE)
+        return (days * rate).fillna(np.inf)
+
+    def select(self, ids, n, now=None):
+        '''Return the (at most) n games among ids with the greatest expected
+           staleness, with ties (e.g. games never fetched) broken in favour
+           of the newest games, i.e. the largest ids.
+        '''
+        staleness = self.staleness(ids, now)
+        order = np.lexsort((-staleness.index.to_numpy(), -staleness.to_numpy()))
+        return staleness.index[order[:n]].tolist()
+
+    def record(self, games, attempted=None, now=None):
+        '''Record that the games (a DataFrame from getGame) were fetched,
+           updating their change rates.  Any ids in "attempted" without a
+           result (e.g. games removed from BGG) are also marked as fetched,
+           so that they don't stay at the front of the queue.
+
+           Games already recorded as fetched at (or after) now are skipped,
+           so that recording the same fetch again (e.g. when a run is resumed,
+           see run_log.py) doesn't change anything.
+        '''
+        now = now or datetime.now()
+        ids = games.index
+        if attempted is not None:
+            ids = ids.union(pd.Index(attempted))
+        recorded = self.meta['last_fetched'].reindex(ids) >= now
+        ids = ids[~recorded.to_numpy()]
+        games = games[games.index.isin(ids)]
+        old = self.meta.reindex(ids)
+        new = games.reindex(ids)[['numratings', 'averating', 'bggrank']].astype(float)
+
+        days = ((now - old['last_fetched']).dt.total_seconds() / 86400).clip(lower=1 / 24)
+        observed = _changeScore(old.astype({c: float for c in ['numratings', 'averating', 'bggrank']}), new) / days
+        rate = old['change_rate'].astype(float)
+        rate = (CHANGE_RATE_SMOOTHING * observed + (1 - CHANGE_RATE_SMOOTHING) * rate)
+        #  Games seen for the first time (or not returned) keep their previous/initial rate.
+        first_time = old['last_fetched'].isna() | new['numratings'].isna()
+        rate = rate.where(~first_time, old['change_rate'].astype(float).fillna(INITIAL_CHANGE_RATE))
+
+        updated = pd.DataFrame({'last_fetched': pd.Series(now, index=ids),
+                                'numratings': new['numratings'].fillna(old['numratings'].astype(float)),
+                                'averating': new['averating'].fillna(old['averating'].astype(float)),
+                                'bggrank': new['bggrank'].where(new['numratings'].notna(),
+                                                                old['bggrank'].astype(float)),
+                                'change_rate': rate}, index=ids)
+        updated.index.name = 'id'
+        self.meta = pd.concat([self.meta.drop(index=ids, errors='ignore'), updated]).sort_index()
+
+    def save(self):
+        '''Write the metadata to disk (atomically).'''
+        self.meta.to_parquet(f'{self.path}.tmp')
+        os.replace(f'{self.path}.tmp', self.path)